@@ -0,0 +1,335 @@
+import hashlib
+import os
+import shutil
+import tarfile
+import time
+import uuid
+import zlib
+
+import ujson
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# files are hashed and shipped by incremental backups in blocks of this size
+BACKUP_BLOCK_SIZE = int(2**20)
+
+# bytes of the tar stream handed to the compressor at once
+BACKUP_CHUNK_SIZE = int(2**16)
+
+COMPRESSION_ZSTD = "zstd"
+COMPRESSION_GZIP = "gzip"
+# zstd compresses on all cores, gzip is the fallback without zstandard
+BACKUP_COMPRESSION = COMPRESSION_ZSTD if zstandard else COMPRESSION_GZIP
+
+CompressionExtensions = {
+    COMPRESSION_ZSTD: "tar.zst",
+    COMPRESSION_GZIP: "tar.gz",
+}
+
+CompressionMimetypes = {
+    COMPRESSION_ZSTD: "application/zstd",
+    COMPRESSION_GZIP: "application/gzip",
+}
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_MAGIC = b"\x1f\x8b"
+
+# the first member says what the backup is based on, the manifest with the
+# sizes and block hashes of every file comes last, once they are known
+BACKUP_INFO_NAME = "backup.json"
+MANIFEST_NAME = "manifest.json"
+FILES_DIR = "files"
+BLOCKS_DIR = "blocks"
+
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+TAR_END = b"\0" * (2 * TAR_BLOCK_SIZE)
+
+
+def make_compressor(compression):
+    if compression == COMPRESSION_ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor(threads=-1).compressobj()
+    if compression == COMPRESSION_GZIP:
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    raise ValueError(f"unknown compression {compression}")
+
+
+def make_decompressor(magic):
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ValueError("zstd backups need the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if magic.startswith(GZIP_MAGIC):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return None
+
+
+def hash_block(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def tar_member(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    return info.tobuf(tarfile.PAX_FORMAT)
+
+
+def tar_padding(size):
+    return b"\0" * (-size % TAR_BLOCK_SIZE)
+
+
+def iter_tar_bytes(member, data):
+    yield tar_member(member, len(data))
+    yield data
+    yield tar_padding(len(data))
+
+
+def hash_file(path, size, block_size):
+    hashes = []
+    with open(path, "rb") as source:
+        for _ in range(0, size, block_size):
+            hashes.append(hash_block(source.read(block_size)))
+    return hashes
+
+
+def start_backup(base, manifest):
+    """Yields the first member of a backup based on base, None if full.
+
+    ``manifest`` is filled in as files are shipped, the caller keeps it as
+    the base of the next backup.
+    """
+    manifest.update({
+        "id": uuid.uuid4().hex,
+        "base": base["id"] if base else None,
+        "block_size": base["block_size"] if base else BACKUP_BLOCK_SIZE,
+        "files": {},
+    })
+    info = {key: manifest[key] for key in ("id", "base", "block_size")}
+    yield from iter_tar_bytes(BACKUP_INFO_NAME, ujson.dumps(info).encode())
+
+
+def finish_backup(manifest):
+    yield from iter_tar_bytes(MANIFEST_NAME, ujson.dumps(manifest).encode())
+    yield TAR_END
+
+
+def read_blocks(source, size, block_size, blocks=None):
+    """Yields the blocks of the first size bytes of source, all of them or
+    the numbers given in blocks."""
+    if blocks is None:
+        blocks = range(-(-size // block_size))
+    for block in blocks:
+        offset = block * block_size
+        source.seek(offset)
+        data = source.read(min(block_size, size - offset))
+        if len(data) < min(block_size, size - offset):
+            raise ValueError(f"{source.name} shrank during backup")
+        yield block, data
+
+
+def iter_backup_file(source, filename, size, base, manifest):
+    """Yields the members shipping the first size bytes of source.
+
+    Without a base the file is shipped whole, otherwise only the blocks
+    whose hash differs from the base manifest.
+    """
+    hashes = []
+    manifest["files"][filename] = {"size": size, "blocks": hashes}
+    if base is not None:
+        yield from iter_backup_blocks(source, filename, None, size, base,
+                                      manifest)
+        return
+
+    yield tar_member(f"{FILES_DIR}/{filename}", size)
+    for _, data in read_blocks(source, size, manifest["block_size"]):
+        hashes.append(hash_block(data))
+        yield data
+    yield tar_padding(size)
+
+
+def iter_backup_blocks(source, filename, blocks, size, base, manifest):
+    """Yields the members of blocks of a file shipped before, read again.
+
+    They replace what was shipped of them, the file is resized to size.
+    Blocks the restored table already has from the base are skipped.
+    """
+    entry = manifest["files"][filename]
+    hashes = entry["blocks"]
+    entry["size"] = size
+    del hashes[-(-size // manifest["block_size"]):]
+
+    base_hashes = []
+    if base is not None:
+        base_hashes = base["files"].get(filename, {}).get("blocks", [])
+    for block, data in read_blocks(source, size, manifest["block_size"],
+                                   blocks):
+        block_hash = hash_block(data)
+        shipped = hashes[block] if block < len(hashes) else None
+        if block < len(hashes):
+            hashes[block] = block_hash
+        else:
+            hashes.append(block_hash)
+
+        # a block shipped before and changed since is shipped again even
+        # if it is back to its base
+        if base is not None and block < len(base_hashes) and \
+                base_hashes[block] == block_hash and \
+                shipped in (None, block_hash):
+            continue
+        yield from iter_tar_bytes(f"{BLOCKS_DIR}/{filename}/{block}", data)
+
+
+def compress_stream(chunks, compression):
+    compressor = make_compressor(compression)
+    buffered = []
+    buffered_size = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        buffered_size += len(chunk)
+        if buffered_size < BACKUP_CHUNK_SIZE:
+            continue
+
+        data = compressor.compress(b"".join(buffered))
+        buffered, buffered_size = [], 0
+        if data:
+            yield data
+
+    yield compressor.compress(b"".join(buffered)) + compressor.flush()
+
+
+class DecompressingReader:
+    """File-like view of a possibly compressed stream, read front to back."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = stream.read(len(ZSTD_MAGIC))
+        self.decompressor = make_decompressor(self.buffer)
+        if self.decompressor is not None:
+            self.buffer = self.decompressor.decompress(self.buffer)
+        self.position = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        while not self.eof and \
+                (size < 0 or len(self.buffer) - self.position < size):
+            data = self.stream.read(BACKUP_CHUNK_SIZE)
+            if not data:
+                self.eof = True
+                if self.decompressor is not None and \
+                        hasattr(self.decompressor, "flush"):
+                    data = self.decompressor.flush()
+            elif self.decompressor is not None:
+                data = self.decompressor.decompress(data)
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        return data
+
+
+def check_filename(filename):
+    if not filename or filename != os.path.basename(filename) or \
+            filename.startswith("."):
+        raise ValueError(f"unexpected file {filename} in backup")
+    return filename
+
+
+def copy_member(archive, member, target, offset=0):
+    source = archive.extractfile(member)
+    with open(target, "r+b" if os.path.exists(target) else "wb") as output:
+        output.seek(offset)
+        shutil.copyfileobj(source, output, BACKUP_CHUNK_SIZE)
+
+
+def read_backup(stream, stage_path, table_path, current, excluded=()):
+    """Unpacks a backup read from stream into stage_path.
+
+    Files changed by an incremental backup start as copies of the table
+    files in table_path, which has to be restored from its base, the
+    ``current`` manifest. Returns the manifest of the backup and the list
+    of files staged. Archives written before backups had a manifest hold
+    the table files at their top level, the manifest is None then and
+    ``excluded`` files found in them are skipped.
+    """
+    manifest = info = None
+    staged = []
+    with tarfile.open(fileobj=DecompressingReader(stream),
+                      mode="r|") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+
+            parts = member.name.split("/")
+            if member.name == BACKUP_INFO_NAME:
+                info = ujson.loads(archive.extractfile(member).read())
+                if info["base"] is not None and \
+                        info["base"] != (current or {}).get("id"):
+                    raise ValueError("incremental backup does not apply to "
+                                     "the table, restore its base first")
+            elif member.name == MANIFEST_NAME:
+                manifest = ujson.loads(archive.extractfile(member).read())
+            elif len(parts) == 2 and parts[0] == FILES_DIR:
+                filename = check_filename(parts[1])
+                copy_member(archive, member,
+                            os.path.join(stage_path, filename))
+                staged.append(filename)
+            elif len(parts) == 3 and parts[0] == BLOCKS_DIR and info:
+                filename = check_filename(parts[1])
+                target = os.path.join(stage_path, filename)
+                if filename not in staged:
+                    source = os.path.join(table_path, filename)
+                    if os.path.isfile(source):
+                        shutil.copyfile(source, target)
+                    staged.append(filename)
+                copy_member(archive, member, target,
+                            int(parts[2]) * info["block_size"])
+            elif info is None:
+                if len(parts) > 1 or member.name in excluded:
+                    continue
+                filename = check_filename(parts[0])
+                copy_member(archive, member,
+                            os.path.join(stage_path, filename))
+                staged.append(filename)
+            else:
+                raise ValueError(f"unexpected member {member.name} in backup")
+
+    if info is not None and manifest is None:
+        raise ValueError("backup is truncated")
+    if manifest is None:
+        return None, staged
+
+    for filename, entry in manifest["files"].items():
+        check_filename(filename)
+        target = os.path.join(stage_path, filename)
+        source = os.path.join(table_path, filename)
+        if filename not in staged:
+            if not os.path.isfile(source) or \
+                    os.path.getsize(source) == entry["size"]:
+                continue
+            # the file only shrank, none of its blocks changed
+            shutil.copyfile(source, target)
+            staged.append(filename)
+        with open(target, "r+b") as output:
+            output.truncate(entry["size"])
+
+    return manifest, staged
+
+
+def verify_backup(manifest, stage_path, table_path):
+    """Checks the staged and unchanged table files against the manifest."""
+    for filename, entry in manifest["files"].items():
+        path = os.path.join(stage_path, filename)
+        if not os.path.isfile(path):
+            path = os.path.join(table_path, filename)
+        if not os.path.isfile(path) or \
+                os.path.getsize(path) != entry["size"] or \
+                hash_file(path, entry["size"],
+                          manifest["block_size"]) != entry["blocks"]:
+            raise ValueError(f"{filename} does not match the backup")
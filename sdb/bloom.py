@@ -0,0 +1,153 @@
+import mmap
+import os
+import struct
+
+import mmh3
+import numpy as np
+
+# about 1% false positives while a filter holds no more values than it was
+# sized for
+BLOOM_BITS_PER_VALUE = 10
+BLOOM_HASHES = 7
+
+# filters are sized for twice the values they are built from, and for at
+# least this many
+BLOOM_MIN_CAPACITY = int(2**14)
+
+# fewer values are added one by one, numpy only pays off for batches
+BLOOM_VECTOR_MIN_VALUES = int(2**6)
+
+# number of bits, number of hashes and number of values added
+BloomHeaderStruct = struct.Struct("<QQQ")
+BLOOM_HEADER_SIZE = BloomHeaderStruct.size
+
+
+# positions are computed modulo 2**64 first, the way numpy does for arrays
+UINT64_MASK = int(2**64) - 1
+
+
+def bloom_positions(value, bits, hashes):
+    first, second = mmh3.hash64(str(value), seed=42, signed=False)
+    return [((first + i * second) & UINT64_MASK) % bits
+            for i in range(hashes)]
+
+
+def bloom_positions_many(values, bits, hashes):
+    hashed = np.array(
+        [mmh3.hash64(str(value), seed=42, signed=False) for value in values],
+        dtype=np.uint64).reshape(-1, 2)
+    steps = np.arange(hashes, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        positions = hashed[:, :1] + steps * hashed[:, 1:]
+    return (positions % np.uint64(bits)).ravel()
+
+
+def set_bits(array, positions):
+    masks = np.left_shift(1, positions % np.uint64(8)).astype(np.uint8)
+    np.bitwise_or.at(array, positions // np.uint64(8), masks)
+
+
+def write_bloom(path, key, values):
+    values = list(values)
+    capacity = max(2 * len(values), BLOOM_MIN_CAPACITY)
+    bits = (capacity * BLOOM_BITS_PER_VALUE + 7) // 8 * 8
+
+    array = np.zeros(bits // 8, dtype=np.uint8)
+    set_bits(array, bloom_positions_many(values, bits, BLOOM_HASHES))
+
+    # a torn filter would rule out values that exist, it is swapped in whole
+    filename = f"{key}.bloom"
+    bloom_path = os.path.join(path, filename)
+    with open(f"{bloom_path}.tmp", "wb") as bloom_file:
+        bloom_file.write(
+            BloomHeaderStruct.pack(bits, BLOOM_HASHES, len(values)))
+        bloom_file.write(array.tobytes())
+        bloom_file.flush()
+        os.fsync(bloom_file.fileno())
+    os.replace(f"{bloom_path}.tmp", bloom_path)
+    return [filename]
+
+
+class BloomFilter:
+    """Bloom filter of every value a key column ever had.
+
+    The file is mapped shared, so values added by other processes are seen
+    right away. Deleted values stay in the filter until it is rebuilt by a
+    compaction, which only costs false positives. Callers hold the table
+    lock, writers the write lock.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+
+        self.checks = 0
+        self.negatives = 0
+        self.false_positives = 0
+
+    def load(self):
+        if self.map is None:
+            with open(self.path, "r+b") as bloom_file:
+                self.map = mmap.mmap(bloom_file.fileno(), 0)
+            self.bits, self.hashes, _ = BloomHeaderStruct.unpack_from(
+                self.map)
+        return self.map
+
+    def __contains__(self, value):
+        data = self.load()
+        self.checks += 1
+        first, second = mmh3.hash64(str(value), seed=42, signed=False)
+        for i in range(self.hashes):
+            position = ((first + i * second) & UINT64_MASK) % self.bits
+            if not data[BLOOM_HEADER_SIZE + (position >> 3)] & \
+                    (1 << (position & 7)):
+                self.negatives += 1
+                return False
+        return True
+
+    def add_many(self, values):
+        data = self.load()
+        values = list(values)
+        if not values:
+            return
+
+        if len(values) < BLOOM_VECTOR_MIN_VALUES:
+            for value in values:
+                for position in bloom_positions(value, self.bits,
+                                                self.hashes):
+                    data[BLOOM_HEADER_SIZE + (position >> 3)] |= \
+                        1 << (position & 7)
+        else:
+            array = np.frombuffer(data,
+                                  dtype=np.uint8,
+                                  offset=BLOOM_HEADER_SIZE)
+            set_bits(array,
+                     bloom_positions_many(values, self.bits, self.hashes))
+            # the view has to be gone before the map can be closed
+            del array
+
+        bits, hashes, count = BloomHeaderStruct.unpack_from(data)
+        BloomHeaderStruct.pack_into(data, 0, bits, hashes,
+                                    count + len(values))
+
+    def is_full(self):
+        _, _, count = BloomHeaderStruct.unpack_from(self.load())
+        return count * BLOOM_BITS_PER_VALUE > self.bits
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def stats(self):
+        _, _, count = BloomHeaderStruct.unpack_from(self.load())
+        # share of values not in the column the filter failed to rule out
+        absent = self.negatives + self.false_positives
+        return {
+            "values": count,
+            "bits": self.bits,
+            "checks": self.checks,
+            "negatives": self.negatives,
+            "false_positives": self.false_positives,
+            "false_positive_rate":
+            self.false_positives / absent if absent else 0.0,
+        }
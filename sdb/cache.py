@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict
+
+# rough per-entry cost of the dicts and tuples around a cached record
+ENTRY_OVERHEAD = 256
+
+
+def estimate_size(record):
+    return ENTRY_OVERHEAD + sum(
+        len(key) + len(str(value)) for key, value in record.items())
+
+
+class RecordCache:
+    """LRU cache of records by primary key within a memory budget.
+
+    Values of the other key columns map to the primary key of their record,
+    so lookups by any key column share one cached copy. Records are copied
+    on the way in and out, callers are free to change what they get.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.records = OrderedDict()
+        self.keys = {}
+        self.mutex = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, name, key, value):
+        with self.mutex:
+            pk = value if key == "pk" else self.keys.get((name, key, value))
+            entry = None if pk is None else self.records.get((name, pk))
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.records.move_to_end((name, pk))
+            self.hits += 1
+            offset, record, _, _ = entry
+            return offset, dict(record)
+
+    def put(self, name, offset, record, keys):
+        size = estimate_size(record)
+        if size > self.budget:
+            return
+
+        keys = [(name, key, record[key]) for key in keys
+                if key != "pk" and key in record]
+        with self.mutex:
+            self.remove((name, record["pk"]))
+            self.records[(name, record["pk"])] = (offset, dict(record), size,
+                                                  keys)
+            for key in keys:
+                self.keys[key] = record["pk"]
+            self.size += size
+
+            while self.size > self.budget:
+                self.remove(next(iter(self.records)))
+                self.evictions += 1
+
+    def discard(self, name, record):
+        with self.mutex:
+            self.remove((name, record.get("pk")))
+
+    def remove(self, pk):
+        entry = self.records.pop(pk, None)
+        if entry is None:
+            return
+
+        _, _, size, keys = entry
+        for key in keys:
+            if self.keys.get(key) == pk[1]:
+                del self.keys[key]
+        self.size -= size
+
+    def drop_table(self, name):
+        with self.mutex:
+            for pk in [pk for pk in self.records if pk[0] == name]:
+                self.remove(pk)
+
+    def stats(self):
+        with self.mutex:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "records": len(self.records),
+                "bytes": self.size,
+                "budget": self.budget,
+            }
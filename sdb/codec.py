@@ -0,0 +1,132 @@
+import struct
+
+import ujson
+
+STORAGE_FORMAT_JSON = "json"
+STORAGE_FORMAT_BINARY = "binary"
+
+NumericStructs = {
+    "int": struct.Struct("<q"),
+    "float": struct.Struct("<d"),
+}
+StringEndStruct = struct.Struct("<I")
+
+
+class JsonCodec:
+    def encode(self, values):
+        return ujson.dumps(values).encode()
+
+    def decode(self, data):
+        return ujson.loads(data)
+
+    def decode_column(self, data, column):
+        return ujson.loads(data).get(column)
+
+    def pad(self, data, length):
+        # json ignores trailing whitespace
+        return data.ljust(length, b" ")
+
+
+class BinaryCodec:
+    """Schema-driven row encoding.
+
+    A row is a presence bitmap, then 8 bytes for every int/float column, then
+    the end offsets of the str columns and the utf-8 strings themselves. Any
+    single column is read straight from its position, without touching the
+    rest of the row.
+    """
+    def __init__(self, columns):
+        self.schema = list(columns)
+        self.columns = [(column.name, column.type) for column in columns]
+        self.bits = {name: bit for bit, (name, _) in enumerate(self.columns)}
+        self.bitmap_size = (len(self.columns) + 7) // 8
+
+        self.numeric = {}
+        self.strings = {}
+        position = self.bitmap_size
+        for name, column_type in self.columns:
+            if column_type in NumericStructs:
+                self.numeric[name] = (position, NumericStructs[column_type])
+                position += 8
+            else:
+                self.strings[name] = len(self.strings)
+
+        self.string_ends = position
+        self.string_data = position + StringEndStruct.size * len(self.strings)
+
+    # structs can not be pickled, parallel scans ship the schema instead
+    def __reduce__(self):
+        return BinaryCodec, (self.schema, )
+
+    def encode(self, values):
+        unknown = set(values) - set(self.bits)
+        if unknown:
+            raise ValueError(f"unknown columns: {', '.join(sorted(unknown))}")
+
+        data = bytearray(self.string_data)
+        strings = []
+        for name, column_type in self.columns:
+            value = values.get(name)
+            if value is not None:
+                bit = self.bits[name]
+                data[bit // 8] |= 1 << (bit % 8)
+
+            if name in self.numeric:
+                position, numeric_struct = self.numeric[name]
+                try:
+                    numeric_struct.pack_into(data, position, value or 0)
+                except struct.error as e:
+                    raise ValueError(f"{name}: {e}") from e
+            else:
+                strings.append(b"" if value is None else str(value).encode())
+
+        end = 0
+        for index, string in enumerate(strings):
+            end += len(string)
+            StringEndStruct.pack_into(
+                data, self.string_ends + StringEndStruct.size * index, end)
+
+        return bytes(data) + b"".join(strings)
+
+    def decode(self, data):
+        return {
+            name: self.read(data, name)
+            for name, _ in self.columns if self.is_present(data, name)
+        }
+
+    def decode_column(self, data, column):
+        if column not in self.bits or not self.is_present(data, column):
+            return None
+        return self.read(data, column)
+
+    def pad(self, data, length):
+        # strings are read up to their end offsets, trailing bytes are never
+        # looked at
+        return data.ljust(length, b"\0")
+
+    def is_present(self, data, name):
+        bit = self.bits[name]
+        return data[bit // 8] & (1 << (bit % 8))
+
+    def read(self, data, name):
+        numeric = self.numeric.get(name)
+        if numeric is not None:
+            position, numeric_struct = numeric
+            return numeric_struct.unpack_from(data, position)[0]
+
+        index = self.strings[name]
+        position = self.string_ends + StringEndStruct.size * index
+        end = StringEndStruct.unpack_from(data, position)[0]
+        start = 0
+        if index:
+            start = StringEndStruct.unpack_from(
+                data, position - StringEndStruct.size)[0]
+
+        return bytes(data[self.string_data + start:self.string_data +
+                          end]).decode()
+
+
+def make_codec(storage_format, columns):
+    if storage_format == STORAGE_FORMAT_BINARY:
+        return BinaryCodec(columns)
+    return JsonCodec()
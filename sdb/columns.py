@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+
+from .handles import WRITE_FLAGS
+
+# int and float columns can be projected into plain arrays aligned to markup
+# offsets, a missing int value is stored as the smallest int64
+ColumnDtypes = {
+    "int": np.dtype("<i8"),
+    "float": np.dtype("<f8"),
+}
+
+INT_MISSING = np.iinfo(np.int64).min
+
+MissingValues = {
+    "int": INT_MISSING,
+    "float": np.nan,
+}
+
+
+def encode_column(values, column_type):
+    missing = MissingValues[column_type]
+    try:
+        return np.array([missing if value is None else value
+                         for value in values],
+                        dtype=ColumnDtypes[column_type])
+    except (OverflowError, TypeError, ValueError) as e:
+        raise ValueError(f"{column_type} column: {e}") from e
+
+
+def column_present(values, column_type):
+    if column_type == "int":
+        return values != INT_MISSING
+    return ~np.isnan(values)
+
+
+class ColumnFile:
+    def __init__(self, path, column_type, handles):
+        self.path = path
+        self.column_type = column_type
+        self.dtype = ColumnDtypes[column_type]
+        self.handles = handles
+
+    def write(self, offset, values):
+        with self.handles.open(self.path, WRITE_FLAGS) as fd:
+            os.pwrite(fd, values.tobytes(), offset * self.dtype.itemsize)
+
+    def truncate(self, rows):
+        if os.path.isfile(self.path):
+            with open(self.path, "r+b") as column_file:
+                column_file.truncate(rows * self.dtype.itemsize)
+
+    def read(self, rows):
+        values = np.empty(0, dtype=self.dtype)
+        if os.path.isfile(self.path):
+            values = np.fromfile(self.path, dtype=self.dtype, count=rows)
+
+        # rows appended by a crashed writer may be missing from the file
+        if len(values) < rows:
+            missing = np.full(rows - len(values),
+                              MissingValues[self.column_type],
+                              dtype=self.dtype)
+            values = np.concatenate([values, missing])
+        return values
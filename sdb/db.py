@@ -2,20 +2,70 @@ import glob
 import os
 import shutil
 import struct
-import tarfile
-from dataclasses import asdict, dataclass
+import threading
+import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field, replace
 from functools import cache
-from typing import Any, Dict, List, Set
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Set
 
-import mmh3
+import numpy as np
 import ujson
 
+from .backup import (BACKUP_COMPRESSION, compress_stream, finish_backup,
+                     hash_block, iter_backup_blocks, iter_backup_file,
+                     read_backup, read_blocks, start_backup, verify_backup)
+from .bloom import BloomFilter, write_bloom
+from .cache import RecordCache
+from .codec import STORAGE_FORMAT_JSON, make_codec
+from .columns import ColumnDtypes, ColumnFile, column_present, encode_column
+from .export import (EXPORT_FORMAT_CSV, EXPORT_FORMAT_NDJSON, ExportMimetypes,
+                     export_columnar, export_csv, export_ndjson)
+from .handles import WRITE_FLAGS, HandlePool
+from .index import BUCKET_SPLIT_SIZE, HashIndex, MultiHashIndex, write_index
+from .locks import TableLock
+from .markup import (MARKUP_VERSION, MARKUP_VERSION_LEGACY, MarkupView,
+                     pack_markup_entries)
+from .metrics import METRICS, instrument
+from .ordered import OrderedIndex, write_ordered_index
+from .pk import PkAllocator
+from .query import (And, Eq, IsMissing, column_bounds, parse_predicate,
+                    plan_query, project)
+from .scan import (SCAN_PARALLEL_MIN_ROWS, ParallelScanner, filter_rows,
+                   read_range_data)
+from .wal import WriteAheadLog
+
 MAX_DB_SIZE = int(2**20)
 BUCKET_SIZE = int(2**10)
 NUMBER_OF_BUCKETS = int(MAX_DB_SIZE / BUCKET_SIZE)
 
-MarkupStruct = struct.Struct("ii?")
-MARKUP_STRUCT_SIZE = MarkupStruct.size
+# number of the largest buckets of an index listed by get_bucket_stats
+BUCKET_STATS_LARGEST = 10
+
+# writes split up to two buckets of an overloaded hash index, and one more
+# for every this many records they store
+RECORDS_PER_SPLIT = int(2**10)
+
+# number of records written per buffered chunk in store_records
+STORE_BATCH_SIZE = int(2**16)
+
+# number of active markup entries converted to python objects at once by scans
+SCAN_CHUNK_SIZE = int(2**12)
+
+# the write-ahead log of a table is checkpointed once it grows past this
+WAL_CHECKPOINT_SIZE = int(2**26)
+
+# background compaction never kicks in for tables smaller than this
+COMPACT_MIN_ROWS = int(2**10)
+
+AGGREGATE_OPS = ("count", "sum", "min", "max", "mean")
+
+# memory budget of the cache of records looked up by key, in bytes
+RECORD_CACHE_SIZE = int(2**26)
+
+# number of table files kept open between calls
+MAX_OPEN_FILES = int(2**9)
 
 
 @dataclass(frozen=True)
@@ -23,24 +73,177 @@ class ColumnInfo:
     name: str
     is_key: bool
     type: str
+    indexed: bool = False
+    ordered: bool = False
+
 
+# tables without a header were written before the on-disk format was versioned
+@dataclass(frozen=True)
+class TableHeader:
+    version: int = MARKUP_VERSION_LEGACY
+    number_of_buckets: int = NUMBER_OF_BUCKETS
+    storage_format: str = STORAGE_FORMAT_JSON
+    columnar: bool = False
+    # linear hashing state of the hash indexes split so far, column ->
+    # [level, split pointer]
+    splits: Dict[str, List[int]] = field(default_factory=dict)
+
+
+@dataclass
+class Compaction:
+    """Snapshot of a table a compaction copies the live rows of."""
+    header: TableHeader
+    # header and columns of the table, the copy is redone if they change
+    structure: Any
+    # id of the log checkpoint taken with the snapshot, and the number of
+    # markup entries at that point
+    checkpoint: str
+    rows: int
+    offsets: Any
+    starts: Any
+    lengths: Any
+    storage: Any
+    # offsets in the copy of rows that could not be decoded
+    dirty: Set[int] = field(default_factory=set)
+
+
+def split_chunks(payload, lengths):
+    chunks = []
+    position = 0
+    for length in lengths:
+        chunks.append(payload[position:position + length])
+        position += length
+    return chunks
 
-def hash_to_bucket(value, number_of_buckets=NUMBER_OF_BUCKETS):
-    hashed = mmh3.hash128(str(value), seed=42)
-    return hashed % NUMBER_OF_BUCKETS
 
 class DB:
-    def __init__(self, path):
+    def __init__(self,
+                 path,
+                 compact_threshold=None,
+                 sync_commits=True,
+                 scan_workers=None,
+                 record_cache_size=RECORD_CACHE_SIZE,
+                 max_open_files=MAX_OPEN_FILES):
         self.pk = 0
         self.path = os.path.abspath(path)
+        self.headers = {}
+        self.codecs = {}
+        self.indexes = {}
+        self.ordered_indexes = {}
+        self.cache = RecordCache(record_cache_size)
+        self.handles = HandlePool(max_open_files)
+        self.pks = {}
+        self.markups = {}
+        self.wals = {}
+        # when false, commits are only handed to the OS: they survive a crash
+        # of the process, but not of the machine
+        self.sync_commits = sync_commits
+        self.locks = {}
+        self.tables_lock = TableLock(os.path.join(self.path, ".tables.lock"),
+                                     lambda structure_changed: None)
+        self.compactions = {}
+        self.compaction_locks = {}
+        # fraction of dead rows that triggers a background compaction
+        self.compact_threshold = compact_threshold
+        # number of processes filtered full-table scans are spread over
+        self.scanner = None
+        if scan_workers is not None and scan_workers > 1:
+            self.scanner = ParallelScanner(scan_workers)
+
+        self.remove_stale_backups()
+        for name in self.list_tables():
+            # a compaction of another process may still be copying
+            if os.path.isdir(self.get_compaction_path(name)):
+                with self.get_compaction_lock(name).write(), \
+                        self.write_lock(name):
+                    if os.path.isdir(self.get_compaction_path(name)):
+                        self.finish_compaction(name)
+            with self.write_lock(name):
+                self.recover(name)
+                self.recover_pk(name)
+                self.recover_blooms(name)
+
+    def get_lock(self, name):
+        lock = self.locks.get(name)
+        if lock is None:
+            lock = TableLock(
+                os.path.join(self.path, f".{name}.lock"),
+                lambda structure_changed: self.invalidate_table(
+                    name, structure_changed))
+            lock = self.locks.setdefault(name, lock)
+        return lock
+
+    def get_compaction_lock(self, name):
+        # held by compactions and restores, which build the table files aside
+        # in its compaction directory
+        lock = self.compaction_locks.get(name)
+        if lock is None:
+            lock = TableLock(os.path.join(self.path, f".{name}.compact.lock"),
+                             lambda structure_changed: None)
+            lock = self.compaction_locks.setdefault(name, lock)
+        return lock
+
+    def read_lock(self, name):
+        return self.get_lock(name).read()
+
+    def write_lock(self, name):
+        return self.get_lock(name).write()
+
+    @contextmanager
+    def write_transaction(self, name):
+        with self.write_lock(name):
+            yield
+
+            wal = self.wals.get(name)
+            if wal is None:
+                return
+            lsn = wal.appended_lsn
+            if wal.size() > WAL_CHECKPOINT_SIZE:
+                self.checkpoint(name)
+
+        if self.sync_commits:
+            wal.commit(lsn)
+
+    def invalidate_table(self, name, structure_changed):
+        if structure_changed:
+            self.drop_table_state(name)
+            self.load_columns_info.cache_clear()
+            self.load_keys.cache_clear()
+            self.load_indexed_columns.cache_clear()
+            self.load_ordered_columns.cache_clear()
+            return
 
-    def create_table(self, name, columns: List[ColumnInfo] = None):
+        markup = self.markups.get(name)
+        if markup is not None:
+            markup.refresh()
+            markup.dead = None
+        self.cache.drop_table(name)
+
+        for indexes in (self.indexes, self.ordered_indexes):
+            for (table, _), index in list(indexes.items()):
+                if table == name:
+                    index.invalidate()
+
+    @instrument
+    def create_table(self,
+                     name,
+                     columns: List[ColumnInfo] = None,
+                     number_of_buckets=NUMBER_OF_BUCKETS,
+                     storage_format=STORAGE_FORMAT_JSON,
+                     columnar=False):
+        with self.write_lock(name):
+            self.do_create_table(name, columns, number_of_buckets,
+                                 storage_format, columnar)
+
+    def do_create_table(self, name, columns, number_of_buckets,
+                        storage_format, columnar):
         path = self.get_table_path(name)
 
         if os.path.exists(path):
             return
 
         os.makedirs(path)
+        self.get_lock(name).mark_structure_changed()
 
         columns = columns or []
 
@@ -49,6 +252,12 @@ class DB:
         columns.append(primary_key_column)
 
         self.store_columns_info(name, columns)
+        self.store_header(
+            name,
+            TableHeader(version=MARKUP_VERSION,
+                        number_of_buckets=number_of_buckets,
+                        storage_format=storage_format,
+                        columnar=columnar))
 
         with open(self.get_markup_path(name), "wb"):
             pass
@@ -56,7 +265,15 @@ class DB:
         with open(self.get_storage_path(name), "wb"):
             pass
 
-        with open(self.get_tables_list_path(), "at") as tables:
+        for column in columns:
+            if column.is_key:
+                write_bloom(path, column.name, [])
+
+        self.register_table(name)
+
+    def register_table(self, name):
+        with self.tables_lock.write(), \
+                open(self.get_tables_list_path(), "at") as tables:
             tables.write(f"{name}\n")
 
     def list_tables(self):
@@ -65,20 +282,26 @@ class DB:
         if not os.path.isfile(self.get_tables_list_path()):
             return tables
 
-        with open(self.get_tables_list_path(), "rt") as tables_list:
+        with self.tables_lock.read(), \
+                open(self.get_tables_list_path(), "rt") as tables_list:
             for line in tables_list:
                 tables.append(line.strip())
 
         return tables
 
+    @instrument
     def delete_table(self, name):
-        path = self.get_table_path(name)
-        if not os.path.exists(path):
-            return
+        with self.get_compaction_lock(name).write(), self.write_lock(name):
+            path = self.get_table_path(name)
+            if not os.path.exists(path):
+                return
 
-        shutil.rmtree(path)
+            self.drop_table_state(name)
+            shutil.rmtree(path)
+            self.get_lock(name).mark_structure_changed()
 
-        with open(self.get_tables_list_path(), "rt+") as tables:
+        with self.tables_lock.write(), \
+                open(self.get_tables_list_path(), "rt+") as tables:
             data = tables.readlines()
             tables.seek(0)
             for line in data:
@@ -87,7 +310,12 @@ class DB:
                     tables.write(f"{line}\n")
             tables.truncate()
 
+    @instrument
     def store_record(self, name: str, values: Dict[str, Any]):
+        with self.write_transaction(name):
+            return self.do_store_record_values(name, values)
+
+    def do_store_record_values(self, name: str, values: Dict[str, Any]):
         keys = self.load_keys(name)
 
         if "pk" not in values:
@@ -97,121 +325,1675 @@ class DB:
             if self.is_key_exist(name, key, values[key]):
                 return False
 
-        start, length = self.do_store_record(name, values)
+        self.append_records(name, [values])
 
-        offset = self.store_markup(name, start, length)
+        return True
 
-        for key in keys:
-            if key in values:
-                self.store_key(name, key, values[key], offset)
+    @instrument
+    def store_records(self, name: str, records: Iterable[Dict[str, Any]]):
+        records = iter(records)
+        stored = 0
+        while True:
+            batch = list(islice(records, STORE_BATCH_SIZE))
+            if not batch:
+                return stored
+            with self.write_transaction(name):
+                stored += self.do_store_records(name, batch)
+
+    def do_store_records(self, name: str, records: List[Dict[str, Any]]):
+        keys = self.load_keys(name)
 
-        return True
+        without_pk = [values for values in records if "pk" not in values]
+        pks = self.reserve_pks(name, len(without_pk))
+        for values, pk in zip(without_pk, pks):
+            values["pk"] = pk
 
+        accepted = []
+        seen = {key: set() for key in keys}
+        for values in records:
+            if any(values[key] in seen[key]
+                   or self.is_key_exist(name, key, values[key])
+                   for key in keys):
+                continue
+            for key in keys:
+                seen[key].add(values[key])
+            accepted.append(values)
+
+        if not accepted:
+            return 0
+
+        self.append_records(name, accepted)
+
+        return len(accepted)
+
+    def append_records(self, name, records):
+        codec = self.get_codec(name)
+        chunks = [codec.encode(values) for values in records]
+
+        # values that do not fit the projection are rejected before logging
+        projection = self.encode_projection(name, records)
+
+        markup = self.get_markup(name)
+        markup.refresh()
+        offset = len(markup)
+        start = os.path.getsize(self.get_storage_path(name))
+
+        self.get_wal(name).append(
+            {
+                "op": "store",
+                "offset": offset,
+                "start": start,
+                "lengths": [len(data) for data in chunks],
+            }, b"".join(chunks))
+        self.write_records(name, offset, start, chunks, records, projection)
+
+        return offset
+
+    def encode_projection(self, name, records):
+        return {
+            column.name: encode_column(
+                [values.get(column.name) for values in records], column.type)
+            for column in self.load_projected_columns(name)
+        }
+
+    def write_records(self,
+                      name,
+                      offset,
+                      start,
+                      chunks,
+                      records,
+                      projection=None):
+        with self.handles.open(self.get_storage_path(name), WRITE_FLAGS) as fd:
+            os.pwrite(fd, b"".join(chunks), start)
+        METRICS.inc("sdb_bytes_written_total",
+                    sum(len(data) for data in chunks),
+                    table=name,
+                    file="storage")
+
+        spans = []
+        for data in chunks:
+            spans.append((start, len(data)))
+            start += len(data)
+        self.get_markup(name).write(offset, spans)
+
+        for column in self.load_indexed_columns(name):
+            index = self.get_index(name, column)
+            index.put_many((values[column], row)
+                           for row, values in enumerate(records, start=offset)
+                           if column in values)
+            # the growth of an index is spread over the writes that cause it
+            for _ in range(2 + len(records) // RECORDS_PER_SPLIT):
+                if not index.is_overloaded():
+                    break
+                self.split_bucket(name, column)
+        for column in self.load_keys(name):
+            bloom = self.get_index(name, column).bloom
+            if bloom is not None and bloom.is_full():
+                self.resize_bloom(name, column)
+
+        for column in self.load_ordered_columns(name):
+            self.get_ordered_index(name, column).put_many(
+                (values[column], row)
+                for row, values in enumerate(records, start=offset)
+                if values.get(column) is not None)
+
+        if projection is None:
+            projection = self.encode_projection(name, records)
+        for column in self.load_projected_columns(name):
+            self.get_column_file(name, column).write(offset,
+                                                     projection[column.name])
+
+    def delete_records_at(self, name, rows):
+        if not rows:
+            return 0
+
+        # the tombstones are flipped in one go and every bucket of an index
+        # gets one append, however many of its rows go away
+        offsets = [offset for offset, _ in rows]
+        self.get_wal(name).append({"op": "delete", "offsets": offsets})
+        self.get_markup(name).set_inactive(offsets)
+        self.cleanup_indexes(name, rows)
+        for _, record in rows:
+            self.cache.discard(name, record)
+        return len(rows)
+
+    @instrument
     def get_record(self, name, key, value):
         keys = self.load_keys(name)
 
         if key in keys:
             yield self.get_record_by_key(name, key, value)
+        elif key in self.load_indexed_columns(name):
+            for record in self.get_record_by_index(name, key, value):
+                yield record
         else:
             for record in self.get_record_by_non_key(name, key, value):
                 yield record
 
+    @instrument
     def list_records(self, name):
-        with open(self.get_storage_path(name), "rb") as storage:
-            for markup in self.list_markup_records(name):
+        for _, record in self.scan_records(name):
+            yield record
+
+    @instrument
+    def scan_records(self, name, after=-1, predicate=None, window=None):
+        """Yields the offsets and records of the active rows after ``after``.
+
+        Callers reading only a few rows pass a ``window``: the markup is
+        then looked at that many active rows at a time, a window twice as
+        big as the last one once it is exhausted.
+        """
+        while True:
+            # the markup snapshot and the storage handle are taken together,
+            # so a scan keeps reading consistent files if a compaction swaps
+            # them
+            with self.read_lock(name):
+                offsets, starts, lengths = self.get_markup(name).active(
+                    after, window)
+                storage = open(self.get_storage_path(name), "rb")
+                codec = self.get_codec(name)
+
+            METRICS.inc("sdb_file_opens_total", table=name)
+            with storage:
+                # without a predicate every row is sent back pickled, which
+                # costs more than decoding it here
+                if self.scanner is not None and predicate is not None and \
+                        len(offsets) >= SCAN_PARALLEL_MIN_ROWS:
+                    rows = self.scanner.scan(storage, codec, offsets, starts,
+                                             lengths, predicate)
+                else:
+                    rows = self.read_chunks(name, storage, codec, offsets,
+                                            starts, lengths, predicate)
+
+                yield from METRICS.count(rows,
+                                         "sdb_rows_returned_total",
+                                         table=name)
+
+            if window is None or len(offsets) < window:
+                return
+            after = int(offsets[-1])
+            window *= 2
+
+    def read_chunks(self, name, storage, codec, offsets, starts, lengths,
+                    predicate):
+        rows = self.read_data_chunks(name, storage, offsets, starts, lengths)
+        return filter_rows(codec, rows, predicate)
+
+    def scan_rows(self, name, after=-1):
+        with self.read_lock(name):
+            offsets, starts, lengths = self.get_markup(name).active(after)
+            storage = open(self.get_storage_path(name), "rb")
+
+        METRICS.inc("sdb_file_opens_total", table=name)
+        with storage:
+            yield from METRICS.count(
+                self.read_data_chunks(name, storage, offsets, starts,
+                                      lengths),
+                "sdb_rows_returned_total",
+                table=name)
+
+    def read_data_chunks(self, name, storage, offsets, starts, lengths):
+        # rows and bytes are counted as the chunks are reached, scans that
+        # stop early don't count the rest of their snapshot
+        for chunk in range(0, len(offsets), SCAN_CHUNK_SIZE):
+            chunk = slice(chunk, chunk + SCAN_CHUNK_SIZE)
+            METRICS.inc("sdb_bytes_read_total",
+                        int(lengths[chunk].sum()),
+                        table=name,
+                        file="storage")
+            rows = read_range_data(storage, offsets[chunk], starts[chunk],
+                                   lengths[chunk])
+            yield from METRICS.count(rows,
+                                     "sdb_rows_scanned_total",
+                                     table=name)
+
+    def scan_matching(self, name, key, value, after=-1, window=None):
+        return self.scan_records(name, after, Eq(key, value), window)
+
+    @instrument
+    def iter_records(self,
+                     name,
+                     key=None,
+                     value=None,
+                     after=-1,
+                     order_by=None,
+                     descending=False,
+                     window=None):
+        if order_by is not None:
+            predicate = None if key is None else Eq(key, value)
+            yield from self.iter_ordered(name, order_by, predicate,
+                                         descending,
+                                         None if after < 0 else after)
+            return
+
+        if key is None:
+            yield from self.scan_records(name, after, window=window)
+            return
 
-                _, start, length, active = markup
-                if not active:
+        if key in self.load_indexed_columns(name):
+            with self.read_lock(name):
+                offsets = self.get_index(name, key).get(value)
+            if key in self.load_keys(name):
+                offsets = [] if offsets is None else [offsets]
+
+            for offset in offsets:
+                if offset <= after:
                     continue
+                record = self.read_record(name, offset)
+                if record is not None:
+                    yield offset, record
+            return
 
-                storage.seek(start)
-                data = storage.read(length)
-                record = ujson.loads(data)
-                yield record
+        yield from self.scan_matching(name, key, value, after, window)
+
+    @instrument
+    def list_records_page(self,
+                          name,
+                          after=None,
+                          limit=10,
+                          key=None,
+                          value=None,
+                          order_by=None,
+                          descending=False):
+        after = -1 if after is None else after
+        page = list(
+            islice(
+                self.iter_records(name, key, value, after, order_by,
+                                  descending, limit + 1), limit + 1))
+
+        next_after = None
+        if len(page) > limit:
+            page = page[:limit]
+            next_after = page[-1][0]
+
+        return [record for _, record in page], next_after
+
+    @instrument
+    def query(self,
+              name,
+              predicate=None,
+              columns=None,
+              limit=None,
+              order_by=None,
+              descending=False):
+        if order_by is not None:
+            rows = self.iter_ordered(name, order_by, predicate, descending)
+        else:
+            rows = self.execute_plan(name, self.explain(name, predicate),
+                                     predicate)
+        if limit is not None:
+            rows = islice(rows, limit)
+
+        for _, record in rows:
+            yield project(record, columns)
+
+    def explain(self, name, predicate=None):
+        return plan_query(predicate, self.load_keys(name),
+                          self.load_indexed_columns(name),
+                          self.load_ordered_columns(name))
+
+    def execute_plan(self, name, plan, predicate):
+        if plan.kind == "scan":
+            yield from self.scan_records(name, predicate=predicate)
+            return
+        if plan.kind == "range":
+            yield from self.iter_ordered(name, plan.column, predicate)
+            return
 
+        lookups = plan.values
+        if plan.kind == "index":
+            lookups = [(plan.column, plan.values)]
+
+        with self.read_lock(name):
+            offsets = set()
+            for column, values in lookups:
+                index = self.get_index(name, column)
+                for value in values:
+                    found = index.get(value)
+                    if column in self.load_keys(name):
+                        found = [] if found is None else [found]
+                    offsets.update(found)
+
+        for offset in sorted(offsets):
+            record = self.read_record(name, offset)
+            if record is not None and predicate.matches(record):
+                yield offset, record
+
+    def iter_ordered(self,
+                     name,
+                     column,
+                     predicate=None,
+                     descending=False,
+                     after=None):
+        """Iterates (offset, record) pairs sorted by an ordered column.
+
+        Rows without a value in the column come last, in markup order.
+        ``after`` is the offset of the last row of the previous page.
+        """
+        if column not in self.load_ordered_columns(name):
+            raise ValueError(f"{column} has no ordered index")
+
+        low, high = column_bounds(predicate, column)
+        bounded = (low, high) != (None, None)
+
+        cursor = None
+        tail_after = -1
+        if after is not None:
+            record = self.read_record(name, after, inactive=True)
+            value = None if record is None else record.get(column)
+            if value is None:
+                tail_after = after
+            elif descending:
+                cursor = (value, after)
+                high = value if high is None else min(high, value)
+            else:
+                cursor = (value, after)
+                low = value if low is None else max(low, value)
+
+        if tail_after < 0:
+            with self.read_lock(name):
+                entries = self.get_ordered_index(name, column).range(
+                    low, high, descending)
+
+            for value, offset in entries:
+                if cursor is not None and (
+                    (value, offset) >= cursor if descending else
+                    (value, offset) <= cursor):
+                    continue
+
+                # entries of rows changed after the snapshot are skipped
+                record = self.read_record(name, offset)
+                if record is None or record.get(column) != value:
+                    continue
+                if predicate is None or predicate.matches(record):
+                    yield offset, record
+
+        if not bounded:
+            missing = IsMissing(column)
+            if predicate is not None:
+                missing = And(missing, predicate)
+            yield from self.scan_records(name, tail_after, missing)
+
+    def parse_query(self, name, spec):
+        return parse_predicate(spec, lambda column, value: self.cast_value(
+            name, column, value))
+
+    @instrument
     def delete_record(self, name, key, value):
         keys = self.load_keys(name)
 
-        if key in keys:
-            return self.delete_record_by_key(name, key, value)
-        else:
-            return self.delete_record_by_non_key(name, key, value)
+        with self.write_transaction(name):
+            if key in keys:
+                result = self.delete_record_by_key(name, key, value)
+            elif key in self.load_indexed_columns(name):
+                result = self.delete_record_by_index(name, key, value)
+            else:
+                result = self.delete_record_by_non_key(name, key, value)
+
+        self.maybe_compact(name)
+        return result
 
     def edit_record(self, name, pk, key, value):
-        record = self.get_record_by_key(name, "pk", pk)
-        if record[key] == value:
+        return self.update_record(name, pk, {key: value})
+
+    @instrument
+    def update_record(self, name, pk, changes):
+        with self.write_transaction(name):
+            found = self.find_record_by_key(name, "pk", pk)
+            if found is None:
+                return False
+            updated = self.do_update_records(name, [found], changes)
+
+        self.maybe_compact(name)
+        return updated == 1
+
+    @instrument
+    def delete_records(self, name, predicate):
+        # without a predicate the plan is a scan of the whole table
+        if predicate is None:
+            raise ValueError("a predicate is required, the table is not "
+                             "emptied")
+
+        with self.write_transaction(name):
+            rows = list(
+                self.execute_plan(name, self.explain(name, predicate),
+                                  predicate))
+            deleted = self.delete_records_at(name, rows)
+
+        self.maybe_compact(name)
+        return deleted
+
+    @instrument
+    def update_records(self, name, predicate, changes):
+        with self.write_transaction(name):
+            rows = list(
+                self.execute_plan(name, self.explain(name, predicate),
+                                  predicate))
+            updated = self.do_update_records(name, rows, changes)
+
+        self.maybe_compact(name)
+        return updated
+
+    def do_update_records(self, name, rows, changes):
+        if "pk" in changes:
+            raise ValueError("pk can not be changed")
+
+        keys = [key for key in self.load_keys(name) if key in changes]
+        indexed = self.load_indexed_columns(name) | \
+            self.load_ordered_columns(name)
+        codec = self.get_codec(name)
+        markup = self.get_markup(name)
+        markup.refresh()
+        end = os.path.getsize(self.get_storage_path(name))
+
+        updates, chunks, records = [], [], []
+        seen = {key: set() for key in keys}
+        for offset, record in rows:
+            values = dict(record)
+            values.update(changes)
+            if values == record:
+                continue
+            if any(values[key] != record.get(key) and (
+                    values[key] in seen[key]
+                    or self.is_key_exist(name, key, values[key]))
+                   for key in keys):
+                continue
+            for key in keys:
+                seen[key].add(values[key])
+
+            # a row that still fits is overwritten where it is, padded to
+            # its old length: scans that took their snapshot before still
+            # read the slot whole. A longer one is appended and its markup
+            # slot is pointed to the copy
+            data = codec.encode(values)
+            start, length, _ = markup.read(offset)
+            if len(data) > length:
+                start = end
+                end += len(data)
+            else:
+                data = codec.pad(data, length)
+
+            updates.append({
+                "offset": offset,
+                "start": start,
+                "changed": {
+                    column: [record.get(column),
+                             values.get(column)]
+                    for column in indexed
+                    if record.get(column) != values.get(column)
+                },
+            })
+            chunks.append(data)
+            records.append(values)
+
+        if not updates:
+            return 0
+
+        self.encode_projection(name, records)
+        wal = self.get_wal(name)
+        lsn = wal.append(
+            {
+                "op": "update",
+                "rows": updates,
+                "lengths": [len(data) for data in chunks],
+            }, b"".join(chunks))
+        # committed rows are changed in place, unlike appended ones they can
+        # not be truncated away by recovery if the entry never made it
+        if self.sync_commits:
+            wal.commit(lsn)
+        self.write_updates(name, updates, chunks, records)
+
+        return len(updates)
+
+    def write_updates(self, name, updates, chunks, records):
+        with self.handles.open(self.get_storage_path(name), WRITE_FLAGS) as fd:
+            for update, data in zip(updates, chunks):
+                os.pwrite(fd, data, update["start"])
+        METRICS.inc("sdb_bytes_written_total",
+                    sum(len(data) for data in chunks),
+                    table=name,
+                    file="storage")
+
+        markup = self.get_markup(name)
+        hashed = self.load_indexed_columns(name)
+        ordered = self.load_ordered_columns(name)
+        projected = self.load_projected_columns(name)
+        for update, data, record in zip(updates, chunks, records):
+            offset = update["offset"]
+            markup.write(offset, [(update["start"], len(data))])
+
+            for column, (old, new) in update["changed"].items():
+                indexes = []
+                if column in hashed:
+                    indexes.append(self.get_index(name, column))
+                if column in ordered:
+                    indexes.append(self.get_ordered_index(name, column))
+                for index in indexes:
+                    if old is not None:
+                        index.remove(old, offset)
+                    if new is not None:
+                        index.put_many([(new, offset)])
+
+            if projected:
+                projection = self.encode_projection(name, [record])
+                for column in projected:
+                    self.get_column_file(name, column).write(
+                        offset, projection[column.name])
+
+            self.cache.discard(name, record)
+
+    def get_cache_stats(self):
+        return self.cache.stats()
+
+    def get_bloom_stats(self, name):
+        with self.read_lock(name):
+            stats = {}
+            for key in self.load_keys(name):
+                bloom = self.get_index(name, key).bloom
+                if bloom is not None:
+                    stats[key] = bloom.stats()
+            return stats
+
+    def get_bucket_stats(self, name, column):
+        with self.read_lock(name):
+            if column not in self.load_indexed_columns(name):
+                raise ValueError(f"{column} has no hash index")
+
+            index = self.get_index(name, column)
+            sizes = index.get_bucket_sizes()
+            largest = sorted(range(len(sizes)), key=sizes.__getitem__,
+                             reverse=True)[:BUCKET_STATS_LARGEST]
+            return {
+                "buckets": len(sizes),
+                "level": index.level,
+                "split": index.split,
+                "bytes": sum(sizes),
+                "mean_bytes": sum(sizes) / len(sizes),
+                "max_bytes": max(sizes),
+                "largest": [{
+                    "bucket": bucket,
+                    "bytes": sizes[bucket]
+                } for bucket in largest],
+            }
+
+    def get_garbage_stats(self, name):
+        with self.read_lock(name):
+            markup = self.get_markup(name)
+            markup.refresh()
+            entries = markup.entries
+            storage_bytes = os.path.getsize(self.get_storage_path(name))
+
+        active = entries["active"]
+
+        rows = len(entries)
+        dead_rows = rows - int(np.count_nonzero(active))
+        live_bytes = int(entries["length"][active].sum(dtype=np.int64))
+
+        return {
+            "rows": rows,
+            "dead_rows": dead_rows,
+            "dead_rows_ratio": dead_rows / rows if rows else 0.0,
+            "storage_bytes": storage_bytes,
+            "dead_bytes": storage_bytes - live_bytes,
+        }
+
+    @instrument
+    def aggregate(self, name, column, op, group_by=None):
+        if op not in AGGREGATE_OPS:
+            raise ValueError(f"unknown aggregate: {op}")
+
+        types = {info.name: info.type for info in self.load_columns_info(name)}
+        for key in (column, group_by):
+            if key is not None and key not in types:
+                raise KeyError(key)
+        if op != "count" and (column is None
+                              or types[column] not in ColumnDtypes):
+            raise ValueError(f"{op} needs an int or float column")
+
+        with self.read_lock(name):
+            offsets, _, _ = self.get_markup(name).active()
+            present = np.ones(len(offsets), dtype=bool)
+            values = None
+            if column is not None:
+                values = self.load_column(name, column, offsets)
+                present = self.get_present(values, types[column])
+
+            if group_by is None:
+                return self.aggregate_values(values, present, op)
+
+            groups = self.load_column(name, group_by, offsets)
+
+        codes, keys = self.group_codes(groups, types[group_by])
+        return dict(
+            zip(keys, self.aggregate_groups(values, present, codes,
+                                            len(keys), op)))
+
+    def load_column(self, name, column, offsets):
+        info = self.get_column_info(name, column)
+        column_type = info.type
+        if column_type in ColumnDtypes and self.load_header(name).columnar:
+            rows = len(self.get_markup(name))
+            return self.get_column_file(name, info).read(rows)[offsets]
+
+        # columns without a projection are read from the rows themselves,
+        # the scan runs under the caller's lock and sees the same offsets
+        codec = self.get_codec(name)
+        values = [
+            codec.decode_column(data, column)
+            for _, data in self.scan_rows(name)
+        ]
+        if column_type in ColumnDtypes:
+            return encode_column(values, column_type)
+        return values
+
+    def get_column_info(self, name, column):
+        for info in self.load_columns_info(name):
+            if info.name == column:
+                return info
+
+    def get_present(self, values, column_type):
+        if column_type in ColumnDtypes:
+            return column_present(values, column_type)
+        return np.array([value is not None for value in values], dtype=bool)
+
+    def aggregate_values(self, values, present, op):
+        if op == "count":
+            return int(np.count_nonzero(present))
+
+        values = values[present]
+        if not len(values):
+            return 0 if op == "sum" else None
+        if op == "mean":
+            return float(values.mean())
+        return getattr(values, op)().item()
+
+    def group_codes(self, groups, column_type):
+        # rows without a group value are collected under None
+        if column_type in ColumnDtypes:
+            present = column_present(groups, column_type)
+            keys, inverse = np.unique(groups[present], return_inverse=True)
+            codes = np.full(len(groups), len(keys), dtype=np.int64)
+            codes[present] = inverse
+            keys = keys.tolist()
+            if not present.all():
+                keys.append(None)
+            return codes, keys
+
+        known = {}
+        codes = np.fromiter(
+            (known.setdefault(group, len(known)) for group in groups),
+            dtype=np.int64,
+            count=len(groups))
+        return codes, list(known)
+
+    def aggregate_groups(self, values, present, codes, groups, op):
+        counts = np.bincount(codes[present], minlength=groups)
+        if op == "count":
+            return counts.tolist()
+
+        codes = codes[present]
+        values = values[present]
+        if op in ("sum", "mean"):
+            sums = np.zeros(groups, dtype=values.dtype)
+            np.add.at(sums, codes, values)
+            if op == "sum":
+                return sums.tolist()
+            return [
+                float(total) / count if count else None
+                for total, count in zip(sums.tolist(), counts.tolist())
+            ]
+
+        if values.dtype.kind == "f":
+            fill = np.inf if op == "min" else -np.inf
+        else:
+            limits = np.iinfo(values.dtype)
+            fill = limits.max if op == "min" else limits.min
+        result = np.full(groups, fill, dtype=values.dtype)
+        getattr(np, "minimum" if op == "min" else "maximum").at(
+            result, codes, values)
+        return [
+            value if count else None
+            for value, count in zip(result.tolist(), counts.tolist())
+        ]
+
+    @instrument
+    def create_projection(self, name):
+        with self.write_lock(name):
+            header = self.load_header(name)
+            if header.columnar:
+                return
+
+            columns = [
+                column for column in self.load_columns_info(name)
+                if column.type in ColumnDtypes
+            ]
+            markup = self.get_markup(name)
+            markup.refresh()
+            rows = len(markup)
+            values = {column.name: [None] * rows for column in columns}
+            codec = self.get_codec(name)
+            for offset, data in self.scan_rows(name):
+                for column in columns:
+                    values[column.name][offset] = codec.decode_column(
+                        data, column.name)
+
+            for column in columns:
+                path = self.get_column_path(name, column.name)
+                with open(path, "wb") as column_file:
+                    column_file.write(
+                        encode_column(values[column.name],
+                                      column.type).tobytes())
+
+            self.store_header(name, replace(header, columnar=True))
+            self.headers.pop(name, None)
+            self.get_lock(name).mark_structure_changed()
+
+    def maybe_compact(self, name):
+        if self.compact_threshold is None:
             return
-        self.delete_record_by_key(name, "pk", pk)
-        record[key] = value
 
-        self.store_record(name, record)
+        with self.read_lock(name):
+            markup = self.get_markup(name)
+            rows = len(markup)
+            if rows < COMPACT_MIN_ROWS:
+                return
+            if markup.count_dead() / rows < self.compact_threshold:
+                return
 
-    def get_tables_list_path(self):
-        return os.path.join(self.path, "tables.txt")
+        compaction = self.compactions.get(name)
+        if compaction is not None and compaction.is_alive():
+            return
 
-    def store_markup(self, name, begin, length):
-        with open(self.get_markup_path(name), "ab") as markup:
-            offset = int(markup.tell() / MARKUP_STRUCT_SIZE)
-            markup.write(MarkupStruct.pack(begin, length, True))
-            return offset
+        compaction = threading.Thread(target=self.compact,
+                                      args=(name, ),
+                                      daemon=True)
+        self.compactions[name] = compaction
+        compaction.start()
+
+    @instrument
+    def migrate(self, name, number_of_buckets=None, storage_format=None):
+        header = self.load_header(name)
+        number_of_buckets = number_of_buckets or header.number_of_buckets
+        storage_format = storage_format or header.storage_format
+
+        # indexes are rewritten from scratch for another number of buckets
+        splits = header.splits
+        if number_of_buckets != header.number_of_buckets:
+            splits = {}
+
+        return self.compact(
+            name,
+            replace(header,
+                    version=MARKUP_VERSION,
+                    number_of_buckets=number_of_buckets,
+                    storage_format=storage_format,
+                    splits=splits))
+
+    @instrument
+    def compact(self, name, header=None):
+        """Rewrites the table files without the dead rows.
+
+        The live rows are copied from a snapshot without holding the table
+        lock. Changes made meanwhile are found in the write-ahead log and
+        applied to the copy under the write lock, right before it is
+        swapped in.
+        """
+        with self.get_compaction_lock(name).write():
+            with self.write_lock(name):
+                compaction = self.start_compaction(name, header)
+                stats = self.get_garbage_stats(name)
+                bytes_before = self.get_table_size(name)
+
+            try:
+                self.copy_compaction(name, compaction)
+                with self.write_lock(name):
+                    if not self.catch_up_compaction(name, compaction):
+                        # the columns changed or the log was checkpointed,
+                        # the copy is redone with writers kept out
+                        compaction.storage.close()
+                        compaction = self.start_compaction(name, header)
+                        self.copy_compaction(name, compaction)
+                        self.catch_up_compaction(name, compaction)
+                    self.commit_compaction(name, compaction)
+                    bytes_after = self.get_table_size(name)
+            finally:
+                compaction.storage.close()
+
+        stats.update({
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "reclaimed_bytes": bytes_before - bytes_after,
+        })
+        return stats
+
+    def start_compaction(self, name, header):
+        # the log starts over, what it holds from now on is what the copy
+        # misses
+        checkpoint = self.checkpoint(name)
+        current = self.load_header(name)
+        offsets, starts, lengths = self.get_markup(name).active()
+
+        path = self.get_compaction_path(name)
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
 
-    def list_markup_records(self, name):
-        with open(self.get_markup_path(name), "rb") as markup:
-            while True:
-                offset = int(markup.tell() / MARKUP_STRUCT_SIZE)
+        return Compaction(header=header or current,
+                          structure=(replace(current, splits={}),
+                                     self.load_columns_info(name)),
+                          checkpoint=checkpoint["id"],
+                          rows=checkpoint["rows"],
+                          offsets=offsets,
+                          starts=starts,
+                          lengths=lengths,
+                          storage=open(self.get_storage_path(name), "rb"))
+
+    def copy_compaction(self, name, compaction):
+        header = compaction.header
+        path = self.get_compaction_path(name)
+        storage_name = os.path.basename(self.get_storage_path(name))
+        markup_name = os.path.basename(self.get_markup_path(name))
+        columns = self.load_indexed_columns(name)
+        ordered = self.load_ordered_columns(name)
+        column_values = {column: [] for column in columns | ordered}
+        projected = self.get_compaction_projection(name, header)
+        projection = {column.name: [] for column in projected}
+        spans = []
+
+        codec = self.get_codec(name)
+        target_codec = self.get_compaction_codec(name, header)
+
+        storage = compaction.storage
+        with open(os.path.join(path, storage_name), "wb") as compacted:
+            position = 0
+            for offset, (start, length) in enumerate(
+                    zip(compaction.starts.tolist(),
+                        compaction.lengths.tolist())):
+                storage.seek(start)
+                data = storage.read(length)
 
-                data = markup.read(MARKUP_STRUCT_SIZE)
-                if len(data) == 0:
-                    return
+                try:
+                    record = codec.decode(data)
+                except (ValueError, struct.error):
+                    # caught halfway through an update in place, the row is
+                    # in the log and copied again when catching up
+                    compaction.dirty.add(offset)
+                    record = {}
+                else:
+                    if target_codec is not codec:
+                        data = target_codec.encode(record)
+                        length = len(data)
+                compacted.write(data)
+
+                spans.append((position, length))
+                position += length
+
+                for column in column_values:
+                    if record.get(column) is not None:
+                        column_values[column].append((record[column], offset))
+                for column in projection:
+                    projection[column].append(record.get(column))
+
+            compacted.flush()
+            os.fsync(compacted.fileno())
+
+        with open(os.path.join(path, markup_name), "wb") as markup:
+            markup.write(pack_markup_entries(spans, header.version))
+            markup.flush()
+            os.fsync(markup.fileno())
+
+        self.store_header(name, header, path)
+        for column in columns:
+            write_index(path, column, header.number_of_buckets,
+                        column_values[column],
+                        *header.splits.get(column, (0, 0)))
+        for column in self.load_keys(name):
+            write_bloom(path, column,
+                        (value for value, _ in column_values[column]))
+        for column in ordered:
+            write_ordered_index(path, column, column_values[column])
+
+        for column in projected:
+            column_name = os.path.basename(
+                self.get_column_path(name, column.name))
+            with open(os.path.join(path, column_name), "wb") as values:
+                values.write(
+                    encode_column(projection[column.name],
+                                  column.type).tobytes())
+
+    def catch_up_compaction(self, name, compaction):
+        """Applies the rows changed since the snapshot to the copy.
+
+        Returns False when the copy can not be caught up: the table
+        structure changed, or the log was checkpointed and lost the
+        changes.
+        """
+        entries = self.get_wal(name).read()
+        current = self.load_header(name)
+        if not entries or entries[0][0].get("id") != compaction.checkpoint \
+                or compaction.structure != (replace(current, splits={}),
+                                            self.load_columns_info(name)):
+            return False
 
-                record = MarkupStruct.unpack(data)
-                yield offset, *record
+        markup = self.get_markup(name)
+        markup.refresh()
+        touched = set(range(compaction.rows, len(markup)))
+        for meta, _ in entries[1:]:
+            if meta["op"] == "store":
+                touched.update(
+                    range(meta["offset"],
+                          meta["offset"] + len(meta["lengths"])))
+            elif meta["op"] == "update":
+                touched.update(row["offset"] for row in meta["rows"])
+            elif meta["op"] == "delete":
+                touched.update(meta["offsets"])
+        touched.update(compaction.offsets[sorted(compaction.dirty)].tolist())
+        if not touched:
+            return True
+
+        header = compaction.header
+        path = self.get_compaction_path(name)
+        codec = self.get_codec(name)
+        target_codec = self.get_compaction_codec(name, header)
+        target_markup = MarkupView(
+            os.path.join(path, os.path.basename(self.get_markup_path(name))),
+            header.version)
+        keys = self.load_keys(name)
+        indexes = []
+        for column in self.load_indexed_columns(name):
+            index_class = HashIndex if column in keys else MultiHashIndex
+            indexes.append(
+                index_class(path, column, header.number_of_buckets,
+                            self.handles, None,
+                            *header.splits.get(column, (0, 0))))
+        indexes += [
+            OrderedIndex(path, column, self.handles)
+            for column in self.load_ordered_columns(name)
+        ]
+        blooms = [(key, BloomFilter(os.path.join(path, f"{key}.bloom")))
+                  for key in keys]
+        projected = [(column,
+                      ColumnFile(
+                          os.path.join(
+                              path,
+                              os.path.basename(
+                                  self.get_column_path(name, column.name))),
+                          column.type, self.handles))
+                     for column in self.get_compaction_projection(
+                         name, header)]
+
+        storage_path = os.path.join(
+            path, os.path.basename(self.get_storage_path(name)))
+        next_offset = len(compaction.offsets)
+        removed = [[] for _ in indexes]
+        added = [[] for _ in indexes]
+        keys_added = [[] for _ in blooms]
+        try:
+            with open(self.get_storage_path(name), "rb") as storage, \
+                    open(storage_path, "r+b") as compacted:
+                position = compacted.seek(0, os.SEEK_END)
+                for offset in sorted(touched):
+                    # rows copied from the snapshot keep their new offset
+                    copied = int(
+                        np.searchsorted(compaction.offsets, offset))
+                    if copied < len(compaction.offsets) and \
+                            compaction.offsets[copied] == offset:
+                        if copied not in compaction.dirty:
+                            start, length, _ = target_markup.read(copied)
+                            compacted.seek(start)
+                            previous = target_codec.decode(
+                                compacted.read(length))
+                            for index, items in zip(indexes, removed):
+                                if previous.get(index.key) is not None:
+                                    items.append((previous[index.key], copied))
+                    elif offset < compaction.rows:
+                        continue
+                    else:
+                        copied = None
 
-    def to_csv(self, name):
-        columns = [column.name for column in self.load_columns_info(name)]
-        header = ",".join(columns)
-        yield f"{header}\n"
-        for record in self.list_records(name):
-            record = ",".join(str(record[column]) for column in columns)
-            yield f"{record}\n"
+                    entry = markup.read(offset)
+                    if entry is None or not entry[2]:
+                        if copied is not None:
+                            target_markup.set_inactive([copied])
+                        continue
 
-    def backup(self, name, output_file):
-        with tarfile.open(output_file, "w|gz") as archive:
-            files = glob.glob(os.path.join(self.get_table_path(name), "*"))
-            for fn in files:
-                archive.add(fn, os.path.basename(fn))
+                    storage.seek(entry[0])
+                    data = storage.read(entry[1])
+                    record = codec.decode(data)
+                    if target_codec is not codec:
+                        data = target_codec.encode(record)
+                    if copied is None:
+                        copied = next_offset
+                        next_offset += 1
+
+                    compacted.seek(position)
+                    compacted.write(data)
+                    target_markup.write(copied, [(position, len(data))])
+                    position += len(data)
+
+                    for index, items in zip(indexes, added):
+                        if record.get(index.key) is not None:
+                            items.append((record[index.key], copied))
+                    for (key, _), values in zip(blooms, keys_added):
+                        if record.get(key) is not None:
+                            values.append(record[key])
+                    for column, column_file in projected:
+                        column_file.write(
+                            copied,
+                            encode_column([record.get(column.name)],
+                                          column.type))
+
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.fsync(target_markup.file.fileno())
+
+            for index, items in zip(indexes, removed):
+                index.remove_many(items)
+            for index, items in zip(indexes, added):
+                index.put_many(items)
+            for (_, bloom), values in zip(blooms, keys_added):
+                bloom.add_many(values)
+        finally:
+            target_markup.close()
+            for _, bloom in blooms:
+                bloom.close()
+            self.handles.invalidate(path)
+        return True
 
-    def restore(self, name, archive):
-        self.delete_table(name)
-        self.create_table(name)
-        with tarfile.open(archive, "r|gz") as archive:
-            archive.extractall(path=self.get_table_path(name))
+    def commit_compaction(self, name, compaction):
+        path = self.get_compaction_path(name)
+        files = sorted(os.listdir(path))
+        # once the list of files is on disk the compaction is committed,
+        # an interrupted swap is finished on the next start
+        with open(os.path.join(path, "done"), "wt") as done:
+            done.write(ujson.dumps(files))
+            done.flush()
+            os.fsync(done.fileno())
+
+        self.finish_compaction(name)
+
+    def get_compaction_codec(self, name, header):
+        codec = self.get_codec(name)
+        if header.storage_format != self.load_header(name).storage_format:
+            return make_codec(header.storage_format,
+                              self.load_columns_info(name))
+        return codec
+
+    def get_compaction_projection(self, name, header):
+        if not header.columnar:
+            return []
+        return [
+            column for column in self.load_columns_info(name)
+            if column.type in ColumnDtypes
+        ]
 
-    def read_markup_record(self, name, offset):
-        with open(self.get_markup_path(name), "rb") as markup:
-            markup.seek(int(offset * MARKUP_STRUCT_SIZE))
+    def finish_compaction(self, name):
+        path = self.get_compaction_path(name)
+        done_path = os.path.join(path, "done")
+        if not os.path.isfile(done_path):
+            shutil.rmtree(path, ignore_errors=True)
+            return
 
-            data = markup.read(MARKUP_STRUCT_SIZE)
-            if len(data) == 0:
-                return
+        with open(done_path, "rt") as done:
+            done = ujson.loads(done.read())
 
-            return MarkupStruct.unpack(data)
+        # a restore lists every file of the table, the others are removed
+        keep = None
+        if isinstance(done, dict):
+            files, keep = set(done["files"]), set(done["keep"])
+        else:
+            files = set(done)
 
-    def markup_set_inactive(self, name, offset):
-        with open(self.get_markup_path(name), "rb+") as markup:
-            markup.seek(int(offset * MARKUP_STRUCT_SIZE))
+        self.drop_table_state(name)
+        self.get_lock(name).mark_structure_changed()
 
-            data = markup.read(MARKUP_STRUCT_SIZE)
-            if len(data) == 0:
-                return
+        table_path = self.get_table_path(name)
+        if keep is None:
+            for column in self.load_indexed_columns(name):
+                for bucket in self.list_index_files(name, column):
+                    if os.path.basename(bucket) not in files:
+                        os.remove(bucket)
+        else:
+            kept = keep | files | self.get_backup_excluded(name)
+            for filename in os.listdir(table_path):
+                stale = os.path.join(table_path, filename)
+                if filename not in kept and os.path.isfile(stale):
+                    os.remove(stale)
 
-            start, length, active = MarkupStruct.unpack(data)
-            if not active:
-                return
+        for filename in files:
+            compacted = os.path.join(path, filename)
+            if os.path.isfile(compacted):
+                os.replace(compacted, os.path.join(table_path, filename))
+
+        shutil.rmtree(path)
+        self.get_wal(name).reset(self.get_checkpoint(name))
+
+    def get_wal(self, name):
+        wal = self.wals.get(name)
+        if wal is None:
+            wal = WriteAheadLog(self.get_wal_path(name))
+            if wal.size() == 0:
+                wal.reset(self.get_checkpoint(name))
+            self.wals[name] = wal
+        return wal
+
+    def close_wal(self, name):
+        wal = self.wals.pop(name, None)
+        if wal is not None:
+            wal.close()
+
+    def get_checkpoint(self, name):
+        markup = self.get_markup(name)
+        markup.refresh()
+        return {
+            "op": "checkpoint",
+            # tells a compaction whether the log started over since its
+            # snapshot
+            "id": uuid.uuid4().hex,
+            "rows": len(markup),
+            "storage": os.path.getsize(self.get_storage_path(name)),
+        }
+
+    def checkpoint(self, name):
+        with self.write_lock(name):
+            for fn in glob.glob(os.path.join(self.get_table_path(name), "*")):
+                if not os.path.isfile(fn):
+                    continue
+                fd = os.open(fn, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            checkpoint = self.get_checkpoint(name)
+            self.get_wal(name).reset(checkpoint)
+            return checkpoint
+
+    def recover(self, name):
+        if not os.path.isfile(self.get_wal_path(name)):
+            return
 
-            markup.seek(int(offset * MARKUP_STRUCT_SIZE))
-            data = MarkupStruct.pack(start, length, False)
-            markup.write(data)
+        with self.write_lock(name):
+            entries = self.get_wal(name).read()
+            checkpoint = self.get_checkpoint(name)
+
+            rows = storage_size = None
+            max_pk = None
+            for meta, payload in entries:
+                if meta["op"] == "checkpoint":
+                    rows, storage_size = meta["rows"], meta["storage"]
+                elif meta["op"] == "store":
+                    chunks = split_chunks(payload, meta["lengths"])
+                    codec = self.get_codec(name)
+                    records = [codec.decode(data) for data in chunks]
+                    self.write_records(name, meta["offset"], meta["start"],
+                                       chunks, records)
+
+                    max_pk = max([max_pk or 0] + [r["pk"] for r in records])
+                    if rows is not None:
+                        rows = max(rows, meta["offset"] + len(chunks))
+                        storage_size = max(storage_size,
+                                           meta["start"] + len(payload))
+                elif meta["op"] == "update":
+                    chunks = split_chunks(payload, meta["lengths"])
+                    codec = self.get_codec(name)
+                    records = [codec.decode(data) for data in chunks]
+                    self.write_updates(name, meta["rows"], chunks, records)
+
+                    if storage_size is not None:
+                        storage_size = max([storage_size] + [
+                            row["start"] + len(data)
+                            for row, data in zip(meta["rows"], chunks)
+                        ])
+                elif meta["op"] == "delete":
+                    deleted = []
+                    for offset in meta["offsets"]:
+                        record = self.read_record(name, offset, True)
+                        if record is not None:
+                            deleted.append((offset, record))
+                    self.get_markup(name).set_inactive(
+                        [offset for offset, _ in deleted])
+                    self.cleanup_indexes(name, deleted)
+
+            # rows that reached the table files but never made it to the
+            # log belong to writes that were not acknowledged, drop them
+            truncated = False
+            if rows is not None and checkpoint["rows"] > rows:
+                self.get_markup(name).truncate(rows)
+                truncated = True
+            if storage_size is not None and \
+                    checkpoint["storage"] > storage_size:
+                with open(self.get_storage_path(name), "r+b") as storage:
+                    storage.truncate(storage_size)
+            if truncated:
+                self.rebuild_indexes(name)
+                for column in self.load_projected_columns(name):
+                    self.get_column_file(name, column).truncate(rows)
+
+            if max_pk is not None:
+                self.get_pk_allocator(name).advance(max_pk)
+
+            if len(entries) > 1 or truncated:
+                self.checkpoint(name)
+
+    def recover_pk(self, name):
+        allocator = self.get_pk_allocator(name)
+        if allocator.read_mark() is not None:
+            return
+
+        # the pk file is gone or garbled, the mark is restored from the
+        # largest pk that ever made it to the table
+        with self.write_lock(name):
+            codec = self.get_codec(name)
+            max_pk = max((codec.decode_column(data, "pk")
+                          for _, data in self.scan_rows(name)),
+                         default=-1)
+            allocator.write_mark(max_pk + 1)
+
+    def recover_blooms(self, name):
+        missing = [
+            column for column in self.load_keys(name)
+            if not os.path.isfile(self.get_bloom_path(name, column))
+        ]
+        if not missing:
+            return
+
+        # tables written before bloom filters get theirs on the first start
+        with self.write_lock(name):
+            values = {column: [] for column in missing}
+            for _, record in self.scan_records(name):
+                for column in missing:
+                    if column in record:
+                        values[column].append(record[column])
+
+            self.drop_indexes(name)
+            for column in missing:
+                write_bloom(self.get_table_path(name), column, values[column])
+
+    def resize_bloom(self, name, key):
+        # the filter holds more values than it was sized for and lets more
+        # and more misses through, it is rebuilt from the index twice as big
+        index = self.get_index(name, key)
+        values = [
+            value for bucket in range(index.count_buckets())
+            for value in index.load_bucket(bucket)
+        ]
+        index.close()
+        write_bloom(self.get_table_path(name), key, values)
+        index.bloom = BloomFilter(self.get_bloom_path(name, key))
+        # other processes still map the old file
+        self.get_lock(name).mark_structure_changed()
+
+    def split_bucket(self, name, column):
+        def commit(level, split):
+            header = self.load_header(name)
+            header = replace(header,
+                             splits={
+                                 **header.splits, column: [level, split]
+                             })
+            self.store_header(name, header)
+            self.headers[name] = header
+
+        self.get_index(name, column).split_bucket(commit)
+        # other processes still address buckets by the old layout
+        self.get_lock(name).mark_structure_changed()
+
+    @instrument
+    def rehash(self,
+               name,
+               column=None,
+               number_of_buckets=None,
+               max_bucket_size=BUCKET_SPLIT_SIZE):
+        """Splits the buckets of hash indexes until they are at least
+        ``number_of_buckets``, or hold ``max_bucket_size`` bytes on average.
+
+        Every split takes the write lock on its own, so lookups and writes
+        go on while an index grows.
+        """
+        columns = self.load_indexed_columns(name)
+        if column is not None:
+            if column not in columns:
+                raise ValueError(f"{column} has no hash index")
+            columns = {column}
+
+        splits = {}
+        for column in sorted(columns):
+            splits[column] = 0
+            while True:
+                with self.write_lock(name):
+                    index = self.get_index(name, column)
+                    if number_of_buckets is not None:
+                        done = index.count_buckets() >= number_of_buckets
+                    else:
+                        done = not index.is_overloaded(max_bucket_size)
+                    if done:
+                        break
+                    self.split_bucket(name, column)
+                splits[column] += 1
+        return splits
+
+    def rebuild_indexes(self, name):
+        with self.write_lock(name):
+            columns = self.load_indexed_columns(name)
+            ordered = self.load_ordered_columns(name)
+            column_values = {column: [] for column in columns | ordered}
+            for offset, record in self.scan_records(name):
+                for column in column_values:
+                    if record.get(column) is not None:
+                        column_values[column].append((record[column], offset))
+
+            self.drop_indexes(name)
+            header = self.load_header(name)
+            for column in columns:
+                for bucket in self.list_index_files(name, column):
+                    os.remove(bucket)
+                write_index(self.get_table_path(name), column,
+                            header.number_of_buckets, column_values[column],
+                            *header.splits.get(column, (0, 0)))
+            for column in self.load_keys(name):
+                write_bloom(self.get_table_path(name), column,
+                            (value for value, _ in column_values[column]))
+            for column in ordered:
+                write_ordered_index(self.get_table_path(name), column,
+                                    column_values[column])
+            self.handles.invalidate(self.get_table_path(name))
+            # other processes still map the old bloom filters
+            self.get_lock(name).mark_structure_changed()
+
+    def get_table_size(self, name):
+        return sum(
+            os.path.getsize(fn)
+            for fn in glob.glob(os.path.join(self.get_table_path(name), "*"))
+            if os.path.isfile(fn))
+
+    def get_tables_list_path(self):
+        return os.path.join(self.path, "tables.txt")
+
+    def get_markup(self, name):
+        markup = self.markups.get(name)
+        if markup is None:
+            markup = MarkupView(self.get_markup_path(name),
+                                self.load_header(name).version)
+            if self.markups.setdefault(name, markup) is not markup:
+                markup.close()
+                markup = self.markups[name]
+        return markup
+
+    def drop_table_state(self, name):
+        self.close_markup(name)
+        self.close_wal(name)
+        self.drop_indexes(name)
+        self.headers.pop(name, None)
+        self.codecs.pop(name, None)
+        self.cache.drop_table(name)
+        self.handles.invalidate(self.get_table_path(name))
+        self.pks.pop(name, None)
+
+    def close_markup(self, name):
+        markup = self.markups.pop(name, None)
+        if markup is not None:
+            markup.close()
+
+    def list_markup_records(self, name):
+        markup = self.get_markup(name)
+        markup.refresh()
+        for offset, record in enumerate(markup.entries.tolist()):
+            yield offset, *record
+
+    def to_csv(self, name, order_by=None, descending=False):
+        return self.export(name,
+                           EXPORT_FORMAT_CSV,
+                           order_by=order_by,
+                           descending=descending)
+
+    @instrument
+    def export(self,
+               name,
+               export_format=EXPORT_FORMAT_CSV,
+               columns=None,
+               predicate=None,
+               order_by=None,
+               descending=False):
+        infos = self.load_columns_info(name)
+        if columns:
+            by_name = {column.name: column for column in infos}
+            missing = [column for column in columns if column not in by_name]
+            if missing:
+                raise ValueError(f"unknown columns {', '.join(missing)}")
+            infos = [by_name[column] for column in columns]
+        columns = [column.name for column in infos]
+
+        if export_format not in ExportMimetypes:
+            raise ValueError(f"unknown export format {export_format}")
+        if order_by is not None and \
+                order_by not in self.load_ordered_columns(name):
+            raise ValueError(f"{order_by} has no ordered index")
+
+        # json rows are already what ndjson wants, they are copied as is
+        # without the padding of rows updated in place
+        if export_format == EXPORT_FORMAT_NDJSON and order_by is None and \
+                len(columns) == len(self.load_columns_info(name)) and \
+                self.load_header(name).storage_format == STORAGE_FORMAT_JSON:
+            codec = self.get_codec(name)
+            return export_ndjson(
+                data.rstrip(b" ") for _, data in self.scan_rows(name)
+                if predicate is None or predicate(codec, data))
+
+        if order_by is not None:
+            rows = self.iter_ordered(name, order_by, predicate, descending)
+        else:
+            rows = self.scan_records(name, predicate=predicate)
+        records = (record for _, record in rows)
+
+        if export_format == EXPORT_FORMAT_CSV:
+            return export_csv(records, columns)
+        if export_format == EXPORT_FORMAT_NDJSON:
+            return export_ndjson(
+                ujson.dumps(project(record, columns)).encode()
+                for record in records)
+        return export_columnar(records, infos)
+
+    def backup(self,
+               name,
+               output_file,
+               incremental=False,
+               compression=BACKUP_COMPRESSION):
+        with open(output_file, "wb") as output:
+            for data in self.backup_stream(name, incremental, compression):
+                output.write(data)
+
+    @instrument
+    def backup_stream(self,
+                      name,
+                      incremental=False,
+                      compression=BACKUP_COMPRESSION):
+        # the compaction lock keeps the files from being swapped until the
+        # client downloaded the backup, the table lock is only held to take
+        # snapshots of what the storage stream can't capture
+        with self.get_compaction_lock(name).read():
+            manifest = {}
+            yield from compress_stream(
+                self.iter_backup(name, incremental, manifest), compression)
+            self.store_backup_manifest(name, manifest)
+
+    def iter_backup(self, name, incremental, manifest):
+        """Yields the tar stream of a backup of the table.
+
+        The storage file is read as it is written, up to its size when the
+        backup started. Blocks of it updated in place meanwhile are found
+        in the log and shipped again with the rows appended since, copied
+        aside under the read lock together with the other table files.
+        """
+        storage_path = self.get_storage_path(name)
+        storage_name = os.path.basename(storage_path)
+        wal = self.get_wal(name)
+        with self.read_lock(name):
+            base = self.load_backup_manifest(name) if incremental else None
+            storage = open(storage_path, "rb")
+            size = os.fstat(storage.fileno()).st_size
+            checkpoint = wal.read_checkpoint()
+            position = wal.size()
+
+        snapshot_path = os.path.join(
+            self.path, f".{name}.backup.{os.getpid()}.{uuid.uuid4().hex}")
+        try:
+            with storage:
+                yield from start_backup(base, manifest)
+                yield from iter_backup_file(storage, storage_name, size, base,
+                                            manifest)
+
+                os.makedirs(snapshot_path)
+                with self.read_lock(name):
+                    blocks, filenames = self.snapshot_backup(
+                        name, storage, size, checkpoint, position, manifest,
+                        snapshot_path)
+
+            with open(os.path.join(snapshot_path, storage_name),
+                      "rb") as changed:
+                yield from iter_backup_blocks(
+                    changed, storage_name, blocks,
+                    os.fstat(changed.fileno()).st_size, base, manifest)
+            for filename in filenames:
+                with open(os.path.join(snapshot_path, filename),
+                          "rb") as source:
+                    yield from iter_backup_file(
+                        source, filename, os.fstat(source.fileno()).st_size,
+                        base, manifest)
+            yield from finish_backup(manifest)
+        finally:
+            shutil.rmtree(snapshot_path, ignore_errors=True)
+
+    def snapshot_backup(self, name, storage, size, checkpoint, position,
+                        manifest, snapshot_path):
+        # callers hold the read lock
+        block_size = manifest["block_size"]
+        storage_name = os.path.basename(storage.name)
+        wal = self.get_wal(name)
+        current = wal.read_checkpoint()
+        if checkpoint is not None and current is not None and \
+                current.get("id") == checkpoint.get("id"):
+            blocks = set()
+            for meta, _ in wal.read(position):
+                if meta["op"] != "update":
+                    continue
+                for row, length in zip(meta["rows"], meta["lengths"]):
+                    if row["start"] < size:
+                        blocks.update(
+                            range(row["start"] // block_size,
+                                  (row["start"] + length - 1) // block_size +
+                                  1))
+        else:
+            # the log started over, the blocks are compared with what was
+            # shipped instead
+            hashes = manifest["files"][storage_name]["blocks"]
+            blocks = {
+                block
+                for block, data in read_blocks(storage, size, block_size)
+                if hash_block(data) != hashes[block]
+            }
+
+        end = os.fstat(storage.fileno()).st_size
+        if end != size:
+            blocks.update(range(size // block_size, -(-end // block_size)))
+        blocks = sorted(blocks)
+
+        # only the blocks shipped again are copied, the rest is a hole
+        with open(os.path.join(snapshot_path, storage_name), "wb") as copy:
+            for block, data in read_blocks(storage, end, block_size, blocks):
+                copy.seek(block * block_size)
+                copy.write(data)
+            copy.truncate(end)
+
+        path = self.get_table_path(name)
+        excluded = self.get_backup_excluded(name) | {storage_name}
+        filenames = sorted(
+            filename for filename in os.listdir(path)
+            if filename not in excluded
+            and os.path.isfile(os.path.join(path, filename)))
+        for filename in filenames:
+            shutil.copyfile(os.path.join(path, filename),
+                            os.path.join(snapshot_path, filename))
+        return blocks, filenames
+
+    def remove_stale_backups(self):
+        # snapshots of backups whose process died while streaming them
+        for path in glob.glob(os.path.join(self.path, ".*.backup.*.*")):
+            pid = os.path.basename(path).rsplit(".", 2)[-2]
+            if not pid.isdigit() or not os.path.isdir(path):
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                shutil.rmtree(path, ignore_errors=True)
+            except PermissionError:
+                pass
+
+    @instrument
+    def restore(self, name, archive):
+        if isinstance(archive, (str, os.PathLike)):
+            with open(archive, "rb") as stream:
+                return self.restore(name, stream)
+
+        table_path = self.get_table_path(name)
+        stage_path = os.path.join(self.path, f".{name}.restore")
+        shutil.rmtree(stage_path, ignore_errors=True)
+        os.makedirs(stage_path)
+        try:
+            # the archive is unpacked without holding the lock, changes made
+            # to the table meanwhile fail the check against the manifest
+            manifest, staged = read_backup(archive, stage_path, table_path,
+                                           self.load_backup_manifest(name),
+                                           self.get_backup_excluded(name))
+
+            with self.get_compaction_lock(name).write(), \
+                    self.write_lock(name):
+                if manifest is not None:
+                    verify_backup(manifest, stage_path, table_path)
+                if name not in self.list_tables():
+                    self.register_table(name)
+
+                # the swap is done the way compactions are, so a restore
+                # interrupted after this point is finished on the next start
+                os.makedirs(table_path, exist_ok=True)
+                compaction_path = self.get_compaction_path(name)
+                shutil.rmtree(compaction_path, ignore_errors=True)
+                os.replace(stage_path, compaction_path)
+                keep = staged if manifest is None else list(manifest["files"])
+                with open(os.path.join(compaction_path, "done"), "wt") as done:
+                    done.write(ujson.dumps({"files": staged, "keep": keep}))
+                    done.flush()
+                    os.fsync(done.fileno())
+
+                self.finish_compaction(name)
+                self.invalidate_table(name, True)
+                self.recover_blooms(name)
+                if manifest is not None:
+                    self.store_backup_manifest(name, manifest)
+        finally:
+            shutil.rmtree(stage_path, ignore_errors=True)
+
+    def load_backup_manifest(self, name):
+        path = self.get_backup_manifest_path(name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rt") as manifest:
+            return ujson.loads(manifest.read())
+
+    def store_backup_manifest(self, name, manifest):
+        path = self.get_backup_manifest_path(name)
+        staged = f"{path}.{manifest['id']}"
+        with open(staged, "wt") as output:
+            output.write(ujson.dumps(manifest))
+        os.replace(staged, path)
+
+    def get_backup_excluded(self, name):
+        # the table files are complete under the lock, the log isn't needed
+        return {
+            os.path.basename(self.get_wal_path(name)),
+            os.path.basename(self.get_backup_manifest_path(name)),
+        }
+
+    def read_markup_record(self, name, offset):
+        return self.get_markup(name).read(offset)
 
     def store_columns_info(self, name, columns):
         path = os.path.join(self.get_table_path(name), "info.txt")
@@ -231,179 +2013,291 @@ class DB:
 
         return columns
 
+    def store_header(self, name, header, path=None):
+        path = path or self.get_table_path(name)
+        header_path = os.path.join(path,
+                                   os.path.basename(self.get_header_path(name)))
+        with open(f"{header_path}.tmp", "wt") as header_file:
+            header_file.write(ujson.dumps(asdict(header)))
+        os.replace(f"{header_path}.tmp", header_path)
+
+    def load_header(self, name):
+        header = self.headers.get(name)
+        if header is not None:
+            return header
+
+        header = TableHeader()
+        if os.path.isfile(self.get_header_path(name)):
+            with open(self.get_header_path(name), "rt") as header_file:
+                header = TableHeader(**ujson.loads(header_file.read()))
+
+        self.headers[name] = header
+        return header
+
     @cache
     def load_keys(self, name):
         columns = self.load_columns_info(name)
         return set(column.name for column in columns if column.is_key)
 
     @cache
-    def get_table_path(self, name):
-        return os.path.join(self.path, name)
-
-    def get_storage_path(self, name: str):
-        return os.path.join(self.get_table_path(name), "storage.json")
+    def load_indexed_columns(self, name):
+        columns = self.load_columns_info(name)
+        return set(column.name for column in columns
+                   if column.is_key or column.indexed)
 
-    def get_markup_path(self, name: str):
-        return os.path.join(self.get_table_path(name), "markup.bin")
+    @cache
+    def load_ordered_columns(self, name):
+        columns = self.load_columns_info(name)
+        return set(column.name for column in columns if column.ordered)
 
-    def get_pk_path(self, name):
-        return os.path.join(self.get_table_path(name), "pk.txt")
+    @instrument
+    def create_index(self, name, column, ordered=False):
+        with self.write_lock(name):
+            columns = self.load_columns_info(name)
+            if column not in (info.name for info in columns):
+                raise KeyError(column)
 
-    def do_store_record(self, name: str, values: Dict[str, Any]):
-        data = ujson.dumps(values)
-        with open(self.get_storage_path(name), "at") as storage:
-            start = storage.tell()
-            storage.write(data)
-            length = len(data)
+            if ordered:
+                if column in self.load_ordered_columns(name):
+                    return
 
-        return start, length
+                self.ordered_indexes.pop((name, column), None)
+                write_ordered_index(
+                    self.get_table_path(name), column,
+                    ((record[column], offset)
+                     for offset, record in self.scan_records(name)
+                     if record.get(column) is not None))
+                flag = {"ordered": True}
+            else:
+                if column in self.load_indexed_columns(name):
+                    return
 
-    def get_bucket_name(self, name, key, value):
-        bucket = hash_to_bucket(value)
-        return os.path.join(self.get_table_path(name), f"{key}_{bucket}.json")
+                self.indexes.pop((name, column), None)
+                for bucket in self.list_index_files(name, column):
+                    os.remove(bucket)
+                self.handles.invalidate(self.get_table_path(name))
+
+                header = self.load_header(name)
+                write_index(self.get_table_path(name), column,
+                            header.number_of_buckets,
+                            ((record[column], offset)
+                             for offset, record in self.scan_records(name)
+                             if column in record),
+                            *header.splits.get(column, (0, 0)))
+                flag = {"indexed": True}
+
+            self.store_columns_info(name, [
+                replace(info, **flag) if info.name == column else info
+                for info in columns
+            ])
+            self.get_lock(name).mark_structure_changed()
+            self.load_columns_info.cache_clear()
+            self.load_keys.cache_clear()
+            self.load_indexed_columns.cache_clear()
+            self.load_ordered_columns.cache_clear()
+
+    def load_projected_columns(self, name):
+        if not self.load_header(name).columnar:
+            return []
+        return [
+            column for column in self.load_columns_info(name)
+            if column.type in ColumnDtypes
+        ]
 
-    def is_key_exist(self, name, key, value):
-        path = self.get_bucket_name(name, key, value)
-        if not os.path.isfile(path):
-            return False
-        with open(path, "rt") as bucket:
-            for line in bucket:
-                record = ujson.loads(line)
-                if record[key] == value:
-                    # record with such key already exists
-                    return True
-
-        return False
-
-    def store_key(self, name, key, value, offset):
-        path = self.get_bucket_name(name, key, value)
-        with open(path, "at") as bucket:
-            record = {
-                key: value,
-                "offset": offset,
-            }
+    def get_column_file(self, name, column):
+        return ColumnFile(self.get_column_path(name, column.name),
+                          column.type, self.handles)
 
-            bucket.write(f"{ujson.dumps(record)}\n")
+    def list_index_files(self, name, column):
+        table_path = self.get_table_path(name)
+        files = glob.glob(os.path.join(table_path, f"{column}_*.idx"))
+        files += glob.glob(os.path.join(table_path, f"{column}_*.json"))
+        return files
 
-    def cleanup_bucket(self, name, key, value):
-        bucket = hash_to_bucket(value)
-        bucket_file = self.get_bucket_name(name, key, value)
+    @cache
+    def get_table_path(self, name):
+        return os.path.join(self.path, name)
 
-        bucket_content = []
-        with open(bucket_file, "rt") as bucket:
-            bucket_content = [ujson.loads(line) for line in bucket]
+    def get_storage_path(self, name: str):
+        return os.path.join(self.get_table_path(name), "storage.json")
 
-        bucket_content = [
-            record for record in bucket_content if record[key] != value
-        ]
+    def get_markup_path(self, name: str):
+        return os.path.join(self.get_table_path(name), "markup.bin")
 
-        with open(bucket_file, "wt") as bucket_file:
-            for line in bucket_content:
-                bucket_file.write(f"{ujson.dumps(line)}\n")
+    def get_header_path(self, name):
+        return os.path.join(self.get_table_path(name), "header.json")
 
-    def delete_record_by_key(self, name, key, value):
-        bucket = hash_to_bucket(value)
-        bucket_file = self.get_bucket_name(name, key, value)
+    def get_wal_path(self, name):
+        return os.path.join(self.get_table_path(name), "wal.log")
 
-        if not os.path.isfile(bucket_file):
-            return None
+    def get_compaction_path(self, name):
+        return os.path.join(self.get_table_path(name), "compact")
 
-        record = self.get_record_by_key(name, key, value)
+    def get_bloom_path(self, name, key):
+        return os.path.join(self.get_table_path(name), f"{key}.bloom")
 
-        if not record:
-            return
+    def get_backup_manifest_path(self, name):
+        return os.path.join(self.get_table_path(name), "last_backup.json")
 
-        with open(bucket_file, "rt") as bucket:
-            for line in bucket:
-                bucket_record = ujson.loads(line)
+    def get_pk_path(self, name):
+        return os.path.join(self.get_table_path(name), "pk.txt")
 
-                if bucket_record[key] == value:
-                    offset = bucket_record["offset"]
-                    self.markup_set_inactive(name, offset)
-                    break
+    def get_column_path(self, name, column):
+        return os.path.join(self.get_table_path(name), f"{column}.col")
+
+    def get_index(self, name, key):
+        index = self.indexes.get((name, key))
+        if index is None:
+            index_class = HashIndex
+            if key not in self.load_keys(name):
+                index_class = MultiHashIndex
+
+            bloom = None
+            if key in self.load_keys(name) and \
+                    os.path.isfile(self.get_bloom_path(name, key)):
+                bloom = BloomFilter(self.get_bloom_path(name, key))
+
+            header = self.load_header(name)
+            index = index_class(self.get_table_path(name), key,
+                                header.number_of_buckets, self.handles, bloom,
+                                *header.splits.get(key, (0, 0)))
+            if self.indexes.setdefault((name, key), index) is not index:
+                index.close()
+                index = self.indexes[(name, key)]
+        return index
+
+    def get_ordered_index(self, name, key):
+        index = self.ordered_indexes.get((name, key))
+        if index is None:
+            index = OrderedIndex(self.get_table_path(name), key,
+                                 self.handles)
+            index = self.ordered_indexes.setdefault((name, key), index)
+        return index
+
+    def drop_indexes(self, name):
+        for table, key in list(self.indexes):
+            if table == name:
+                self.indexes.pop((table, key)).close()
+        for table, key in list(self.ordered_indexes):
+            if table == name:
+                del self.ordered_indexes[(table, key)]
 
-        keys = self.load_keys(name)
-        for key in keys:
-            self.cleanup_bucket(name, key, record[key])
+    def is_key_exist(self, name, key, value):
+        return value in self.get_index(name, key)
+
+    def cleanup_indexes(self, name, rows):
+        for column in self.load_indexed_columns(name):
+            self.get_index(name, column).remove_many(
+                (record[column], offset) for offset, record in rows
+                if column in record)
+        for column in self.load_ordered_columns(name):
+            self.get_ordered_index(name, column).remove_many(
+                (record[column], offset) for offset, record in rows
+                if record.get(column) is not None)
 
-    def delete_record_by_non_key(self, name, key, value):
-        keys = self.load_keys(name)
-        with open(self.get_storage_path(name), "rb") as storage:
-            for markup in self.list_markup_records(name):
-                offset, start, length, active = markup
-                if not active:
-                    continue
+    def delete_record_by_key(self, name, key, value):
+        found = self.find_record_by_key(name, key, value)
+        if found is None:
+            return 0
 
-                storage.seek(start)
-                data = storage.read(length)
-                record = ujson.loads(data)
+        return self.delete_records_at(name, [found])
 
-                if record[key] != value:
-                    continue
+    def delete_record_by_non_key(self, name, key, value):
+        return self.delete_records_at(
+            name, list(self.scan_matching(name, key, value)))
 
-                self.markup_set_inactive(name, offset)
+    def delete_record_by_index(self, name, key, value):
+        rows = []
+        for offset in self.get_index(name, key).get(value):
+            record = self.read_record(name, offset)
+            if record is not None:
+                rows.append((offset, record))
 
-                if record[key] == value:
-                    for _key in keys:
-                        self.cleanup_bucket(name, _key, record[_key])
+        return self.delete_records_at(name, rows)
 
+    @instrument
     def get_record_by_key(self, name, key, value):
-        bucket = hash_to_bucket(value)
-        bucket = self.get_bucket_name(name, key, value)
+        found = self.find_record_by_key(name, key, value)
+        return None if found is None else found[1]
+
+    def find_record_by_key(self, name, key, value):
+        with self.read_lock(name):
+            found = self.cache.get(name, key, value)
+            if found is not None:
+                return found
+
+            offset = self.get_index(name, key).get(value)
+            if offset is None:
+                return None
+
+            record = self.read_record(name, offset)
+            if record is None:
+                return None
+
+            self.cache.put(name, offset, record, self.load_keys(name))
+            return offset, record
+
+    def get_record_by_index(self, name, key, value):
+        with self.read_lock(name):
+            records = [
+                self.read_record(name, offset)
+                for offset in self.get_index(name, key).get(value)
+            ]
+
+        for record in records:
+            if record is not None:
+                yield record
 
-        if not os.path.isfile(bucket):
-            return None
+    def read_record(self, name, offset, inactive=False):
+        with self.read_lock(name):
+            markup = self.read_markup_record(name, offset)
+            if markup is None:
+                return None
 
-        with open(bucket, "rt") as bucket:
-            for line in bucket:
-                bucket_record = ujson.loads(line)
-                if bucket_record[key] == value:
-                    offset = bucket_record["offset"]
-                    start, length, active = self.read_markup_record(
-                        name, offset)
-                    if not active:
-                        continue
-                    return self.read_storage(name, start, length)
+            start, length, active = markup
+            if not active and not inactive:
+                return None
+            return self.read_storage(name, start, length)
 
     def get_record_by_non_key(self, name, key, value):
-        with open(self.get_storage_path(name), "rb") as storage:
-            for markup in self.list_markup_records(name):
-                _, start, length, active = markup
-
-                if not active:
-                    continue
-
-                storage.seek(start)
-                data = storage.read(length)
-                record = ujson.loads(data)
-
-                if record[key] == value:
-                    yield record
+        for _, record in self.scan_matching(name, key, value):
+            yield record
 
     def read_storage(self, name, start, length):
-        with open(self.get_storage_path(name), "rt") as storage:
-            storage.seek(start)
-            data = storage.read(length)
-            record = ujson.loads(data)
-
-            return record
+        with self.handles.open(self.get_storage_path(name)) as fd:
+            data = os.pread(fd, length, start)
+        METRICS.inc("sdb_bytes_read_total",
+                    len(data),
+                    table=name,
+                    file="storage")
+
+        return self.get_codec(name).decode(data)
+
+    def get_codec(self, name):
+        codec = self.codecs.get(name)
+        if codec is None:
+            codec = make_codec(self.load_header(name).storage_format,
+                               self.load_columns_info(name))
+            self.codecs[name] = codec
+        return codec
 
     def get_pk(self, name):
-        pk_file_path = self.get_pk_path(name)
-        if not os.path.isfile(pk_file_path):
-            with open(pk_file_path, "wt") as pk_file:
-                pk_file.write(f"0")
-
-        with open(pk_file_path, "rt") as pk_file:
-            pk = int(pk_file.read().strip())
-
-        _pk = pk
-        pk += 1
-
-        with open(pk_file_path, "wt") as pk_file:
-            pk_file.write(f"{pk}")
-
-        return _pk
+        return self.reserve_pks(name, 1).start
+
+    def reserve_pks(self, name, count):
+        return self.get_pk_allocator(name).allocate(count)
+
+    def get_pk_allocator(self, name):
+        allocator = self.pks.get(name)
+        if allocator is None:
+            allocator = PkAllocator(self.get_pk_path(name), self.handles)
+            allocator = self.pks.setdefault(name, allocator)
+        return allocator
+
+    def cast_value(self, name, column, value):
+        if self.get_column_info(name, column) is None:
+            raise KeyError(column)
+        return self.cast_key(name, column, value)
 
     def cast_key(self, name, key, value):
         map_types = {
@@ -0,0 +1,172 @@
+import csv
+import io
+import struct
+from itertools import islice
+
+import numpy as np
+import ujson
+
+from .columns import ColumnDtypes, encode_column
+
+EXPORT_FORMAT_CSV = "csv"
+EXPORT_FORMAT_NDJSON = "ndjson"
+EXPORT_FORMAT_COLUMNAR = "columnar"
+
+ExportMimetypes = {
+    EXPORT_FORMAT_CSV: "text/csv",
+    EXPORT_FORMAT_NDJSON: "application/x-ndjson",
+    EXPORT_FORMAT_COLUMNAR: "application/octet-stream",
+}
+
+# output is handed out in chunks of about this size, small writes make the
+# server flush all the time
+EXPORT_CHUNK_SIZE = int(2**20)
+
+# records are converted in groups of this many, a group of a columnar export
+# is encoded column by column
+EXPORT_GROUP_SIZE = int(2**16)
+
+# a columnar export is the magic followed by frames: the length of a json
+# description, the description and the buffers it lists. The first frame
+# holds the schema, every other one a group of rows, a zero length ends it
+COLUMNAR_MAGIC = b"SDBCOL1\n"
+FrameStruct = struct.Struct("<I")
+
+# str columns are stored as the lengths of the utf-8 values, -1 for missing
+# ones, followed by the values themselves
+StrLengthDtype = np.dtype("<i4")
+
+
+def export_csv(records, columns):
+    records = iter(records)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    while True:
+        rows = [[record.get(column) for column in columns]
+                for record in islice(records, EXPORT_GROUP_SIZE)]
+        if not rows:
+            break
+
+        writer.writerows(rows)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue().encode()
+
+
+def export_ndjson(rows):
+    """Joins rows of json bytes into lines."""
+    lines = []
+    size = 0
+    for data in rows:
+        lines.append(data)
+        size += len(data) + 1
+        if size >= EXPORT_CHUNK_SIZE:
+            lines.append(b"")
+            yield b"\n".join(lines)
+            lines, size = [], 0
+
+    if lines:
+        lines.append(b"")
+        yield b"\n".join(lines)
+
+
+def encode_frame(description, buffers=()):
+    description = dict(description, buffers=[len(data) for data in buffers])
+    data = ujson.dumps(description).encode()
+    return b"".join([FrameStruct.pack(len(data)), data, *buffers])
+
+
+def encode_str_column(values):
+    values = [None if value is None else str(value).encode()
+              for value in values]
+    lengths = np.array([-1 if value is None else len(value)
+                        for value in values],
+                       dtype=StrLengthDtype)
+    return [lengths.tobytes(), b"".join(value or b"" for value in values)]
+
+
+def export_columnar(records, columns):
+    """Encodes records column by column, ``columns`` are ColumnInfo."""
+    records = iter(records)
+    yield COLUMNAR_MAGIC + encode_frame({
+        "columns": [{
+            "name": column.name,
+            "type": column.type
+        } for column in columns]
+    })
+
+    while True:
+        group = list(islice(records, EXPORT_GROUP_SIZE))
+        if not group:
+            break
+
+        buffers = []
+        for column in columns:
+            values = [record.get(column.name) for record in group]
+            if column.type in ColumnDtypes:
+                buffers.append(encode_column(values, column.type).tobytes())
+            else:
+                buffers += encode_str_column(values)
+        yield encode_frame({"rows": len(group)}, buffers)
+
+    yield FrameStruct.pack(0)
+
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        raise ValueError("columnar export is truncated")
+    return data
+
+
+def read_frame(stream):
+    size, = FrameStruct.unpack(read_exact(stream, FrameStruct.size))
+    if size == 0:
+        return None, []
+    description = ujson.loads(read_exact(stream, size))
+    buffers = [read_exact(stream, length)
+               for length in description["buffers"]]
+    return description, buffers
+
+
+def read_columnar(stream):
+    """Yields every group of rows of a columnar export as a dict of columns.
+
+    int and float columns come as numpy arrays with their missing values,
+    str columns as lists.
+    """
+    if read_exact(stream, len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError("not a columnar export")
+    schema, _ = read_frame(stream)
+    columns = schema["columns"]
+
+    while True:
+        description, buffers = read_frame(stream)
+        if description is None:
+            return
+
+        group = {}
+        buffers = iter(buffers)
+        for column in columns:
+            if column["type"] in ColumnDtypes:
+                group[column["name"]] = np.frombuffer(
+                    next(buffers), dtype=ColumnDtypes[column["type"]])
+                continue
+
+            lengths = np.frombuffer(next(buffers), dtype=StrLengthDtype)
+            data = next(buffers)
+            values = []
+            position = 0
+            for length in lengths.tolist():
+                if length < 0:
+                    values.append(None)
+                    continue
+                values.append(data[position:position + length].decode())
+                position += length
+            group[column["name"]] = values
+        yield group
+
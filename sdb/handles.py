@@ -0,0 +1,72 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .metrics import METRICS
+
+READ_FLAGS = os.O_RDONLY
+WRITE_FLAGS = os.O_WRONLY | os.O_CREAT
+APPEND_FLAGS = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+UPDATE_FLAGS = os.O_RDWR | os.O_CREAT
+
+
+class HandlePool:
+    """Descriptors of table files kept open between calls.
+
+    Handles are raw descriptors used with pread/pwrite, so threads can share
+    them. Only idle handles are closed, the least recently used first, once
+    more than ``max_open`` are open. Handles of files replaced on disk have
+    to be invalidated, they keep pointing to the old file.
+    """
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.handles = OrderedDict()
+        self.mutex = threading.Lock()
+
+    @contextmanager
+    def open(self, path, flags=READ_FLAGS):
+        key = (path, flags)
+        with self.mutex:
+            handle = self.handles.get(key)
+            if handle is None:
+                handle = [os.open(path, flags, 0o644), 0]
+                self.handles[key] = handle
+                METRICS.inc("sdb_file_opens_total",
+                            table=os.path.basename(os.path.dirname(path)))
+            else:
+                self.handles.move_to_end(key)
+            handle[1] += 1
+            self.evict()
+
+        try:
+            yield handle[0]
+        finally:
+            with self.mutex:
+                handle[1] -= 1
+                # handles dropped while in use are closed by their last user
+                if handle[1] == 0 and self.handles.get(key) is not handle:
+                    os.close(handle[0])
+
+    def evict(self):
+        if len(self.handles) <= self.max_open:
+            return
+
+        for key, handle in list(self.handles.items()):
+            if len(self.handles) <= self.max_open:
+                return
+            if handle[1] == 0:
+                del self.handles[key]
+                os.close(handle[0])
+
+    def invalidate(self, path):
+        prefix = os.path.join(path, "")
+        with self.mutex:
+            for key, handle in list(self.handles.items()):
+                if key[0] == path or key[0].startswith(prefix):
+                    del self.handles[key]
+                    if handle[1] == 0:
+                        os.close(handle[0])
+
+    def __len__(self):
+        return len(self.handles)
@@ -0,0 +1,341 @@
+import os
+import struct
+from collections import defaultdict
+
+import mmh3
+import ujson
+
+from .handles import APPEND_FLAGS
+from .metrics import METRICS
+
+# every bucket file is an append-only log of (op, offset, value) entries
+IndexEntryStruct = struct.Struct("<BqI")
+INDEX_ENTRY_STRUCT_SIZE = IndexEntryStruct.size
+
+OP_REMOVE = 0
+OP_PUT = 1
+
+# the next bucket of an index is split, linear hashing style, once its
+# bucket files hold this many bytes on average
+BUCKET_SPLIT_SIZE = int(2**16)
+
+
+def hash_to_bucket(value, number_of_buckets, level=0, split=0):
+    hashed = mmh3.hash128(str(value), seed=42)
+    # every split doubles one bucket, the ones before the split pointer are
+    # addressed as if the whole index had twice as many buckets already
+    bucket = hashed % (number_of_buckets << level)
+    if bucket < split:
+        bucket = hashed % (number_of_buckets << (level + 1))
+    return bucket
+
+
+def encode_index_entry(op, value, offset):
+    data = ujson.dumps(value).encode()
+    return IndexEntryStruct.pack(op, offset, len(data)) + data
+
+
+def decode_index_entries(data):
+    position = 0
+    while position < len(data):
+        op, offset, length = IndexEntryStruct.unpack_from(data, position)
+        position += INDEX_ENTRY_STRUCT_SIZE
+        value = ujson.loads(data[position:position + length])
+        position += length
+        yield op, value, offset
+
+
+class HashIndex:
+    def __init__(self,
+                 path,
+                 key,
+                 number_of_buckets,
+                 handles,
+                 bloom=None,
+                 level=0,
+                 split=0):
+        self.path = path
+        self.key = key
+        self.number_of_buckets = number_of_buckets
+        self.level = level
+        self.split = split
+        self.handles = handles
+        # values the bloom filter rules out are not looked up in buckets
+        self.bloom = bloom
+        self.buckets = {}
+        # bytes of every bucket file applied to memory, and the generation
+        # they were last checked against the file in
+        self.sizes = {}
+        self.checked = {}
+        self.generation = 0
+        # bytes of all bucket files, counted once and kept up to date with
+        # the appends of this process
+        self.total_size = None
+
+    def get(self, value):
+        bucket = self.get_bucket(value)
+        # buckets already in memory answer exactly and cheaper than the filter
+        if self.bloom is None or self.is_loaded(bucket):
+            return self.load_bucket(bucket).get(value)
+        if value not in self.bloom:
+            return None
+
+        found = self.load_bucket(bucket).get(value)
+        if found is None:
+            self.bloom.false_positives += 1
+        return found
+
+    def __contains__(self, value):
+        return self.get(value) is not None
+
+    def put(self, value, offset):
+        self.put_many([(value, offset)])
+
+    def put_many(self, items):
+        entries = defaultdict(list)
+        values = []
+        for value, offset in items:
+            bucket = self.get_bucket(value)
+            # with a bloom filter in front a bucket is only read once it is
+            # looked up, puts just go to its file until then
+            if self.bloom is None or bucket in self.buckets:
+                self.apply(self.load_bucket(bucket), OP_PUT, value, offset)
+            entries[bucket].append(encode_index_entry(OP_PUT, value, offset))
+            values.append(value)
+
+        if self.bloom is not None:
+            self.bloom.add_many(values)
+        for bucket, data in entries.items():
+            self.append_entries(bucket, b"".join(data))
+
+    def remove(self, value, offset):
+        self.remove_many([(value, offset)])
+
+    def remove_many(self, items):
+        entries = defaultdict(list)
+        for value, offset in items:
+            bucket = self.get_bucket(value)
+            if self.apply(self.load_bucket(bucket), OP_REMOVE, value, offset):
+                entries[bucket].append(
+                    encode_index_entry(OP_REMOVE, value, offset))
+
+        for bucket, data in entries.items():
+            self.append_entries(bucket, b"".join(data))
+
+    def append_entries(self, bucket, data):
+        with self.handles.open(self.get_bucket_path(bucket),
+                               APPEND_FLAGS) as fd:
+            os.write(fd, data)
+        METRICS.inc("sdb_bytes_written_total",
+                    len(data),
+                    table=os.path.basename(self.path),
+                    file="index")
+        if bucket in self.sizes:
+            self.sizes[bucket] += len(data)
+        if self.total_size is not None:
+            self.total_size += len(data)
+
+    def invalidate(self):
+        self.generation += 1
+
+    def close(self):
+        if self.bloom is not None:
+            self.bloom.close()
+
+    def apply(self, content, op, value, offset):
+        if op == OP_PUT:
+            content[value] = offset
+            return True
+
+        if content.get(value) != offset:
+            return False
+
+        del content[value]
+        return True
+
+    def get_bucket(self, value):
+        return hash_to_bucket(value, self.number_of_buckets, self.level,
+                              self.split)
+
+    def count_buckets(self):
+        return (self.number_of_buckets << self.level) + self.split
+
+    def get_bucket_sizes(self):
+        sizes = []
+        for bucket in range(self.count_buckets()):
+            path = self.get_bucket_path(bucket)
+            sizes.append(os.path.getsize(path) if os.path.isfile(path) else 0)
+        return sizes
+
+    def is_overloaded(self, max_size=BUCKET_SPLIT_SIZE):
+        if self.total_size is None:
+            self.total_size = sum(self.get_bucket_sizes())
+        return self.total_size > max_size * self.count_buckets()
+
+    def split_bucket(self, commit):
+        """Moves the entries of the bucket at the split pointer that belong
+        to its new sibling at the end of the index.
+
+        The sibling is written first and ``commit`` is called with the new
+        level and split pointer to store them, only then is the split bucket
+        rewritten. A crash in between leaves the moved entries behind in it,
+        where lookups never look for them.
+        """
+        bucket = self.split
+        sibling = bucket + (self.number_of_buckets << self.level)
+        staying, moving = [], []
+        for value, offset in self.iter_entries(self.load_bucket(bucket)):
+            entry = encode_index_entry(OP_PUT, value, offset)
+            if hash_to_bucket(value, self.number_of_buckets,
+                              self.level + 1) == sibling:
+                moving.append(entry)
+            else:
+                staying.append(entry)
+
+        write_bucket(self.get_bucket_path(sibling), b"".join(moving))
+        # once every bucket of the level is split the next level starts over
+        # from the first bucket
+        if bucket + 1 == self.number_of_buckets << self.level:
+            level, split = self.level + 1, 0
+        else:
+            level, split = self.level, bucket + 1
+        commit(level, split)
+        write_bucket(self.get_bucket_path(bucket), b"".join(staying))
+
+        self.level, self.split = level, split
+        for path, changed in ((self.get_bucket_path(bucket), bucket),
+                              (self.get_bucket_path(sibling), sibling)):
+            # pooled handles still point to the replaced files
+            self.handles.invalidate(path)
+            self.buckets.pop(changed, None)
+            self.sizes.pop(changed, None)
+            self.checked.pop(changed, None)
+        self.total_size = None
+
+    def iter_entries(self, content):
+        return content.items()
+
+    def get_bucket_path(self, bucket):
+        return os.path.join(self.path, f"{self.key}_{bucket}.idx")
+
+    def get_legacy_bucket_path(self, bucket):
+        return os.path.join(self.path, f"{self.key}_{bucket}.json")
+
+    def is_loaded(self, bucket):
+        return bucket in self.buckets and \
+            self.checked[bucket] == self.generation
+
+    def load_bucket(self, bucket):
+        content = self.buckets.get(bucket)
+        if content is not None and self.checked[bucket] == self.generation:
+            return content
+
+        path = self.get_bucket_path(bucket)
+        legacy_path = self.get_legacy_bucket_path(bucket)
+        if not os.path.isfile(path) and os.path.isfile(legacy_path):
+            self.convert_legacy_bucket(bucket)
+
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        known = self.sizes.get(bucket, 0)
+        if content is None or size < known:
+            content, known = {}, 0
+
+        # another process may have appended to the bucket, only the tail
+        # past what is already in memory has to be applied
+        if size > known:
+            with self.handles.open(path) as fd:
+                data = os.pread(fd, size - known, known)
+            for op, value, offset in decode_index_entries(data):
+                self.apply(content, op, value, offset)
+            self.observe_bucket(content, len(data), known == 0)
+
+        self.buckets[bucket] = content
+        self.sizes[bucket] = size
+        self.checked[bucket] = self.generation
+        return content
+
+    def observe_bucket(self, content, read, whole):
+        if not METRICS.enabled:
+            return
+        table = os.path.basename(self.path)
+        length = self.get_bucket_length(content)
+        METRICS.inc("sdb_bytes_read_total", read, table=table, file="index")
+        METRICS.set_max("sdb_bucket_entries_max",
+                        length,
+                        table=table,
+                        column=self.key)
+        # tails applied later would count the same bucket over and over
+        if whole:
+            METRICS.observe("sdb_bucket_entries",
+                            length,
+                            table=table,
+                            column=self.key)
+
+    def get_bucket_length(self, content):
+        return len(content)
+
+    def convert_legacy_bucket(self, bucket):
+        legacy_path = self.get_legacy_bucket_path(bucket)
+        with open(legacy_path, "rt") as legacy:
+            entries = [ujson.loads(line) for line in legacy]
+
+        with open(self.get_bucket_path(bucket), "wb") as bucket_file:
+            bucket_file.write(b"".join(
+                encode_index_entry(OP_PUT, entry[self.key], entry["offset"])
+                for entry in entries))
+
+        os.remove(legacy_path)
+
+
+# secondary indexes on non-key columns map every value to a set of offsets
+class MultiHashIndex(HashIndex):
+    def get(self, value):
+        return sorted(self.load_bucket(self.get_bucket(value)).get(value, ()))
+
+    def __contains__(self, value):
+        return value in self.load_bucket(self.get_bucket(value))
+
+    def apply(self, content, op, value, offset):
+        if op == OP_PUT:
+            content.setdefault(value, set()).add(offset)
+            return True
+
+        offsets = content.get(value)
+        if offsets is None or offset not in offsets:
+            return False
+
+        offsets.remove(offset)
+        if not offsets:
+            del content[value]
+        return True
+
+    def get_bucket_length(self, content):
+        return sum(len(offsets) for offsets in content.values())
+
+    def iter_entries(self, content):
+        for value, offsets in content.items():
+            for offset in sorted(offsets):
+                yield value, offset
+
+
+def write_bucket(path, data):
+    # a torn bucket would lose entries, it is swapped in whole
+    with open(f"{path}.tmp", "wb") as bucket_file:
+        bucket_file.write(data)
+    os.replace(f"{path}.tmp", path)
+
+
+def write_index(path, key, number_of_buckets, items, level=0, split=0):
+    entries = defaultdict(list)
+    for value, offset in items:
+        bucket = hash_to_bucket(value, number_of_buckets, level, split)
+        entries[bucket].append(encode_index_entry(OP_PUT, value, offset))
+
+    files = []
+    for bucket, data in entries.items():
+        filename = f"{key}_{bucket}.idx"
+        with open(os.path.join(path, filename), "wb") as bucket_file:
+            bucket_file.write(b"".join(data))
+        files.append(filename)
+
+    return files
@@ -0,0 +1,182 @@
+import fcntl
+import os
+import struct
+import threading
+from contextlib import contextmanager
+
+# the lock file carries counters bumped by every writer, so other processes
+# can tell whether their in-memory state of the table is still valid
+LockStateStruct = struct.Struct("<QQ")
+
+
+class TableLock:
+    """Reader/writer lock of one table.
+
+    Threads of one process are coordinated with a condition variable, other
+    processes with fcntl locks on the lock file. ``on_change`` is called with
+    ``structure_changed`` whenever another process modified the table since
+    this process last held the lock.
+
+    The readers of a process share one shared lock on the file, released by
+    the last of them. A writer waiting for the file holds the turnstile file
+    exclusively: readers of every process pass the turnstile first, and
+    readers joining a shared lock still held wait for it to be released.
+    """
+    def __init__(self, path, on_change):
+        self.path = path
+        self.on_change = on_change
+
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = None
+        self.writer_depth = 0
+        self.waiting_writers = 0
+        self.local = threading.local()
+
+        self.file_mutex = threading.Lock()
+        self.fd = None
+        self.turnstile_fd = None
+        self.draining = False
+        self.file_mode = None
+        self.generation = None
+        self.epoch = None
+        self.structure_changed = False
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        depth = getattr(self.local, "depth", 0)
+
+        # nested acquisitions never wait, a waiting writer would deadlock them
+        if self.writer == me or depth:
+            self.local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self.local.depth -= 1
+            return
+
+        with self.condition:
+            while self.writer is not None or self.waiting_writers or \
+                    self.draining:
+                self.condition.wait()
+            if self.readers and self.is_writer_waiting():
+                # the shared lock of the other readers is let go, otherwise
+                # a steady stream of them keeps the writer out for good
+                self.draining = True
+                while self.readers:
+                    self.condition.wait()
+                self.draining = False
+                self.condition.notify_all()
+            self.readers += 1
+
+        self.local.depth = 1
+        try:
+            with self.file_mutex:
+                if self.file_mode is None:
+                    self.lock_file(fcntl.LOCK_SH)
+            yield
+        finally:
+            self.local.depth = 0
+            with self.file_mutex:
+                with self.condition:
+                    self.readers -= 1
+                    last = self.readers == 0
+                    if last:
+                        self.condition.notify_all()
+                if last and self.file_mode == fcntl.LOCK_SH:
+                    self.unlock_file()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self.writer == me:
+            self.writer_depth += 1
+            try:
+                yield
+            finally:
+                self.writer_depth -= 1
+            return
+
+        if getattr(self.local, "depth", 0):
+            raise RuntimeError("table lock can not be upgraded to write")
+
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer is not None or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = me
+            self.writer_depth = 1
+
+        try:
+            with self.file_mutex:
+                self.lock_file(fcntl.LOCK_EX)
+            yield
+        finally:
+            with self.file_mutex:
+                self.unlock_file()
+            with self.condition:
+                self.writer = None
+                self.writer_depth = 0
+                self.condition.notify_all()
+
+    def mark_structure_changed(self):
+        self.structure_changed = True
+
+    def is_writer_waiting(self):
+        if self.turnstile_fd is None:
+            return False
+        try:
+            fcntl.flock(self.turnstile_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        fcntl.flock(self.turnstile_fd, fcntl.LOCK_UN)
+        return False
+
+    def lock_file(self, mode):
+        if self.fd is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            self.turnstile_fd = os.open(f"{self.path}.turnstile",
+                                        os.O_RDWR | os.O_CREAT)
+
+        # writers hold the turnstile until they got the file, readers only
+        # pass it
+        fcntl.flock(self.turnstile_fd, mode)
+        try:
+            fcntl.flock(self.fd, mode)
+        finally:
+            fcntl.flock(self.turnstile_fd, fcntl.LOCK_UN)
+        self.file_mode = mode
+
+        generation, epoch = self.read_state()
+        if self.generation is not None and generation != self.generation:
+            self.on_change(epoch != self.epoch)
+        self.generation, self.epoch = generation, epoch
+
+    def unlock_file(self):
+        if self.file_mode == fcntl.LOCK_EX:
+            self.generation += 1
+            if self.structure_changed:
+                self.epoch += 1
+                self.structure_changed = False
+            os.pwrite(self.fd,
+                      LockStateStruct.pack(self.generation, self.epoch), 0)
+
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.file_mode = None
+
+    def read_state(self):
+        data = os.pread(self.fd, LockStateStruct.size, 0)
+        if len(data) < LockStateStruct.size:
+            return 0, 0
+        return LockStateStruct.unpack(data)
+
+    def close(self):
+        with self.file_mutex:
+            if self.fd is not None and self.file_mode is None:
+                os.close(self.fd)
+                os.close(self.turnstile_fd)
+                self.fd = None
+                self.turnstile_fd = None
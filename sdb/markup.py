@@ -0,0 +1,160 @@
+import mmap
+import os
+import struct
+
+import numpy as np
+
+# version 1 tables store 32-bit offsets, which caps storage at 2 GiB
+MARKUP_VERSION_LEGACY = 1
+MARKUP_VERSION = 2
+
+MarkupStructs = {
+    MARKUP_VERSION_LEGACY: struct.Struct("<ii?"),
+    MARKUP_VERSION: struct.Struct("<qq?"),
+}
+
+MarkupDtypes = {
+    MARKUP_VERSION_LEGACY:
+    np.dtype([("start", "<i4"), ("length", "<i4"), ("active", "?")]),
+    MARKUP_VERSION:
+    np.dtype([("start", "<i8"), ("length", "<i8"), ("active", "?")]),
+}
+
+# markup entries looked at first when only a few active rows are wanted
+ACTIVE_WINDOW_SIZE = int(2**12)
+
+for version, dtype in MarkupDtypes.items():
+    assert dtype.itemsize == MarkupStructs[version].size
+
+
+def pack_markup_entries(spans, version=MARKUP_VERSION):
+    markup_struct = MarkupStructs[version]
+    return b"".join(
+        markup_struct.pack(start, length, True) for start, length in spans)
+
+
+class MarkupView:
+    def __init__(self, path, version=MARKUP_VERSION):
+        self.path = path
+        self.version = version
+        self.dtype = MarkupDtypes[version]
+        self.entry_size = self.dtype.itemsize
+        self.active_field_offset = self.dtype.fields["active"][1]
+
+        self.file = open(path, "r+b")
+        self.mmap = None
+        self.entries = np.empty(0, dtype=self.dtype)
+        self.dead = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def refresh(self):
+        size = os.fstat(self.file.fileno()).st_size
+        size -= size % self.entry_size
+        if size == len(self.entries) * self.entry_size:
+            return
+
+        known = len(self.entries)
+
+        # the previous mapping is not closed explicitly: arrays handed out
+        # by scans may still reference it, it goes away with the last of them
+        if size == 0:
+            self.mmap = None
+            self.entries = np.empty(0, dtype=self.dtype)
+        else:
+            self.mmap = mmap.mmap(self.file.fileno(), size)
+            self.entries = np.frombuffer(self.mmap, dtype=self.dtype)
+
+        if self.dead is not None and len(self.entries) >= known:
+            appended = self.entries["active"][known:]
+            self.dead += len(appended) - int(np.count_nonzero(appended))
+        else:
+            self.dead = None
+
+    def close(self):
+        self.mmap = None
+        self.entries = np.empty(0, dtype=self.dtype)
+        self.file.close()
+
+    def append(self, spans):
+        self.file.seek(0, os.SEEK_END)
+        offset = int(self.file.tell() / self.entry_size)
+        self.write(offset, spans)
+
+        return offset
+
+    def write(self, offset, spans):
+        self.file.seek(offset * self.entry_size)
+        self.file.write(pack_markup_entries(spans, self.version))
+        self.file.flush()
+        self.refresh()
+
+    def truncate(self, rows):
+        self.file.truncate(rows * self.entry_size)
+        self.refresh()
+
+    def read(self, offset):
+        if offset >= len(self.entries):
+            self.refresh()
+            if offset >= len(self.entries):
+                return None
+
+        start, length, active = self.entries[offset].tolist()
+        return start, length, active
+
+    def set_active(self, offset, active):
+        if offset >= len(self.entries):
+            self.refresh()
+            if offset >= len(self.entries):
+                return
+
+        position = offset * self.entry_size + self.active_field_offset
+        if self.mmap[position] == int(active):
+            return
+
+        self.mmap[position] = int(active)
+        if self.dead is not None:
+            self.dead += -1 if active else 1
+
+    def set_inactive(self, offsets):
+        self.refresh()
+        offsets = np.unique(np.asarray(offsets, dtype=np.int64))
+        offsets = offsets[offsets < len(self.entries)]
+
+        active = self.entries["active"]
+        flipped = int(np.count_nonzero(active[offsets]))
+        active[offsets] = False
+        if self.dead is not None:
+            self.dead += flipped
+
+    def count_dead(self):
+        self.refresh()
+        if self.dead is None:
+            active = self.entries["active"]
+            self.dead = len(active) - int(np.count_nonzero(active))
+        return self.dead
+
+    def active(self, after=-1, count=None):
+        """Offsets, starts and lengths of the active rows after ``after``.
+
+        With ``count`` only the first count of them, the active flags are
+        looked at in growing windows until they are found.
+        """
+        self.refresh()
+        entries = self.entries
+        if count is None:
+            offsets = np.flatnonzero(entries["active"][after + 1:]) + \
+                (after + 1)
+        else:
+            found, total = [np.empty(0, dtype=np.intp)], 0
+            start, window = after + 1, max(count, ACTIVE_WINDOW_SIZE)
+            while start < len(entries) and total < count:
+                active = np.flatnonzero(
+                    entries["active"][start:start + window]) + start
+                found.append(active)
+                total += len(active)
+                start += window
+                window *= 2
+            offsets = np.concatenate(found)[:count]
+        return offsets, entries["start"][offsets], entries["length"][offsets]
@@ -0,0 +1,275 @@
+import cProfile
+import functools
+import inspect
+import io
+import os
+import pstats
+import random
+import threading
+import time
+from bisect import bisect_left
+
+# upper bounds of the latency histograms, in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   5.0, 10.0)
+
+# upper bounds of the histogram of hash index bucket lengths, in entries
+BUCKET_LENGTHS = (1, 4, 16, 64, 256, 1024, 4096, 16384, 65536)
+
+# type, help text and histogram buckets of every metric
+MetricDefinitions = {
+    "sdb_db_call_seconds":
+    ("histogram", "Latency of DB calls, generators until exhausted",
+     LATENCY_BUCKETS),
+    "sdb_http_request_seconds":
+    ("histogram", "Latency of HTTP requests", LATENCY_BUCKETS),
+    "sdb_bucket_entries":
+    ("histogram", "Entries of hash index buckets read from disk",
+     BUCKET_LENGTHS),
+    "sdb_bucket_entries_max":
+    ("gauge", "Entries of the longest hash index bucket read from disk", None),
+    "sdb_file_opens_total": ("counter", "Table files opened", None),
+    "sdb_bytes_read_total": ("counter", "Bytes read from table files", None),
+    "sdb_bytes_written_total":
+    ("counter", "Bytes written to table files", None),
+    "sdb_rows_scanned_total":
+    ("counter", "Rows read by full table scans", None),
+    "sdb_rows_returned_total":
+    ("counter", "Rows full table scans returned", None),
+    "sdb_record_cache":
+    ("gauge", "Record cache counters and sizes by stat", None),
+    "sdb_bloom_false_positive_rate":
+    ("gauge", "Share of absent keys bloom filters let through", None),
+}
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"'
+                          for key, value in labels) + "}"
+
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus format.
+
+    While disabled every update returns right away.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.mutex = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.mutex:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.mutex:
+            self.values[key] = value
+
+    def set_max(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.mutex:
+            self.values[key] = max(self.values.get(key, value), value)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        bounds = MetricDefinitions[name][2]
+        with self.mutex:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = [[0] * (len(bounds) + 1), 0.0]
+                self.histograms[key] = histogram
+            histogram[0][bisect_left(bounds, value)] += 1
+            histogram[1] += value
+
+    def count(self, iterator, name, **labels):
+        """Passes the items of iterator on, counting them under name."""
+        if not self.enabled:
+            return iterator
+        return self.count_items(iterator, name, labels)
+
+    def count_items(self, iterator, name, labels):
+        count = 0
+        try:
+            for item in iterator:
+                count += 1
+                yield item
+        finally:
+            self.inc(name, count, **labels)
+
+    def reset(self):
+        with self.mutex:
+            self.values.clear()
+            self.histograms.clear()
+
+    def render(self):
+        with self.mutex:
+            values = dict(self.values)
+            histograms = {
+                key: (list(counts), total)
+                for key, (counts, total) in self.histograms.items()
+            }
+
+        lines = []
+        for name, (kind, description, bounds) in MetricDefinitions.items():
+            series = sorted(
+                (labels, value) for (metric, labels), value in values.items()
+                if metric == name)
+            observed = sorted(
+                (labels, histogram)
+                for (metric, labels), histogram in histograms.items()
+                if metric == name)
+            if not series and not observed:
+                continue
+
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+            for labels, (counts, total) in observed:
+                cumulative = 0
+                for bound, count in zip(list(bounds) + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket"
+                                 f"{format_labels(labels, [('le', bound)])} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total}")
+                lines.append(
+                    f"{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class Profiler:
+    """cProfile of a random sample of instrumented calls.
+
+    Off while the rate is 0. Only one call is profiled at a time, calls
+    made meanwhile are not sampled.
+    """
+    def __init__(self, rate=0.0):
+        self.rate = rate
+        self.stats = None
+        self.mutex = threading.Lock()
+        self.busy = threading.Lock()
+
+    def sample(self):
+        return random.random() < self.rate and \
+            self.busy.acquire(blocking=False)
+
+    def call(self, function, *args, **kwargs):
+        if not self.rate or not self.sample():
+            return function(*args, **kwargs)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            self.busy.release()
+            self.collect(profile)
+
+    def iterate(self, iterator):
+        if not self.rate or not self.sample():
+            yield from iterator
+            return
+
+        # only the steps of the generator are profiled, not its consumer
+        profile = cProfile.Profile()
+        try:
+            while True:
+                profile.enable()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    profile.disable()
+                yield item
+        finally:
+            self.busy.release()
+            self.collect(profile)
+
+    def collect(self, profile):
+        profile.create_stats()
+        if not profile.stats:
+            return
+        with self.mutex:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def reset(self):
+        with self.mutex:
+            self.stats = None
+
+    def report(self, limit=50):
+        with self.mutex:
+            if self.stats is None:
+                return ""
+            stream = io.StringIO()
+            self.stats.stream = stream
+            self.stats.sort_stats("cumulative").print_stats(limit)
+            return stream.getvalue()
+
+
+METRICS = Metrics(os.environ.get("SDB_METRICS", "1") != "0")
+PROFILER = Profiler(float(os.environ.get("SDB_PROFILE_RATE", "0")))
+
+
+def instrument(method):
+    """Times every call of a DB method by table and profiles a sample."""
+    labels = {"method": method.__name__}
+
+    def observe(start, args):
+        table = args[0] if args and isinstance(args[0], str) else ""
+        METRICS.observe("sdb_db_call_seconds",
+                        time.perf_counter() - start,
+                        table=table,
+                        **labels)
+
+    if inspect.isgeneratorfunction(method):
+
+        @functools.wraps(method)
+        def generator_wrapper(self, *args, **kwargs):
+            if not METRICS.enabled and not PROFILER.rate:
+                return (yield from method(self, *args, **kwargs))
+
+            start = time.perf_counter()
+            try:
+                return (yield from PROFILER.iterate(
+                    method(self, *args, **kwargs)))
+            finally:
+                observe(start, args)
+
+        return generator_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not METRICS.enabled and not PROFILER.rate:
+            return method(self, *args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return PROFILER.call(method, self, *args, **kwargs)
+        finally:
+            observe(start, args)
+
+    return wrapper
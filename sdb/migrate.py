@@ -0,0 +1,36 @@
+import argparse
+
+from .codec import STORAGE_FORMAT_BINARY, STORAGE_FORMAT_JSON
+from .db import DB
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Rewrite tables in the current on-disk format")
+    parser.add_argument("path", help="database directory")
+    parser.add_argument("tables",
+                        nargs="*",
+                        help="tables to migrate, all tables by default")
+    parser.add_argument("--buckets",
+                        type=int,
+                        default=None,
+                        help="number of key index buckets")
+    parser.add_argument("--format",
+                        choices=[STORAGE_FORMAT_JSON, STORAGE_FORMAT_BINARY],
+                        default=None,
+                        help="row encoding of storage.json")
+    args = parser.parse_args()
+
+    db = DB(args.path)
+    for name in args.tables or db.list_tables():
+        header = db.load_header(name)
+        stats = db.migrate(name, args.buckets, args.format)
+        print(f"{name}: version {header.version} -> "
+              f"{db.load_header(name).version}, "
+              f"{db.load_header(name).number_of_buckets} buckets, "
+              f"{db.load_header(name).storage_format} rows, "
+              f"{stats['reclaimed_bytes']} bytes reclaimed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+import bisect
+import heapq
+import os
+import struct
+import threading
+
+import ujson
+
+from .handles import APPEND_FLAGS
+from .index import OP_PUT, OP_REMOVE, decode_index_entries, encode_index_entry
+
+# entries of a sorted run between two fences, only the fences are kept in
+# memory and a range scan reads the run block by block
+FENCE_INTERVAL = int(2**8)
+
+# number of logged changes merged into a new sorted run at once
+MEMTABLE_SIZE = int(2**14)
+
+# the run ends with its fences and the position they start at
+RunFooterStruct = struct.Struct("<Q")
+
+
+def write_run(path, items):
+    """Writes (value, offset) pairs, which have to be sorted, as a run."""
+    fences = []
+    position = 0
+    with open(f"{path}.tmp", "wb") as run:
+        for number, (value, offset) in enumerate(items):
+            if number % FENCE_INTERVAL == 0:
+                fences.append([value, position])
+            data = encode_index_entry(OP_PUT, value, offset)
+            run.write(data)
+            position += len(data)
+
+        run.write(ujson.dumps(fences).encode())
+        run.write(RunFooterStruct.pack(position))
+        run.flush()
+        os.fsync(run.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+def apply_entry(puts, removed, op, value, offset):
+    entry = (value, offset)
+    position = bisect.bisect_left(puts, entry)
+    present = position < len(puts) and puts[position] == entry
+
+    # a removal hides the entry in the run as well, a later put of the same
+    # entry brings it back
+    if op == OP_PUT:
+        removed.discard(entry)
+        if not present:
+            puts.insert(position, entry)
+    else:
+        removed.add(entry)
+        if present:
+            del puts[position]
+
+
+class SortedRun:
+    def __init__(self, path):
+        self.path = path
+        self.fences = []
+        self.values = []
+        self.end = 0
+
+        if not os.path.isfile(path):
+            return
+
+        with open(path, "rb") as run:
+            run.seek(-RunFooterStruct.size, os.SEEK_END)
+            footer = run.tell()
+            self.end = RunFooterStruct.unpack(run.read())[0]
+            run.seek(self.end)
+            self.fences = ujson.loads(run.read(footer - self.end))
+        self.values = [value for value, _ in self.fences]
+
+    def read_block(self, run, block):
+        start = self.fences[block][1]
+        end = self.end
+        if block + 1 < len(self.fences):
+            end = self.fences[block + 1][1]
+
+        run.seek(start)
+        return [(value, offset)
+                for _, value, offset in decode_index_entries(run.read(end -
+                                                                      start))]
+
+    def range(self, low=None, high=None, reverse=False):
+        if not self.fences:
+            return
+
+        # the run is opened once, a merge replacing it does not disturb
+        # a range scan that is already running
+        with open(self.path, "rb") as run:
+            if not reverse:
+                block = 0
+                if low is not None:
+                    block = max(bisect.bisect_left(self.values, low) - 1, 0)
+                for block in range(block, len(self.fences)):
+                    for value, offset in self.read_block(run, block):
+                        if high is not None and value > high:
+                            return
+                        if low is None or value >= low:
+                            yield value, offset
+                return
+
+            block = len(self.fences) - 1
+            if high is not None:
+                block = bisect.bisect_right(self.values, high) - 1
+            for block in range(block, -1, -1):
+                for value, offset in reversed(self.read_block(run, block)):
+                    if low is not None and value < low:
+                        return
+                    if high is None or value <= high:
+                        yield value, offset
+
+
+class OrderedIndex:
+    """Index keeping the values of a column in order.
+
+    It is a small LSM tree: a sorted run on disk plus a log of changes made
+    since the run was written, which is kept sorted in memory and merged
+    into a new run once it grows past ``MEMTABLE_SIZE`` entries.
+    """
+    def __init__(self, path, key, handles):
+        self.path = path
+        self.key = key
+        self.handles = handles
+        self.run = None
+        self.puts = None
+        self.removed = None
+        self.logged = 0
+        # readers share the table lock, the first of them loads the index
+        # and the others wait for it
+        self.mutex = threading.Lock()
+
+    def get_run_path(self):
+        return os.path.join(self.path, f"{self.key}.run")
+
+    def get_log_path(self):
+        return os.path.join(self.path, f"{self.key}.olog")
+
+    def invalidate(self):
+        with self.mutex:
+            self.run = None
+            self.puts = None
+
+    def load(self):
+        """Returns the run, the memtable and the removed entries.
+
+        They are built aside and published together, a reader never sees a
+        memtable that is still being replayed.
+        """
+        with self.mutex:
+            if self.puts is not None:
+                return self.run, self.puts, self.removed
+
+            run = SortedRun(self.get_run_path())
+            puts, removed = [], set()
+            logged = 0
+            if os.path.isfile(self.get_log_path()):
+                with open(self.get_log_path(), "rb") as log:
+                    data = log.read()
+                for op, value, offset in decode_index_entries(data):
+                    apply_entry(puts, removed, op, value, offset)
+                    logged += 1
+
+            self.run, self.removed, self.logged = run, removed, logged
+            self.puts = puts
+            return run, puts, removed
+
+    def apply(self, op, value, offset):
+        apply_entry(self.puts, self.removed, op, value, offset)
+        self.logged += 1
+
+    def put_many(self, items):
+        self.append_entries([(OP_PUT, value, offset)
+                             for value, offset in items])
+
+    def remove(self, value, offset):
+        self.remove_many([(value, offset)])
+
+    def remove_many(self, items):
+        self.append_entries([(OP_REMOVE, value, offset)
+                             for value, offset in items])
+
+    def append_entries(self, entries):
+        if not entries:
+            return
+
+        self.load()
+        data = b"".join(
+            encode_index_entry(op, value, offset)
+            for op, value, offset in entries)
+        with self.handles.open(self.get_log_path(), APPEND_FLAGS) as fd:
+            os.write(fd, data)
+
+        for op, value, offset in entries:
+            self.apply(op, value, offset)
+
+        if self.logged >= MEMTABLE_SIZE:
+            self.merge()
+
+    def merge(self):
+        self.load()
+        write_run(self.get_run_path(), self.range())
+        with open(self.get_log_path(), "wb"):
+            pass
+        self.invalidate()
+
+    def range(self, low=None, high=None, reverse=False):
+        """Iterates (value, offset) pairs with low <= value <= high in order.
+
+        The memtable is copied right away, so the index may change while the
+        caller goes through the range.
+        """
+        run, puts, removed = self.load()
+
+        removed = set(removed)
+        lower = 0 if low is None else bisect.bisect_left(puts, (low, ))
+        upper = len(puts)
+        if high is not None:
+            upper = bisect.bisect_left(puts, (high, float("inf")))
+        puts = puts[lower:upper]
+        if reverse:
+            puts.reverse()
+
+        return self.merge_entries(run.range(low, high, reverse), puts,
+                                  removed, reverse)
+
+    def merge_entries(self, run, puts, removed, reverse):
+        previous = None
+        for entry in heapq.merge(run, puts, reverse=reverse):
+            if entry != previous and entry not in removed:
+                yield entry
+            previous = entry
+
+    def get(self, value):
+        return [offset for _, offset in self.range(value, value)]
+
+
+def write_ordered_index(path, key, items):
+    run_name, log_name = f"{key}.run", f"{key}.olog"
+    write_run(os.path.join(path, run_name), sorted(items))
+    with open(os.path.join(path, log_name), "wb"):
+        pass
+    return [run_name, log_name]
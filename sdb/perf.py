@@ -1,176 +1,275 @@
-import math
+import argparse
+import io
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
 
-import perfplot
+import numpy as np
+import ujson
 from faker import Faker
 
 from .db import DB, ColumnInfo
 
-fake = Faker()
-db = DB("test")
-from functools import cache
-import random
+TABLE = "bench"
+
+DEFAULT_SIZES = [int(1e3), int(1e4)]
+
+# number of timed operations of the lookup, edit and delete benchmarks
+DEFAULT_OPS = int(1e3)
+
+# benchmarks reading the whole table per operation run this many of them
+FULL_TABLE_OPS = 3
 
+# records per call of the batch insert benchmark
+BATCH_SIZE = int(2**10)
 
-@cache
-def build_records(count):
+# a benchmark regresses once its throughput drops, or its median latency
+# grows, by more than this fraction of the baseline
+DEFAULT_THRESHOLD = 0.25
+
+
+def build_records(count, seed):
+    fake = Faker()
+    fake.seed_instance(seed)
+    # phone numbers repeat, the counter keeps the key unique
     return [{
         "name": fake.name(),
         "job": fake.job(),
-        "number": fake.phone_number()
-    } for _ in range(count)]
-
-    return records
-
-
-def perf_add():
-    name = "test_add"
-    def setup(size: int):
-        db.delete_table(name)
-
-        columns = [
-            ColumnInfo(name="name", is_key=False, type='str'),
-            ColumnInfo(name="job", is_key=False, type='str'),
-            ColumnInfo(name="number", is_key=True, type='str'),
-        ]
-
-        db.create_table(name, columns=columns)
-
-        return build_records(size)
-
-    def kernel(record):
-        for record in record:
-            db.store_record(name, record)
-
-    perfplot.show(
-        setup=setup,
-        kernels=[
-            kernel,
-        ],
-        labels=["add"],
-        n_range=[1000 * k for k in range(1, 20)],
-        xlabel="number of db records",
-        # More optional arguments with their default values:
-        logx=False,  # set to True or False to force scaling
-        logy=False,
-        # equality_check=np.allclose,  # set to None to disable "correctness" assertion
-        # show_progress=True,
-        # target_time_per_measurement=1.0,
-        # max_time=None,  # maximum time per measurement
-        # time_unit="s",  # set to one of ("auto", "s", "ms", "us", or "ns") to force plot units
-        # relative_to=1,  # plot the timings relative to one of the measurements
-        # flops=lambda n: 3*n,  # FLOPS plots
-    )
-
-def perf_search():
-    name = "test_search_by_key"
-    def setup(size: int):
-        db.delete_table(name)
-
-        columns = [
-            ColumnInfo(name="name", is_key=False, type='str'),
-            ColumnInfo(name="job", is_key=False, type='str'),
-            ColumnInfo(name="number", is_key=True, type='str'),
-        ]
-
-        db.create_table(name, columns=columns)
-
-        records = build_records(size)
-        for record in records:
-            db.store_record(name, record)
-
-        return records
-
-    def search_by_key(records):
-        searched_record = random.choice(records)
-
-        key = "number"
-        records = list(db.get_record(name, key=key, value=searched_record[key]))
-        assert len(records) > 0
-
-    def search_by_non_key(records):
-        searched_record = random.choice(records)
-
-        key = "name"
-        records = list(db.get_record(name, key=key, value=searched_record[key]))
-        assert len(records) > 0
-
-
-    perfplot.show(
-        setup=setup,
-        kernels=[
-            search_by_key,
-            # search_by_non_key,
-        ],
-        labels=[
-            "by key",
-            # "by non-key"
-        ],
-        n_range=[1000 * k for k in range(1, 5)],
-        xlabel="number of db records",
-        # More optional arguments with their default values:
-        logx=False,  # set to True or False to force scaling
-        logy=False,
-        equality_check=None,  # set to None to disable "correctness" assertion
-        # show_progress=True,
-        # target_time_per_measurement=1.0,
-        # max_time=None,  # maximum time per measurement
-        time_unit="us",  # set to one of ("auto", "s", "ms", "us", or "ns") to force plot units
-        # relative_to=1,  # plot the timings relative to one of the measurements
-        # flops=lambda n: 3*n,  # FLOPS plots
-    )
-
-def perf_del():
-    name = "del_search_by_key"
-    def setup(size: int):
-        db.delete_table(name)
-
-        columns = [
-            ColumnInfo(name="name", is_key=False, type='str'),
-            ColumnInfo(name="job", is_key=False, type='str'),
-            ColumnInfo(name="number", is_key=True, type='str'),
-        ]
-
-        db.create_table(name, columns=columns)
-
-        records = build_records(size)
-        for record in records:
-            db.store_record(name, record)
-
-        return records
-
-    def del_by_key(records):
-        removed_record = random.choice(records)
-
-        key = "number"
-        db.delete_record(name, key=key, value=removed_record[key])
-
-    def del_by_non_key(records):
-        removed_record = random.choice(records)
-
-        key = "name"
-        db.delete_record(name, key=key, value=removed_record[key])
-
-
-    perfplot.show(
-        setup=setup,
-        kernels=[
-            del_by_key,
-            # del_by_non_key,
-        ],
-        labels=[
-            "by key",
-            # "by non-key"
-        ],
-        n_range=[1000 * k for k in range(1, 5)],
-        xlabel="number of db records",
-        # More optional arguments with their default values:
-        logx=False,  # set to True or False to force scaling
-        logy=False,
-        equality_check=None,  # set to None to disable "correctness" assertion
-        # show_progress=True,
-        # target_time_per_measurement=1.0,
-        # max_time=None,  # maximum time per measurement
-        time_unit="ms",  # set to one of ("auto", "s", "ms", "us", or "ns") to force plot units
-        # relative_to=1,  # plot the timings relative to one of the measurements
-        # flops=lambda n: 3*n,  # FLOPS plots
-    )
+        "number": f"{fake.phone_number()} #{i}",
+    } for i in range(count)]
+
+
+def create_table(db, name=TABLE):
+    db.create_table(name,
+                    columns=[
+                        ColumnInfo(name="name", is_key=False, type="str"),
+                        ColumnInfo(name="job", is_key=False, type="str"),
+                        ColumnInfo(name="number", is_key=True, type="str"),
+                    ])
+
+
+def populate(db, records):
+    create_table(db)
+    db.store_records(TABLE, (dict(record) for record in records))
+
+
+def measure(operations):
+    latencies = []
+    for operation in operations:
+        start = time.perf_counter()
+        operation()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_insert(db, records, rng, ops):
+    create_table(db)
+    latencies = measure(lambda record=record: db.store_record(
+        TABLE, dict(record)) for record in records)
+    return latencies, len(records)
+
+
+def bench_batch_insert(db, records, rng, ops):
+    create_table(db)
+    batches = [records[i:i + BATCH_SIZE]
+               for i in range(0, len(records), BATCH_SIZE)]
+    latencies = measure(lambda batch=batch: db.store_records(
+        TABLE, [dict(record) for record in batch]) for batch in batches)
+    return latencies, len(records)
+
+
+def bench_key_lookup(db, records, rng, ops):
+    populate(db, records)
+    keys = [rng.choice(records)["number"] for _ in range(ops)]
+    latencies = measure(lambda key=key: db.get_record_by_key(
+        TABLE, "number", key) for key in keys)
+    return latencies, ops
+
+
+def bench_non_key_lookup(db, records, rng, ops):
+    populate(db, records)
+    names = [rng.choice(records)["name"] for _ in range(FULL_TABLE_OPS)]
+    latencies = measure(lambda name=name: list(
+        db.get_record(TABLE, "name", name)) for name in names)
+    return latencies, len(names)
+
+
+def bench_edit(db, records, rng, ops):
+    populate(db, records)
+    pks = [rng.randrange(len(records)) for _ in range(ops)]
+    latencies = measure(lambda pk=pk: db.update_record(
+        TABLE, pk, {"job": f"job {pk}"}) for pk in pks)
+    return latencies, ops
+
+
+def bench_delete(db, records, rng, ops):
+    populate(db, records)
+    keys = [record["number"]
+            for record in rng.sample(records, min(ops, len(records)))]
+    latencies = measure(lambda key=key: db.delete_record(
+        TABLE, "number", key) for key in keys)
+    return latencies, len(keys)
+
+
+def bench_scan(db, records, rng, ops):
+    populate(db, records)
+    latencies = measure(lambda: sum(1 for _ in db.list_records(TABLE))
+                        for _ in range(FULL_TABLE_OPS))
+    return latencies, FULL_TABLE_OPS * len(records)
+
+
+def bench_csv_export(db, records, rng, ops):
+    populate(db, records)
+    latencies = measure(lambda: sum(len(data) for data in db.to_csv(TABLE))
+                        for _ in range(FULL_TABLE_OPS))
+    return latencies, FULL_TABLE_OPS * len(records)
+
+
+def bench_backup_restore(db, records, rng, ops):
+    populate(db, records)
+
+    def backup_restore():
+        archive = io.BytesIO()
+        for data in db.backup_stream(TABLE):
+            archive.write(data)
+        archive.seek(0)
+        db.restore(f"{TABLE}_restored", archive)
+
+    latencies = measure(backup_restore for _ in range(FULL_TABLE_OPS))
+    return latencies, FULL_TABLE_OPS * len(records)
+
+
+Benchmarks = {
+    "insert": bench_insert,
+    "batch_insert": bench_batch_insert,
+    "key_lookup": bench_key_lookup,
+    "non_key_lookup": bench_non_key_lookup,
+    "edit": bench_edit,
+    "delete": bench_delete,
+    "scan": bench_scan,
+    "csv_export": bench_csv_export,
+    "backup_restore": bench_backup_restore,
+}
+
+
+def get_disk_usage(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, filename))
+        for directory, _, filenames in os.walk(path)
+        for filename in filenames)
+
+
+def run_benchmark(benchmark, size, ops, seed, sync_commits):
+    records = build_records(size, seed)
+    # every benchmark draws the same operations for the same seed
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory(prefix="sdb-perf-") as path:
+        db = DB(path, sync_commits=sync_commits)
+        latencies, rows = Benchmarks[benchmark](db, records, rng, ops)
+        bytes_on_disk = get_disk_usage(path)
+
+    seconds = sum(latencies)
+    return {
+        "benchmark": benchmark,
+        "size": size,
+        "ops": len(latencies),
+        "rows": rows,
+        "seconds": seconds,
+        "throughput": rows / seconds if seconds else 0.0,
+        "p50_ms": float(np.percentile(latencies, 50)) * 1e3,
+        "p99_ms": float(np.percentile(latencies, 99)) * 1e3,
+        "bytes_on_disk": bytes_on_disk,
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if expected is None:
+            continue
+
+        if result["throughput"] < expected["throughput"] * (1 - threshold):
+            regressions.append(
+                f"{key}: throughput {expected['throughput']:.1f} -> "
+                f"{result['throughput']:.1f} rows/s")
+        if result["p50_ms"] > expected["p50_ms"] * (1 + threshold):
+            regressions.append(f"{key}: p50 {expected['p50_ms']:.3f} -> "
+                               f"{result['p50_ms']:.3f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark sdb and compare the results to a baseline")
+    parser.add_argument("--sizes",
+                        type=lambda sizes: [int(s) for s in sizes.split(",")],
+                        default=DEFAULT_SIZES,
+                        help="comma separated numbers of records")
+    parser.add_argument("--ops",
+                        type=int,
+                        default=DEFAULT_OPS,
+                        help="timed operations of point benchmarks")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--benchmarks",
+                        nargs="*",
+                        choices=list(Benchmarks),
+                        default=list(Benchmarks),
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--no-sync",
+                        action="store_true",
+                        help="don't fsync commits")
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--baseline",
+                        help="results of an earlier run to compare with")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown as a fraction of the baseline")
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        for benchmark in args.benchmarks:
+            result = run_benchmark(benchmark, size, args.ops, args.seed,
+                                   not args.no_sync)
+            results[f"{benchmark}@{size}"] = result
+            print(f"{benchmark}@{size}: {result['throughput']:.1f} rows/s, "
+                  f"p50 {result['p50_ms']:.3f} ms, "
+                  f"p99 {result['p99_ms']:.3f} ms, "
+                  f"{result['bytes_on_disk']} bytes",
+                  file=sys.stderr)
+
+    report = {
+        "meta": {
+            "seed": args.seed,
+            "ops": args.ops,
+            "sync_commits": not args.no_sync,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "created": time.time(),
+        },
+        "results": results,
+    }
+    data = ujson.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "wt") as output:
+            output.write(data)
+    else:
+        print(data)
+
+    if args.baseline:
+        with open(args.baseline, "rt") as baseline:
+            baseline = ujson.loads(baseline.read())["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import os
+
+from .handles import UPDATE_FLAGS
+
+# primary keys are handed out of blocks reserved in the pk file, so the file
+# is written once per block instead of once per record
+PK_BLOCK_SIZE = int(2**10)
+
+
+class PkAllocator:
+    """Primary key counter of one table.
+
+    The pk file holds the high-water mark: every pk below it may have been
+    handed out by some process. A process owns the block it reserved last
+    and allocates from memory until the block runs out, pks left in a block
+    when the process exits are never used. Callers hold the table write
+    lock, which also serializes reservations of different processes.
+    """
+    def __init__(self, path, handles):
+        self.path = path
+        self.handles = handles
+        self.next = 0
+        self.reserved = 0
+
+    def read_mark(self):
+        with self.handles.open(self.path, UPDATE_FLAGS) as fd:
+            data = os.pread(fd, 32, 0).strip()
+        try:
+            return int(data)
+        except ValueError:
+            return None
+
+    def write_mark(self, mark, sync=False):
+        data = f"{mark}".encode()
+        with self.handles.open(self.path, UPDATE_FLAGS) as fd:
+            os.pwrite(fd, data, 0)
+            os.ftruncate(fd, len(data))
+            if sync:
+                os.fsync(fd)
+
+    def allocate(self, count):
+        if count and self.next + count > self.reserved:
+            start = self.read_mark() or 0
+            self.reserved = start + max(count, PK_BLOCK_SIZE)
+            # the block is handed out before any row using it is logged, a
+            # mark lost in a crash would give its pks out again
+            self.write_mark(self.reserved, sync=True)
+            self.next = start
+
+        pks = range(self.next, self.next + count)
+        self.next += count
+        return pks
+
+    def advance(self, pk):
+        """Makes sure pk and everything below it is never handed out."""
+        mark = self.read_mark() or 0
+        if pk >= mark:
+            self.write_mark(pk + 1)
+        if pk >= self.next:
+            self.next = self.reserved = 0
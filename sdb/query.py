@@ -0,0 +1,281 @@
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+
+class Predicate:
+    """Condition on the columns of a row.
+
+    Predicates are picklable, so parallel scans can hand them to worker
+    processes. Called with a codec and the encoded row they only decode the
+    columns they look at.
+    """
+    def __call__(self, codec, data):
+        raise NotImplementedError
+
+    def matches(self, record):
+        raise NotImplementedError
+
+
+class ColumnPredicate(Predicate):
+    def __init__(self, column):
+        self.column = column
+
+    def __call__(self, codec, data):
+        return self.check(codec.decode_column(data, self.column))
+
+    def matches(self, record):
+        return self.check(record.get(self.column))
+
+    # missing values and values of another type never match
+    def check(self, value):
+        if value is None:
+            return False
+        try:
+            return self.test(value)
+        except TypeError:
+            return False
+
+    def test(self, value):
+        raise NotImplementedError
+
+
+class Eq(ColumnPredicate):
+    def __init__(self, column, value):
+        super().__init__(column)
+        self.value = value
+
+    def test(self, value):
+        return value == self.value
+
+
+class Lt(ColumnPredicate):
+    def __init__(self, column, value):
+        super().__init__(column)
+        self.value = value
+
+    def test(self, value):
+        return value < self.value
+
+
+class Gt(ColumnPredicate):
+    def __init__(self, column, value):
+        super().__init__(column)
+        self.value = value
+
+    def test(self, value):
+        return value > self.value
+
+
+# both bounds are inclusive
+class Between(ColumnPredicate):
+    def __init__(self, column, low, high):
+        super().__init__(column)
+        self.low = low
+        self.high = high
+
+    def test(self, value):
+        return self.low <= value <= self.high
+
+
+class In(ColumnPredicate):
+    def __init__(self, column, values):
+        super().__init__(column)
+        self.values = list(values)
+        self.lookup = set(self.values)
+
+    def test(self, value):
+        return value in self.lookup
+
+
+class Prefix(ColumnPredicate):
+    def __init__(self, column, prefix):
+        super().__init__(column)
+        self.prefix = prefix
+
+    def test(self, value):
+        return str(value).startswith(self.prefix)
+
+
+class IsMissing(Predicate):
+    def __init__(self, column):
+        self.column = column
+
+    def __call__(self, codec, data):
+        return codec.decode_column(data, self.column) is None
+
+    def matches(self, record):
+        return record.get(self.column) is None
+
+
+class And(Predicate):
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __call__(self, codec, data):
+        return all(predicate(codec, data) for predicate in self.predicates)
+
+    def matches(self, record):
+        return all(predicate.matches(record) for predicate in self.predicates)
+
+
+class Or(Predicate):
+    def __init__(self, *predicates):
+        self.predicates = predicates
+
+    def __call__(self, codec, data):
+        return any(predicate(codec, data) for predicate in self.predicates)
+
+    def matches(self, record):
+        return any(predicate.matches(record) for predicate in self.predicates)
+
+
+ComparisonOps = {
+    "==": Eq,
+    "<": Lt,
+    ">": Gt,
+}
+
+
+def check_leaf_value(column, value):
+    # casting null, a list or an object raises TypeError or quietly turns
+    # it into a string
+    if value is None or not isinstance(value, (str, int, float)):
+        raise ValueError(f"{column} can't be compared with {value!r}")
+    return value
+
+
+def parse_predicate(spec, cast):
+    """Builds a predicate from its JSON form.
+
+    ``{"and": [...]}`` and ``{"or": [...]}`` combine other predicates, a
+    leaf is ``{"column": ..., "op": ..., "value": ...}`` with one of ``==``,
+    ``<``, ``>``, ``between`` (``[low, high]``), ``in`` (a list) or
+    ``prefix``. ``cast(column, value)`` converts values to the column type.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError(f"predicate must be an object: {spec!r}")
+
+    for name, combinator in (("and", And), ("or", Or)):
+        if name in spec:
+            parts = spec[name]
+            if not isinstance(parts, list) or not parts:
+                raise ValueError(f"{name} needs a list of predicates")
+            return combinator(*(parse_predicate(part, cast)
+                                for part in parts))
+
+    column, op, value = spec.get("column"), spec.get("op"), spec.get("value")
+    if column is None:
+        raise ValueError(f"predicate without a column: {spec!r}")
+
+    if op in ComparisonOps:
+        return ComparisonOps[op](column,
+                                 cast(column, check_leaf_value(column, value)))
+    if op == "between":
+        if not isinstance(value, list) or len(value) != 2:
+            raise ValueError("between needs [low, high]")
+        low, high = (cast(column, check_leaf_value(column, item))
+                     for item in value)
+        return Between(column, low, high)
+    if op == "in":
+        if not isinstance(value, list):
+            raise ValueError("in needs a list of values")
+        return In(column, [
+            cast(column, check_leaf_value(column, item)) for item in value
+        ])
+    if op == "prefix":
+        return Prefix(column, str(check_leaf_value(column, value)))
+
+    raise ValueError(f"unknown operator: {op}")
+
+
+@dataclass(frozen=True)
+class QueryPlan:
+    # "index" looks the values up in the index of the column, "union" does
+    # that for several columns, "range" walks the ordered index of the column
+    # between two bounds, "scan" reads every active row; all of them check
+    # the whole predicate on every row
+    kind: str
+    column: Optional[str] = None
+    values: Optional[List[Any]] = None
+
+
+def plan_lookup(predicate, indexed):
+    if isinstance(predicate, Eq) and predicate.column in indexed:
+        return QueryPlan("index", predicate.column, [predicate.value])
+    if isinstance(predicate, In) and predicate.column in indexed:
+        return QueryPlan("index", predicate.column, predicate.values)
+    return None
+
+
+def column_bounds(predicate, column):
+    """Returns the (low, high) range the predicate keeps the column in."""
+    if isinstance(predicate, ColumnPredicate) and predicate.column == column:
+        if isinstance(predicate, Eq):
+            return predicate.value, predicate.value
+        if isinstance(predicate, Between):
+            return predicate.low, predicate.high
+        if isinstance(predicate, Lt):
+            return None, predicate.value
+        if isinstance(predicate, Gt):
+            return predicate.value, None
+
+    low = high = None
+    if isinstance(predicate, And):
+        for part in predicate.predicates:
+            part_low, part_high = column_bounds(part, column)
+            if part_low is not None:
+                low = part_low if low is None else max(low, part_low)
+            if part_high is not None:
+                high = part_high if high is None else min(high, part_high)
+    return low, high
+
+
+def plan_range(predicate, ordered):
+    for column in sorted(ordered):
+        bounds = column_bounds(predicate, column)
+        if bounds != (None, None):
+            return QueryPlan("range", column, list(bounds))
+    return None
+
+
+def plan_query(predicate, keys, indexed, ordered=()):
+    if predicate is None:
+        return QueryPlan("scan")
+
+    plan = plan_lookup(predicate, indexed)
+    if plan is not None:
+        return plan
+
+    # a conjunction is narrowed by any of its indexed parts, unique keys
+    # give the fewest rows to check
+    if isinstance(predicate, And):
+        plans = [plan_lookup(part, indexed) for part in predicate.predicates]
+        plans = [plan for plan in plans if plan is not None]
+        if plans:
+            return min(plans,
+                       key=lambda plan: (plan.column not in keys,
+                                         len(plan.values)))
+
+    plan = plan_range(predicate, ordered)
+    if plan is not None:
+        return plan
+
+    # a disjunction can only avoid the scan if every part is indexed
+    if isinstance(predicate, Or):
+        plans = [plan_lookup(part, indexed) for part in predicate.predicates]
+        if all(plan is not None for plan in plans):
+            columns = {plan.column for plan in plans}
+            if len(columns) == 1:
+                values = [value for plan in plans for value in plan.values]
+                return QueryPlan("index", columns.pop(), values)
+            return QueryPlan("union",
+                             values=[(plan.column, plan.values)
+                                     for plan in plans])
+
+    return QueryPlan("scan")
+
+
+def project(record, columns):
+    if columns is None:
+        return record
+    return {column: record[column] for column in columns if column in record}
@@ -0,0 +1,138 @@
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .metrics import METRICS
+
+# number of markup entries handed to a worker process at once
+SCAN_RANGE_SIZE = int(2**14)
+
+# scans of fewer active rows are not worth shipping to other processes
+SCAN_PARALLEL_MIN_ROWS = int(2**15)
+
+
+def read_range_data(storage, offsets, starts, lengths):
+    if not len(offsets):
+        return
+
+    # rows of a range are mostly adjacent in storage, so unless deleted rows
+    # left big holes the whole span is read with one call
+    first = int(starts.min())
+    span = int((starts + lengths).max()) - first
+    block = None
+    if span <= 2 * int(lengths.sum()):
+        storage.seek(first)
+        block = storage.read(span)
+
+    for offset, start, length in zip(offsets.tolist(), starts.tolist(),
+                                     lengths.tolist()):
+        if block is not None:
+            data = block[start - first:start - first + length]
+        else:
+            storage.seek(start)
+            data = storage.read(length)
+        yield offset, data
+
+
+def filter_rows(codec, rows, predicate=None):
+    for offset, data in rows:
+        if predicate is None or predicate(codec, data):
+            yield offset, codec.decode(data)
+
+
+def read_range(storage, codec, offsets, starts, lengths, predicate=None):
+    return filter_rows(codec,
+                       read_range_data(storage, offsets, starts, lengths),
+                       predicate)
+
+
+def scan_task(path, inode, codec, offsets, starts, lengths, predicate):
+    with open(path, "rb") as storage:
+        # a compaction swapped the file after the scan took its snapshot,
+        # the caller still holds the old file and reads the range itself
+        if os.fstat(storage.fileno()).st_ino != inode:
+            return None
+        return list(
+            read_range(storage, codec, offsets, starts, lengths, predicate))
+
+
+class ParallelScanner:
+    """Process pool reading ranges of a markup snapshot.
+
+    Every worker opens the storage file on its own, decodes the rows of its
+    range and applies the predicate, which has to be picklable. Ranges are
+    yielded in markup order, only a few of them are in flight at once.
+
+    Workers import the main module again, as with the spawn start method,
+    so it has to guard its entry point with ``if __name__ == "__main__"``.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = None
+        self.mutex = threading.Lock()
+
+    def get_executor(self):
+        with self.mutex:
+            if self.executor is None:
+                # the application may run threads, forking it could copy a
+                # lock another thread holds into the worker; workers come
+                # from a server process that only imported this module
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload([__name__])
+                self.executor = ProcessPoolExecutor(self.workers,
+                                                    mp_context=context)
+            return self.executor
+
+    def scan(self, storage, codec, offsets, starts, lengths, predicate=None):
+        executor = self.get_executor()
+        path = storage.name
+        table = os.path.basename(os.path.dirname(path))
+        inode = os.fstat(storage.fileno()).st_ino
+
+        ranges = iter(
+            [slice(i, i + SCAN_RANGE_SIZE) for i in range(0, len(offsets),
+                                                          SCAN_RANGE_SIZE)])
+
+        def submit(chunk):
+            return chunk, executor.submit(scan_task, path, inode, codec,
+                                          offsets[chunk], starts[chunk],
+                                          lengths[chunk], predicate)
+
+        pending = deque()
+        try:
+            for chunk in ranges:
+                pending.append(submit(chunk))
+                if len(pending) >= 2 * self.workers:
+                    break
+
+            while pending:
+                chunk, future = pending.popleft()
+                rows = future.result()
+                chunk_next = next(ranges, None)
+                if chunk_next is not None:
+                    pending.append(submit(chunk_next))
+
+                if rows is None:
+                    rows = read_range(storage, codec, offsets[chunk],
+                                      starts[chunk], lengths[chunk], predicate)
+                # a range is counted once its rows are consumed, not when
+                # a worker read it ahead
+                METRICS.inc("sdb_rows_scanned_total",
+                            len(offsets[chunk]),
+                            table=table)
+                METRICS.inc("sdb_bytes_read_total",
+                            int(lengths[chunk].sum()),
+                            table=table,
+                            file="storage")
+                yield from rows
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def close(self):
+        with self.mutex:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
@@ -1,14 +1,43 @@
+import multiprocessing
 import os
+import tarfile
 import tempfile
+import time
 
-from flask import (Flask, flash, redirect, render_template, request, send_file,
-                   url_for)
+import ujson
+from flask import Flask, flash, g, redirect, render_template, request, url_for
 
-from .db import DB, ColumnInfo
+from .backup import (BACKUP_COMPRESSION, CompressionExtensions,
+                     CompressionMimetypes)
+from .codec import STORAGE_FORMAT_JSON
+from .db import DB, NUMBER_OF_BUCKETS, ColumnInfo
+from .export import EXPORT_FORMAT_CSV, ExportMimetypes
+from .metrics import METRICS, PROFILER
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'my secret key'
-db = DB("prod")
+# the scan workers import the main module again, which may import this one:
+# only the server process opens the database
+db = None
+if multiprocessing.parent_process() is None:
+    db = DB("prod", scan_workers=os.cpu_count())
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    # streamed responses are timed until the response object is returned
+    METRICS.observe("sdb_http_request_seconds",
+                    time.perf_counter() - g.request_start,
+                    route=request.url_rule.rule
+                    if request.url_rule else "unmatched",
+                    method=request.method,
+                    status=response.status_code)
+    return response
 
 
 def format_columns_info(columns):
@@ -16,6 +45,8 @@ def format_columns_info(columns):
     for column in columns:
         if column.is_key:
             fmt.append(f"<b>{column.name}</b>")
+        elif column.indexed or column.ordered:
+            fmt.append(f"<i>{column.name}</i>")
         else:
             fmt.append(f"{column.name}")
 
@@ -43,32 +74,277 @@ def delete_table():
     return redirect("/")
 
 
-def get_records(name, filter_column, filter_value):
+def get_records(name,
+                filter_column,
+                filter_value,
+                after=None,
+                limit=10,
+                order_by=None,
+                descending=False):
     if filter_column is not None and filter_value is not None:
         filter_value = db.cast_key(name, filter_column, filter_value)
         if filter_value is None:
-            return []
-
-    if filter_column is not None and filter_value is not None:
-        return list(db.get_record(name, key=filter_column, value=filter_value))
+            return [], None
     else:
-        return list(db.list_records(name))
+        filter_column = filter_value = None
+
+    if order_by not in db.load_ordered_columns(name):
+        order_by = None
+
+    return db.list_records_page(name,
+                                after=after,
+                                limit=limit,
+                                key=filter_column,
+                                value=filter_value,
+                                order_by=order_by,
+                                descending=descending)
+
+
+@app.route('/table/<name>/records', methods=['GET'])
+def table_records(name):
+    limit = request.args.get('limit', 100, type=int)
+    after = request.args.get('after', type=int)
+    pages = request.args.get('pages', type=int)
+    filter_value = request.args.get('filter_value')
+    filter_column = request.args.get('filter_column')
+    order_by = request.args.get('order_by')
+    descending = bool(request.args.get('desc', 0, type=int))
+
+    # the first page is read before the response is started, a filter
+    # value that can't be cast is still answered with a 400
+    try:
+        page = get_records(name, filter_column, filter_value, after, limit,
+                           order_by, descending)
+    except (KeyError, ValueError) as e:
+        return app.response_class(ujson.dumps({"error": str(e)}),
+                                  status=400,
+                                  mimetype='application/json')
+
+    def generate(page):
+        sent = 0
+        while pages is None or sent < pages:
+            rows, after = page
+            yield ujson.dumps({"records": rows, "next": after}) + "\n"
+            sent += 1
+            if after is None:
+                return
+            page = get_records(name, filter_column, filter_value, after,
+                               limit, order_by, descending)
+
+    return app.response_class(generate(page),
+                              mimetype='application/x-ndjson')
 
 
 @app.route('/table/<name>/csv', methods=['GET'])
 def table_csv(name):
-    return app.response_class(db.to_csv(name), mimetype='text/csv')
+    order_by = request.args.get('order_by')
+    if order_by not in db.load_ordered_columns(name):
+        order_by = None
+    descending = bool(request.args.get('desc', 0, type=int))
+    return app.response_class(db.to_csv(name, order_by, descending),
+                              mimetype='text/csv')
+
+
+@app.route('/table/<name>/export', methods=['GET'])
+def table_export(name):
+    export_format = request.args.get('format', EXPORT_FORMAT_CSV)
+    columns = request.args.get('columns')
+    order_by = request.args.get('order_by')
+    descending = bool(request.args.get('desc', 0, type=int))
+
+    try:
+        predicate = None
+        where = request.args.get('where')
+        if where:
+            predicate = db.parse_query(name, ujson.loads(where))
+        records = db.export(name, export_format,
+                            columns.split(",") if columns else None, predicate,
+                            order_by, descending)
+    except (KeyError, ValueError) as e:
+        return app.response_class(ujson.dumps({"error": str(e)}),
+                                  status=400,
+                                  mimetype='application/json')
+
+    return app.response_class(records,
+                              mimetype=ExportMimetypes[export_format])
+
+
+@app.route('/table/<name>/query', methods=['GET', 'POST'])
+def table_query(name):
+    spec = request.get_json(silent=True) or {}
+    limit = spec.get('limit', request.args.get('limit', type=int))
+    columns = spec.get('columns')
+    order_by = spec.get('order_by')
+    descending = bool(spec.get('desc', False))
+
+    try:
+        predicate = None
+        if spec.get('where') is not None:
+            predicate = db.parse_query(name, spec['where'])
+        if order_by is not None and \
+                order_by not in db.load_ordered_columns(name):
+            raise ValueError(f"{order_by} has no ordered index")
+    except (KeyError, ValueError) as e:
+        return app.response_class(ujson.dumps({"error": str(e)}),
+                                  status=400,
+                                  mimetype='application/json')
+
+    plan = "order"
+    if order_by is None:
+        plan = db.explain(name, predicate).kind
+    records = db.query(name, predicate, columns, limit, order_by, descending)
+    result = {"records": list(records), "plan": plan}
+    return app.response_class(ujson.dumps(result),
+                              mimetype='application/json')
+
+
+@app.route('/table/<name>/delete', methods=['POST'])
+def table_delete(name):
+    spec = request.get_json(silent=True) or {}
+    if spec.get('where') is None:
+        return app.response_class(ujson.dumps(
+            {"error": "where is required, the table is not emptied"}),
+                                  status=400,
+                                  mimetype='application/json')
+
+    try:
+        predicate = db.parse_query(name, spec['where'])
+    except (KeyError, ValueError) as e:
+        return app.response_class(ujson.dumps({"error": str(e)}),
+                                  status=400,
+                                  mimetype='application/json')
+
+    deleted = db.delete_records(name, predicate)
+    return app.response_class(ujson.dumps({"deleted": deleted}),
+                              mimetype='application/json')
+
+
+@app.route('/table/<name>/aggregate', methods=['GET'])
+def table_aggregate(name):
+    column = request.args.get('column')
+    op = request.args.get('op', 'count')
+    group_by = request.args.get('group_by')
+
+    try:
+        result = db.aggregate(name, column, op, group_by)
+    except (KeyError, ValueError) as e:
+        return app.response_class(ujson.dumps({"error": str(e)}),
+                                  status=400,
+                                  mimetype='application/json')
+
+    if group_by is not None:
+        result = [{
+            "group": group,
+            "value": value
+        } for group, value in result.items()]
+
+    return app.response_class(ujson.dumps({"result": result}),
+                              mimetype='application/json')
+
+
+@app.route('/table/<name>/index', methods=['POST'])
+def create_index(name):
+    column = request.form.get('column')
+    ordered = bool(request.form.get('ordered', 0, type=int))
+    db.create_index(name, column, ordered)
+    return redirect(url_for('table', name=name))
+
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    return app.response_class(ujson.dumps(db.get_cache_stats()),
+                              mimetype='application/json')
+
+
+@app.route('/table/<name>/bloom', methods=['GET'])
+def bloom_stats(name):
+    return app.response_class(ujson.dumps(db.get_bloom_stats(name)),
+                              mimetype='application/json')
+
+
+@app.route('/table/<name>/buckets', methods=['GET'])
+def bucket_stats(name):
+    column = request.args.get('column')
+    columns = [column] if column else sorted(db.load_indexed_columns(name))
+    try:
+        stats = {
+            column: db.get_bucket_stats(name, column)
+            for column in columns
+        }
+    except ValueError as e:
+        return app.response_class(ujson.dumps({"error": str(e)}),
+                                  status=400,
+                                  mimetype='application/json')
+    return app.response_class(ujson.dumps(stats),
+                              mimetype='application/json')
+
+
+@app.route('/table/<name>/rehash', methods=['POST'])
+def rehash(name):
+    column = request.values.get('column') or None
+    number_of_buckets = request.values.get('number_of_buckets', type=int)
+    try:
+        splits = db.rehash(name, column, number_of_buckets)
+    except ValueError as e:
+        return app.response_class(ujson.dumps({"error": str(e)}),
+                                  status=400,
+                                  mimetype='application/json')
+    return app.response_class(ujson.dumps({"splits": splits}),
+                              mimetype='application/json')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if METRICS.enabled:
+        for stat, value in db.get_cache_stats().items():
+            METRICS.set("sdb_record_cache", value, stat=stat)
+        for table in db.list_tables():
+            for key, stats in db.get_bloom_stats(table).items():
+                METRICS.set("sdb_bloom_false_positive_rate",
+                            stats["false_positive_rate"],
+                            table=table,
+                            column=key)
+    return app.response_class(METRICS.render(),
+                              mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/profile', methods=['GET', 'POST'])
+def profile():
+    if request.method == "GET":
+        limit = request.args.get('limit', 50, type=int)
+        return app.response_class(PROFILER.report(limit),
+                                  mimetype='text/plain')
+
+    # a share of the instrumented DB calls to profile, 0 turns it off
+    rate = request.values.get('rate', type=float)
+    if rate is None or not 0 <= rate <= 1:
+        return "rate between 0 and 1 is required", 400
+    PROFILER.rate = rate
+    if request.values.get('reset', 0, type=int):
+        PROFILER.reset()
+    return app.response_class(ujson.dumps({"rate": PROFILER.rate}),
+                              mimetype='application/json')
 
 
 @app.route('/backup/<name>/', methods=['GET', 'POST'])
 def backup(name):
-    filename = os.path.join(os.getcwd(), f"{name}_backup.tar.gz")
     if request.method == "GET":
-        db.backup(name, filename)
-        return send_file(filename, mimetype='application/gzip')
+        incremental = bool(request.args.get('incremental', 0, type=int))
+        filename = f"{name}_backup.{CompressionExtensions[BACKUP_COMPRESSION]}"
+        return app.response_class(
+            db.backup_stream(name, incremental),
+            mimetype=CompressionMimetypes[BACKUP_COMPRESSION],
+            headers={
+                "Content-Disposition": f"attachment; filename={filename}"
+            })
     else:
-        request.files.get('file').save(filename)
-        db.restore(name, filename)
+        # uploads from the form come as multipart, anything else is the
+        # archive itself and is read straight from the request
+        upload = request.files.get('file')
+        try:
+            db.restore(name, upload.stream if upload else request.stream)
+        except (ValueError, tarfile.TarError) as e:
+            return f"broken backup: {e}", 400
         return 'file uploaded successfully'
 
 
@@ -88,7 +364,10 @@ def table(name):
         for column in db.load_columns_info(name)
     }
 
-    limit = request.args.get('limit', 10)
+    limit = request.args.get('limit', 10, type=int)
+    after = request.args.get('after', type=int)
+    order_by = request.args.get('order_by')
+    descending = bool(request.args.get('desc', 0, type=int))
     key = request.args.get('key')
     value = request.args.get('value')
     filter_value = request.args.get('filter_value')
@@ -113,12 +392,19 @@ def table(name):
 
         db.edit_record(name, pk, key, value)
 
-    rows = get_records(name, filter_column, filter_value)
+    rows, next_after = get_records(name, filter_column, filter_value, after,
+                                   limit, order_by, descending)
 
     return render_template("table.html",
                            table_name=name,
                            columns=columns,
                            rows=rows,
+                           limit=limit,
+                           after=after,
+                           next_after=next_after,
+                           order_by=order_by,
+                           desc=int(descending),
+                           ordered_columns=db.load_ordered_columns(name),
                            filter_value=filter_value,
                            filter_column=filter_column,
                            column_types=column_types)
@@ -132,7 +418,12 @@ def create():
         data = request.json
         name = data["name"]
         fields = [ColumnInfo(**field) for field in data["columns"]]
-        db.create_table(name, fields)
+        number_of_buckets = int(
+            data.get("number_of_buckets", NUMBER_OF_BUCKETS))
+        storage_format = data.get("storage_format", STORAGE_FORMAT_JSON)
+        columnar = bool(data.get("columnar", False))
+        db.create_table(name, fields, number_of_buckets, storage_format,
+                        columnar)
         return redirect("/")
 
 
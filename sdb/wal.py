@@ -0,0 +1,124 @@
+import os
+import struct
+import threading
+import zlib
+
+import ujson
+
+from .metrics import METRICS
+
+# every entry is framed as (body length, crc32 of body) followed by the body,
+# a torn or corrupted tail is detected by the checksum and ignored
+WalFrameStruct = struct.Struct("<II")
+WAL_FRAME_STRUCT_SIZE = WalFrameStruct.size
+
+
+def encode_wal_entry(meta, payload=b""):
+    body = ujson.dumps(meta).encode() + b"\n" + payload
+    return WalFrameStruct.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_wal_entries(data):
+    position = 0
+    while position + WAL_FRAME_STRUCT_SIZE <= len(data):
+        length, crc = WalFrameStruct.unpack_from(data, position)
+        position += WAL_FRAME_STRUCT_SIZE
+
+        body = data[position:position + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            return
+        position += length
+
+        meta, payload = body.split(b"\n", 1)
+        yield ujson.loads(meta), payload
+
+
+class WriteAheadLog:
+    """Append-only redo log of one table with group commit.
+
+    ``append`` hands the entry to the OS before the caller applies it to the
+    table files, so a crashed process never loses it. ``commit`` makes it
+    durable: whichever thread gets there first fsyncs on behalf of every
+    entry appended so far, the others just wait for that fsync.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.table = os.path.basename(os.path.dirname(path))
+        self.file = open(path, "ab")
+        self.condition = threading.Condition()
+        self.appended_lsn = 0
+        self.synced_lsn = 0
+        self.syncing = False
+
+    def append(self, meta, payload=b""):
+        data = encode_wal_entry(meta, payload)
+        with self.condition:
+            self.file.write(data)
+            self.file.flush()
+            self.appended_lsn += 1
+            lsn = self.appended_lsn
+        METRICS.inc("sdb_bytes_written_total",
+                    len(data),
+                    table=self.table,
+                    file="wal")
+        return lsn
+
+    def commit(self, lsn=None):
+        with self.condition:
+            lsn = self.appended_lsn if lsn is None else lsn
+            while self.synced_lsn < lsn:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+
+                self.syncing = True
+                target = self.appended_lsn
+                self.condition.release()
+                try:
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    self.condition.notify_all()
+                self.synced_lsn = max(self.synced_lsn, target)
+
+    def size(self):
+        return os.fstat(self.file.fileno()).st_size
+
+    def read(self, position=0):
+        with open(self.path, "rb") as wal:
+            wal.seek(position)
+            return list(decode_wal_entries(wal.read()))
+
+    def read_checkpoint(self):
+        """Returns the checkpoint the log starts with, None if it's torn."""
+        with open(self.path, "rb") as wal:
+            data = wal.read(WAL_FRAME_STRUCT_SIZE)
+            if len(data) < WAL_FRAME_STRUCT_SIZE:
+                return None
+            length, _ = WalFrameStruct.unpack(data)
+            data += wal.read(length)
+        for meta, _ in decode_wal_entries(data):
+            return meta
+        return None
+
+    def reset(self, meta):
+        with self.condition:
+            self.file.truncate(0)
+            self.file.write(encode_wal_entry(meta))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced_lsn = self.appended_lsn
+
+    def close(self):
+        # writers commit after releasing the table lock, the log may be
+        # closed under them: what they appended is synced here, so their
+        # commit finds nothing left to do
+        with self.condition:
+            while self.syncing:
+                self.condition.wait()
+            if self.synced_lsn < self.appended_lsn:
+                os.fsync(self.file.fileno())
+                self.synced_lsn = self.appended_lsn
+            self.file.close()
+            self.condition.notify_all()
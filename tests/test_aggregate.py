@@ -0,0 +1,67 @@
+import pytest
+
+from sdb.db import DB, ColumnInfo
+
+ROWS = 300
+
+
+def make_rows():
+    for i in range(ROWS):
+        row = {"city": f"city {i % 3}", "age": i % 40, "score": i / 4}
+        if i % 7 == 0:
+            del row["age"]
+        if i % 11 == 0:
+            del row["city"]
+        yield row
+
+
+@pytest.fixture(params=[False, True], ids=["rows", "columnar"])
+def db(tmp_path, request):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[
+                        ColumnInfo(name="city", is_key=False, type="str"),
+                        ColumnInfo(name="age", is_key=False, type="int"),
+                        ColumnInfo(name="score", is_key=False,
+                                   type="float"),
+                    ],
+                    columnar=request.param)
+    db.store_records("a", make_rows())
+    # the projection has to follow changes made after it was written
+    db.delete_record("a", "pk", 1)
+    assert db.update_record("a", 2, {"age": 1000})
+    return db
+
+
+def test_aggregates_skip_missing_values(db):
+    ages = [r["age"] for r in db.list_records("a") if "age" in r]
+
+    assert db.aggregate("a", None, "count") == ROWS - 1
+    assert db.aggregate("a", "age", "count") == len(ages)
+    assert db.aggregate("a", "age", "sum") == sum(ages)
+    assert db.aggregate("a", "age", "min") == 0
+    assert db.aggregate("a", "age", "max") == 1000
+    assert db.aggregate("a", "age", "mean") == pytest.approx(
+        sum(ages) / len(ages))
+
+
+def test_aggregates_by_group(db):
+    expected = {}
+    for record in db.list_records("a"):
+        expected.setdefault(record.get("city"), []).append(record["score"])
+
+    assert db.aggregate("a", "score", "sum", group_by="city") == \
+        pytest.approx({city: sum(v) for city, v in expected.items()})
+    assert db.aggregate("a", "score", "max", group_by="city") == \
+        {city: max(v) for city, v in expected.items()}
+    assert db.aggregate("a", None, "count", group_by="age")[1000] == 1
+
+
+@pytest.mark.parametrize("column,op,error", [
+    ("age", "median", ValueError),
+    ("city", "sum", ValueError),
+    ("height", "count", KeyError),
+])
+def test_bad_aggregates_are_rejected(db, column, op, error):
+    with pytest.raises(error):
+        db.aggregate("a", column, op)
@@ -0,0 +1,89 @@
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+from sdb.db import DB, ColumnInfo
+
+ROWS = 5000
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr("sdb.backup.BACKUP_BLOCK_SIZE", 4096)
+
+
+def make_table(path):
+    db = DB(str(path), sync_commits=False)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="name", is_key=False,
+                                        type="str")])
+    db.store_records("a", ({"name": f"name {i}"} for i in range(ROWS)))
+    return db
+
+
+def restore(path, *backups):
+    db = DB(str(path), sync_commits=False)
+    for backup in backups:
+        db.restore("a", io.BytesIO(backup))
+    return db
+
+
+def records(db):
+    return sorted((record["pk"], record["name"])
+                  for record in db.list_records("a"))
+
+
+@pytest.mark.parametrize("checkpoint", [False, True])
+def test_writes_while_backup_is_downloaded(tmp_path, checkpoint):
+    db = make_table(tmp_path / "db")
+
+    stream = db.iter_backup("a", False, {})
+    chunks = [next(stream) for _ in range(10)]
+    # the client is still downloading, the table lock is not held for it:
+    # the first row was shipped already and is changed in place
+    assert db.update_record("a", 0, {"name": "s"})
+    db.store_record("a", {"name": "new"})
+    if checkpoint:
+        # the log starts over, the changed blocks are found by their hashes
+        db.checkpoint("a")
+    chunks.extend(stream)
+
+    assert not any(".backup." in name
+                   for name in os.listdir(tmp_path / "db"))
+    restored = restore(tmp_path / "restored", b"".join(chunks))
+    assert records(restored) == records(db)
+    assert restored.get_record_by_key("a", "pk", 0)["name"] == "s"
+
+
+def test_incremental_backup_of_updated_rows(tmp_path):
+    db = make_table(tmp_path / "db")
+    full = b"".join(db.backup_stream("a"))
+    assert db.update_record("a", 10, {"name": "a much longer name"})
+    assert db.update_record("a", 20, {"name": "s"})
+
+    stream = db.iter_backup("a", True, {})
+    # the info member and the header of the first block, which is read by
+    # then and changed again below
+    chunks = [next(stream) for _ in range(4)]
+    assert db.update_record("a", 30, {"name": "t"})
+    chunks.extend(stream)
+
+    restored = restore(tmp_path / "restored", full, b"".join(chunks))
+    assert records(restored) == records(db)
+
+
+def test_stale_backup_snapshots_are_removed(tmp_path):
+    db = make_table(tmp_path)
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    stale = tmp_path / f".a.backup.{dead.pid}.0"
+    live = tmp_path / f".a.backup.{os.getpid()}.0"
+    stale.mkdir()
+    live.mkdir()
+
+    DB(str(tmp_path), sync_commits=False)
+    assert not stale.exists()
+    assert live.exists()
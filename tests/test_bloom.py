@@ -0,0 +1,75 @@
+import pytest
+
+from sdb.bloom import (BLOOM_VECTOR_MIN_VALUES, BloomFilter, bloom_positions,
+                       bloom_positions_many, write_bloom)
+from sdb.db import DB, ColumnInfo
+
+
+def test_single_and_batched_positions_agree():
+    values = ["a", 1, 2.5, "ünïcode"] * BLOOM_VECTOR_MIN_VALUES
+    batched = bloom_positions_many(values, 10007, 7).reshape(-1, 7)
+    for value, positions in zip(values, batched.tolist()):
+        assert bloom_positions(value, 10007, 7) == positions
+
+
+@pytest.mark.parametrize("count", [3, 10 * BLOOM_VECTOR_MIN_VALUES])
+def test_added_values_are_never_ruled_out(tmp_path, count):
+    write_bloom(str(tmp_path), "k", range(0, 2 * count, 2))
+    bloom = BloomFilter(str(tmp_path / "k.bloom"))
+    bloom.add_many(range(1, 2 * count, 2))
+
+    assert all(value in bloom for value in range(2 * count))
+    assert bloom.stats()["values"] == 2 * count
+    assert bloom.stats()["negatives"] == 0
+
+
+def test_few_absent_values_get_through(tmp_path):
+    write_bloom(str(tmp_path), "k", (f"{i}@x" for i in range(5000)))
+    bloom = BloomFilter(str(tmp_path / "k.bloom"))
+
+    passed = sum(f"{i}@y" in bloom for i in range(10000))
+    assert passed < 200
+    assert bloom.stats()["negatives"] == 10000 - passed
+
+
+def test_lookups_of_absent_keys_skip_the_buckets(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="email", is_key=True,
+                                        type="str")])
+    db.store_records("a", ({"email": f"{i}@x"} for i in range(1000)))
+    db.delete_record("a", "email", "5@x")
+    db.checkpoint("a")
+
+    db = DB(str(tmp_path), sync_commits=False)
+    index = db.get_index("a", "email")
+    for i in range(100):
+        assert db.get_record_by_key("a", "email", f"{i}@y") is None
+    # deleted values stay in the filter, their lookups are false positives
+    assert db.get_record_by_key("a", "email", "5@x") is None
+
+    stats = db.get_bloom_stats("a")["email"]
+    assert stats["checks"] == 101
+    assert stats["negatives"] + stats["false_positives"] == 101
+    assert stats["false_positives"] >= 1
+    assert len(index.buckets) <= stats["false_positives"]
+
+
+def test_full_filters_are_rebuilt_bigger(tmp_path, monkeypatch):
+    monkeypatch.setattr("sdb.bloom.BLOOM_MIN_CAPACITY", 64)
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="email", is_key=True,
+                                        type="str")])
+    bits = db.get_bloom_stats("a")["email"]["bits"]
+    for start in range(0, 1000, 100):
+        db.store_records("a", ({
+            "email": f"{i}@x"
+        } for i in range(start, start + 100)))
+
+    assert db.get_bloom_stats("a")["email"]["bits"] > bits
+    db = DB(str(tmp_path), sync_commits=False)
+    assert all(
+        db.get_record_by_key("a", "email", f"{i}@x") is not None
+        for i in range(1000))
+    assert db.get_bloom_stats("a")["email"]["negatives"] == 0
@@ -0,0 +1,51 @@
+from sdb.cache import RecordCache, estimate_size
+from sdb.db import DB, ColumnInfo
+
+
+def test_least_recently_used_records_are_evicted():
+    # room for three records of this size
+    cache = RecordCache(3 * estimate_size({"pk": 0, "email": "0@x"}))
+    for pk in range(3):
+        cache.put("a", pk, {"pk": pk, "email": f"{pk}@x"}, {"pk", "email"})
+    assert cache.get("a", "pk", 0) is not None
+    cache.put("a", 3, {"pk": 3, "email": "3@x"}, {"pk", "email"})
+
+    assert cache.get("a", "email", "1@x") is None
+    assert cache.get("a", "email", "0@x") == (0, {"pk": 0, "email": "0@x"})
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] <= cache.budget
+
+
+def test_cached_records_are_copies():
+    cache = RecordCache(2**20)
+    record = {"pk": 1, "name": "a"}
+    cache.put("a", 0, record, {"pk"})
+    record["name"] = "b"
+    cache.get("a", "pk", 1)[1]["name"] = "c"
+
+    assert cache.get("a", "pk", 1)[1] == {"pk": 1, "name": "a"}
+
+
+def test_writes_go_through_the_cache(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="email", is_key=True,
+                                        type="str")])
+    db.store_records("a", ({"email": f"{i}@x"} for i in range(10)))
+    assert db.get_record_by_key("a", "email", "1@x")["pk"] == 1
+    assert db.get_record_by_key("a", "pk", 1)["email"] == "1@x"
+    assert db.get_cache_stats()["hits"] == 1
+
+    assert db.update_record("a", 1, {"email": "new@x"})
+    assert db.get_record_by_key("a", "email", "1@x") is None
+    assert db.get_record_by_key("a", "pk", 1)["email"] == "new@x"
+
+    db.delete_record("a", "email", "new@x")
+    assert db.get_record_by_key("a", "pk", 1) is None
+
+    # a write of another process drops what this one cached
+    assert db.get_record_by_key("a", "pk", 2)["email"] == "2@x"
+    other = DB(str(tmp_path), sync_commits=False)
+    assert other.update_record("a", 2, {"email": "other@x"})
+    db.invalidate_table("a", False)
+    assert db.get_record_by_key("a", "pk", 2)["email"] == "other@x"
@@ -0,0 +1,64 @@
+import pickle
+
+import pytest
+
+from sdb.codec import STORAGE_FORMAT_BINARY, BinaryCodec
+from sdb.db import DB, ColumnInfo
+
+COLUMNS = [
+    ColumnInfo(name="name", is_key=False, type="str"),
+    ColumnInfo(name="age", is_key=False, type="int"),
+    ColumnInfo(name="city", is_key=False, type="str"),
+    ColumnInfo(name="score", is_key=False, type="float"),
+    ColumnInfo(name="pk", is_key=True, type="int"),
+]
+
+
+@pytest.mark.parametrize("values", [
+    {"name": "Анна", "age": -3, "city": "", "score": 0.5, "pk": 1},
+    {"name": "b", "pk": 2},
+    {"age": 0, "score": 0.0, "pk": 3},
+    {},
+])
+def test_rows_round_trip(values):
+    codec = BinaryCodec(COLUMNS)
+    data = codec.encode(values)
+
+    assert codec.decode(data) == values
+    assert codec.decode(codec.pad(data, len(data) + 7)) == values
+    for column in ("name", "age", "city", "score", "pk", "unknown"):
+        assert codec.decode_column(data, column) == values.get(column)
+
+
+def test_values_that_dont_fit_the_schema_are_rejected():
+    codec = BinaryCodec(COLUMNS)
+    with pytest.raises(ValueError):
+        codec.encode({"name": "a", "email": "a@x"})
+    with pytest.raises(ValueError):
+        codec.encode({"age": "ten"})
+    with pytest.raises(ValueError):
+        codec.encode({"age": 2**64})
+
+
+def test_codec_is_shipped_to_workers_by_schema():
+    codec = pickle.loads(pickle.dumps(BinaryCodec(COLUMNS)))
+    assert codec.decode(BinaryCodec(COLUMNS).encode({"city": "c"})) == \
+        {"city": "c"}
+
+
+def test_json_table_is_migrated_to_binary_rows(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a", columns=COLUMNS[:4])
+    db.store_records("a", ({
+        "name": f"name {i}",
+        "age": i
+    } for i in range(50)))
+    expected = list(db.list_records("a"))
+
+    db.migrate("a", storage_format=STORAGE_FORMAT_BINARY)
+
+    db = DB(str(tmp_path), sync_commits=False)
+    assert db.load_header("a").storage_format == STORAGE_FORMAT_BINARY
+    assert list(db.list_records("a")) == expected
+    assert db.get_record_by_key("a", "pk", 7) == {"name": "name 7", "age": 7,
+                                                  "pk": 7}
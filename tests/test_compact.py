@@ -0,0 +1,45 @@
+from sdb.db import DB, ColumnInfo
+from sdb.query import Eq
+
+ROWS = 5000
+
+
+def test_writes_during_compaction(tmp_path, monkeypatch):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[
+                        ColumnInfo(name="name", is_key=False, type="str"),
+                        ColumnInfo(name="age",
+                                   is_key=False,
+                                   type="int",
+                                   indexed=True,
+                                   ordered=True),
+                    ])
+    db.store_records("a", ({
+        "name": f"name {i}",
+        "age": i % 50
+    } for i in range(ROWS)))
+    db.delete_record("a", key="pk", value=1)
+
+    copy_compaction = db.copy_compaction
+
+    def copy_with_writes(name, compaction):
+        # writers are not kept out while the rows are copied
+        copy_compaction(name, compaction)
+        db.store_record("a", {"name": "new", "age": 1000})
+        assert db.update_record("a", 10, {"age": 2000})
+        assert db.update_record("a", 11, {"name": "a much longer name"})
+        db.delete_record("a", key="pk", value=12)
+
+    monkeypatch.setattr(db, "copy_compaction", copy_with_writes)
+    db.compact("a")
+
+    db = DB(str(tmp_path), sync_commits=False)
+    records = list(db.list_records("a"))
+    assert len(records) == ROWS - 1
+    assert db.get_record_by_key("a", "pk", 1) is None
+    assert db.get_record_by_key("a", "pk", 12) is None
+    assert db.get_record_by_key("a", "pk", 11)["name"] == "a much longer name"
+    assert [r["pk"] for r in db.query("a", order_by="age", descending=True,
+                                      limit=2)] == [10, ROWS]
+    assert sum(1 for _ in db.query("a", Eq("age", 10))) == ROWS // 50 - 1
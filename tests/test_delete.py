@@ -0,0 +1,28 @@
+import pytest
+
+from sdb.db import DB, ColumnInfo
+from sdb.query import Eq
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="age", is_key=False,
+                                        type="int")])
+    db.store_records("a", ({"age": i % 4} for i in range(100)))
+    return db
+
+
+def test_delete_records_matching_predicate(db):
+    assert db.delete_records("a", Eq("age", 1)) == 25
+    assert sorted({record["age"] for record in db.list_records("a")}) == \
+        [0, 2, 3]
+
+
+def test_delete_records_needs_a_predicate(db):
+    with pytest.raises(TypeError):
+        db.delete_records("a")
+    with pytest.raises(ValueError):
+        db.delete_records("a", None)
+    assert sum(1 for _ in db.list_records("a")) == 100
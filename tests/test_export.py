@@ -0,0 +1,78 @@
+import csv
+import io
+
+import numpy as np
+import pytest
+import ujson
+
+from sdb.columns import INT_MISSING
+from sdb.db import DB, ColumnInfo
+from sdb.export import read_columnar
+from sdb.query import Gt
+
+NAMES = ["plain", "with, comma", 'with "quotes"', "two\nlines", "ünïcode"]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[
+                        ColumnInfo(name="name", is_key=False, type="str"),
+                        ColumnInfo(name="age",
+                                   is_key=False,
+                                   type="int",
+                                   ordered=True),
+                    ])
+    db.store_records("a", ({
+        "name": NAMES[i % len(NAMES)],
+        "age": i
+    } for i in range(20)))
+    db.store_record("a", {"name": "no age"})
+    return db
+
+
+def export(db, *args, **kwargs):
+    return b"".join(db.export("a", *args, **kwargs))
+
+
+def test_csv_quotes_what_needs_it(db):
+    rows = list(csv.reader(io.StringIO(export(db, "csv").decode())))
+
+    assert rows[0] == ["name", "age", "pk"]
+    assert rows[1:] == [[r["name"], str(r.get("age", "")),
+                         str(r["pk"])] for r in db.list_records("a")]
+
+
+def test_ndjson_with_columns_predicate_and_order(db):
+    lines = export(db, "ndjson").splitlines()
+    assert [ujson.loads(line) for line in lines] == list(db.list_records("a"))
+
+    lines = export(db,
+                   "ndjson",
+                   columns=["age"],
+                   predicate=Gt("age", 16),
+                   order_by="age",
+                   descending=True).splitlines()
+    assert lines == [b'{"age":19}', b'{"age":18}', b'{"age":17}']
+
+
+def test_columnar_export_reads_back(db, monkeypatch):
+    monkeypatch.setattr("sdb.export.EXPORT_GROUP_SIZE", 8)
+    groups = list(read_columnar(io.BytesIO(export(db, "columnar"))))
+
+    assert [len(group["pk"]) for group in groups] == [8, 8, 5]
+    names = sum((group["name"] for group in groups), [])
+    ages = np.concatenate([group["age"] for group in groups])
+    assert names == [r["name"] for r in db.list_records("a")]
+    assert ages.tolist() == list(range(20)) + [INT_MISSING]
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"export_format": "xml"},
+    {"columns": ["name", "height"]},
+    {"order_by": "name"},
+])
+def test_bad_exports_are_rejected(db, kwargs):
+    with pytest.raises(ValueError):
+        db.export("a", **kwargs)
@@ -0,0 +1,62 @@
+import os
+
+from sdb.db import DB, ColumnInfo
+from sdb.markup import (MARKUP_VERSION, MARKUP_VERSION_LEGACY, MarkupView,
+                        pack_markup_entries)
+
+
+def make_legacy_table(path):
+    """Writes a table the way it was stored before the format had a
+    version: no header and 32-bit markup entries."""
+    db = DB(str(path), sync_commits=False)
+    db.create_table("a",
+                    columns=[
+                        ColumnInfo(name="name", is_key=True, type="str"),
+                        ColumnInfo(name="age", is_key=False, type="int"),
+                    ])
+    db.store_records("a", ({
+        "name": f"name {i}",
+        "age": i % 10
+    } for i in range(100)))
+    db.delete_record("a", "name", "name 3")
+    db.checkpoint("a")
+
+    spans = [(start, length)
+             for _, start, length, _ in db.list_markup_records("a")]
+    os.remove(db.get_header_path("a"))
+    with open(db.get_markup_path("a"), "wb") as markup:
+        markup.write(pack_markup_entries(spans, MARKUP_VERSION_LEGACY))
+    MarkupView(db.get_markup_path("a"),
+               MARKUP_VERSION_LEGACY).set_inactive([3])
+
+
+def test_starts_past_2_gib_fit_the_markup(tmp_path):
+    path = tmp_path / "markup.bin"
+    path.touch()
+    markup = MarkupView(str(path), MARKUP_VERSION)
+    markup.append([(2**33, 100), (2**33 + 100, 2**31)])
+
+    assert MarkupView(str(path)).read(1) == (2**33 + 100, 2**31, True)
+
+
+def test_legacy_tables_are_read_and_migrated(tmp_path):
+    make_legacy_table(tmp_path)
+
+    db = DB(str(tmp_path), sync_commits=False)
+    assert db.load_header("a").version == MARKUP_VERSION_LEGACY
+    assert db.get_record_by_key("a", "name", "name 42")["age"] == 2
+    expected = sorted(
+        (record["name"], record["age"]) for record in db.list_records("a"))
+    assert len(expected) == 99
+
+    db.migrate("a", number_of_buckets=16)
+
+    db = DB(str(tmp_path), sync_commits=False)
+    header = db.load_header("a")
+    assert (header.version, header.number_of_buckets) == (MARKUP_VERSION, 16)
+    assert os.path.getsize(db.get_markup_path("a")) == \
+        99 * db.get_markup("a").entry_size
+    assert sorted((record["name"], record["age"])
+                  for record in db.list_records("a")) == expected
+    assert db.get_record_by_key("a", "name", "name 42")["age"] == 2
+    assert db.get_record_by_key("a", "name", "name 3") is None
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+from sdb.handles import APPEND_FLAGS, HandlePool
+
+
+def is_open(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"{i}.bin"
+        path.write_bytes(b"%d" % i)
+        paths.append(str(path))
+    return paths
+
+
+def test_handles_are_reused_and_idle_ones_evicted(files):
+    pool = HandlePool(2)
+    with pool.open(files[0]) as first:
+        with pool.open(files[0]) as again:
+            assert again == first
+        # the handle in use outlives the eviction of the idle ones
+        for i, path in enumerate(files[1:], start=1):
+            with pool.open(path) as fd:
+                assert os.pread(fd, 1, 0) == b"%d" % i
+        assert len(pool) == 2
+        assert is_open(first)
+        assert os.pread(first, 1, 0) == b"0"
+
+
+def test_invalidated_handles_are_closed_by_their_last_user(files):
+    pool = HandlePool(8)
+    with pool.open(files[1]) as idle:
+        pass
+    with pool.open(files[0], APPEND_FLAGS) as busy:
+        pool.invalidate(os.path.dirname(files[0]))
+        assert not is_open(idle)
+        # the file is replaced while it is written
+        os.replace(files[2], files[0])
+        os.write(busy, b"!")
+    assert not is_open(busy)
+
+    with pool.open(files[0]) as fd:
+        assert os.pread(fd, 2, 0) == b"2"
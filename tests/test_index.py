@@ -0,0 +1,66 @@
+import os
+
+import pytest
+import ujson
+
+from sdb.handles import HandlePool
+from sdb.index import HashIndex, MultiHashIndex
+
+
+@pytest.fixture
+def handles():
+    return HandlePool(16)
+
+
+def test_lookups_of_put_and_removed_values(tmp_path, handles):
+    index = HashIndex(str(tmp_path), "email", 4, handles)
+    index.put_many([(f"{i}@x", i) for i in range(100)])
+    index.remove("7@x", 7)
+    # an entry of another row is not removed by a stale offset
+    index.remove("8@x", 9)
+
+    assert index.get("3@x") == 3
+    assert index.get("7@x") is None
+    assert "8@x" in index
+    assert "missing" not in index
+
+
+def test_index_is_read_back_from_its_bucket_files(tmp_path, handles):
+    index = MultiHashIndex(str(tmp_path), "age", 4, handles)
+    index.put_many([(i % 3, i) for i in range(30)])
+    index.remove(1, 4)
+
+    reopened = MultiHashIndex(str(tmp_path), "age", 4, HandlePool(16))
+    assert reopened.get(0) == list(range(0, 30, 3))
+    assert 4 not in reopened.get(1)
+    assert reopened.get(5) == []
+
+
+def test_appends_of_other_processes_are_seen_after_invalidate(
+        tmp_path, handles):
+    index = HashIndex(str(tmp_path), "email", 1, handles)
+    index.put("a@x", 0)
+    other = HashIndex(str(tmp_path), "email", 1, HandlePool(16))
+    other.put("b@x", 1)
+
+    assert index.get("b@x") is None
+    index.invalidate()
+    assert index.get("b@x") == 1
+    assert index.get("a@x") == 0
+
+
+def test_legacy_json_buckets_are_converted(tmp_path, handles):
+    index = HashIndex(str(tmp_path), "email", 1, handles)
+    with open(index.get_legacy_bucket_path(0), "wt") as legacy:
+        for offset, email in enumerate(["a@x", "b@x"]):
+            legacy.write(ujson.dumps({"email": email, "offset": offset}))
+            legacy.write("\n")
+
+    assert index.get("b@x") == 1
+    assert not os.path.exists(index.get_legacy_bucket_path(0))
+    assert os.path.isfile(index.get_bucket_path(0))
+
+    index.put("c@x", 2)
+    reopened = HashIndex(str(tmp_path), "email", 1, HandlePool(16))
+    assert [reopened.get(email) for email in ("a@x", "b@x", "c@x")] == \
+        [0, 1, 2]
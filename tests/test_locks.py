@@ -0,0 +1,39 @@
+import subprocess
+import sys
+import threading
+import time
+
+from sdb.locks import TableLock
+
+WRITER = """
+import sys
+from sdb.locks import TableLock
+
+with TableLock(sys.argv[1], lambda structure_changed: None).write():
+    pass
+"""
+
+
+def test_writer_of_other_process_gets_past_overlapping_readers(tmp_path):
+    lock = TableLock(str(tmp_path / ".a.lock"),
+                     lambda structure_changed: None)
+    done = threading.Event()
+
+    def read():
+        # the readers overlap, the process never stops holding the file
+        while not done.is_set():
+            with lock.read():
+                time.sleep(0.01)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    try:
+        time.sleep(0.1)
+        writer = subprocess.run([sys.executable, "-c", WRITER, lock.path],
+                                timeout=10)
+        assert writer.returncode == 0
+    finally:
+        done.set()
+        for reader in readers:
+            reader.join()
@@ -0,0 +1,38 @@
+import numpy as np
+
+from sdb.markup import MarkupView
+
+
+def test_entries_written_by_another_view_are_mapped(tmp_path):
+    path = tmp_path / "markup.bin"
+    path.touch()
+    writer = MarkupView(str(path))
+    reader = MarkupView(str(path))
+
+    assert writer.append([(0, 10), (10, 5)]) == 0
+    assert reader.read(1) == (10, 5, True)
+    assert reader.read(2) is None
+
+    writer.append([(15, 7)])
+    reader.refresh()
+    offsets, starts, lengths = reader.active()
+    assert offsets.tolist() == [0, 1, 2]
+    assert starts.tolist() == [0, 10, 15]
+    assert lengths.tolist() == [10, 5, 7]
+
+
+def test_dead_rows_are_counted_as_they_are_flipped(tmp_path):
+    path = tmp_path / "markup.bin"
+    path.touch()
+    markup = MarkupView(str(path))
+    markup.append([(i, 1) for i in range(10)])
+
+    assert markup.count_dead() == 0
+    markup.set_inactive([2, 3, 3, 42])
+    markup.set_active(5, False)
+    markup.set_active(2, True)
+    markup.append([(10, 1)])
+
+    assert markup.count_dead() == 2
+    assert markup.active()[0].tolist() == [0, 1, 2, 4, 6, 7, 8, 9, 10]
+    assert np.array_equal(markup.active(after=4)[0], [6, 7, 8, 9, 10])
@@ -0,0 +1,25 @@
+from sdb.db import DB, SCAN_CHUNK_SIZE, ColumnInfo
+from sdb.metrics import METRICS
+
+ROWS = 5 * SCAN_CHUNK_SIZE
+
+
+def counted(name, table):
+    return METRICS.values.get((name, (("table", table), )), 0)
+
+
+def test_scans_stopped_early_count_what_they_read(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="age", is_key=False,
+                                        type="int")])
+    db.store_records("a", ({"age": i} for i in range(ROWS)))
+
+    METRICS.reset()
+    assert len(list(db.query("a", limit=5))) == 5
+    assert counted("sdb_rows_scanned_total", "a") <= SCAN_CHUNK_SIZE
+
+    METRICS.reset()
+    assert sum(1 for _ in db.list_records("a")) == ROWS
+    assert counted("sdb_rows_scanned_total", "a") == ROWS
+    assert counted("sdb_rows_returned_total", "a") == ROWS
@@ -0,0 +1,37 @@
+import threading
+
+from sdb.db import DB, ColumnInfo
+
+ROWS = 12000
+
+
+def test_concurrent_first_range_scans(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[
+                        ColumnInfo(name="age",
+                                   is_key=False,
+                                   type="int",
+                                   ordered=True)
+                    ])
+    # the changes stay in the log of the index, which a load replays
+    db.store_records("a", ({"age": i % 97} for i in range(ROWS)))
+
+    for _ in range(5):
+        # what a write of another process does to the index
+        db.invalidate_table("a", False)
+        barrier = threading.Barrier(2)
+        counts = []
+
+        def scan():
+            barrier.wait()
+            counts.append(
+                sum(1 for _ in db.query("a", order_by="age")))
+
+        threads = [threading.Thread(target=scan) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert counts == [ROWS, ROWS]
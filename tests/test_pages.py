@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from sdb.db import DB, ColumnInfo
+from sdb.markup import ACTIVE_WINDOW_SIZE
+
+ROWS = 3 * ACTIVE_WINDOW_SIZE
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="age", is_key=False,
+                                        type="int")])
+    db.store_records("a", ({"age": i % 7} for i in range(ROWS)))
+    # a long run of deleted rows the first window finds nothing in
+    db.get_markup("a").set_inactive(range(100, 100 + ACTIVE_WINDOW_SIZE * 2))
+    return db
+
+
+@pytest.mark.parametrize("after,count", [(-1, 10), (50, 100), (99, 3),
+                                         (ROWS - 5, 10), (ROWS, 1)])
+def test_active_window_is_a_prefix_of_all_active_rows(db, after, count):
+    markup = db.get_markup("a")
+    offsets, starts, lengths = markup.active(after)
+    window = markup.active(after, count)
+    for expected, found in zip((offsets, starts, lengths), window):
+        assert np.array_equal(expected[:count], found)
+
+
+@pytest.mark.parametrize("key,value", [(None, None), ("age", 3)])
+def test_pages_cover_the_table(db, key, value):
+    expected = [
+        record["pk"] for record in db.list_records("a")
+        if key is None or record[key] == value
+    ]
+
+    pks, after = [], None
+    while True:
+        page, after = db.list_records_page("a", after, 25, key, value)
+        pks += [record["pk"] for record in page]
+        if after is None:
+            break
+    assert pks == expected
@@ -0,0 +1,65 @@
+import sys
+
+import pytest
+import ujson
+
+from sdb.perf import Benchmarks, build_records, compare, main, run_benchmark
+
+
+def test_records_only_depend_on_the_seed():
+    records = build_records(200, 7)
+    assert records == build_records(200, 7)
+    assert records != build_records(200, 8)
+    assert len({record["number"] for record in records}) == 200
+
+
+@pytest.mark.parametrize("benchmark", sorted(Benchmarks))
+def test_benchmark_results(benchmark):
+    result = run_benchmark(benchmark, 50, 10, 42, False)
+
+    assert result["benchmark"] == benchmark
+    assert result["ops"] > 0 and result["rows"] > 0
+    assert result["throughput"] > 0
+    assert 0 < result["p50_ms"] <= result["p99_ms"]
+    assert result["bytes_on_disk"] > 0
+
+
+def test_regressions_past_the_threshold():
+    baseline = {
+        "scan@10": {"throughput": 100.0, "p50_ms": 1.0},
+        "edit@10": {"throughput": 100.0, "p50_ms": 1.0},
+    }
+    results = {
+        "scan@10": {"throughput": 80.0, "p50_ms": 1.2},
+        "edit@10": {"throughput": 70.0, "p50_ms": 1.3},
+        "delete@10": {"throughput": 1.0, "p50_ms": 100.0},
+    }
+
+    regressions = compare(results, baseline, 0.25)
+    assert [regression.split(":")[0] for regression in regressions] == \
+        ["edit@10", "edit@10"]
+
+
+def run_main(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["perf", "--sizes", "20", "--ops", "5",
+                                      "--benchmarks", "key_lookup", "scan",
+                                      "--no-sync", *args])
+    main()
+
+
+def test_run_is_compared_to_its_baseline(tmp_path, monkeypatch):
+    output = tmp_path / "results.json"
+    run_main(monkeypatch, "--output", str(output))
+    report = ujson.loads(output.read_text())
+    assert sorted(report["results"]) == ["key_lookup@20", "scan@20"]
+    assert report["meta"]["seed"] == 42
+
+    # the same run is well within a threshold this large
+    run_main(monkeypatch, "--baseline", str(output), "--threshold", "1000")
+
+    for result in report["results"].values():
+        result["throughput"] *= 1000
+    output.write_text(ujson.dumps(report))
+    with pytest.raises(SystemExit) as exit:
+        run_main(monkeypatch, "--baseline", str(output))
+    assert exit.value.code == 1
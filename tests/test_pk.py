@@ -0,0 +1,28 @@
+import os
+
+from sdb.db import DB, ColumnInfo
+
+
+def test_pks_after_crash_with_logged_rows(tmp_path):
+    db = DB(str(tmp_path), sync_commits=True)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="name", is_key=False,
+                                        type="str")])
+    db.store_records("a", ({"name": f"name {i}"} for i in range(1000)))
+    checkpoint = db.checkpoint("a")
+    db.store_records("a", ({"name": f"name {i}"} for i in range(1000, 2000)))
+
+    # the process dies with the rows in the log but not in the table files
+    entry_size = db.get_markup("a").entry_size
+    os.truncate(db.get_markup_path("a"), checkpoint["rows"] * entry_size)
+    os.truncate(db.get_storage_path("a"), checkpoint["storage"])
+
+    db = DB(str(tmp_path), sync_commits=True)
+    pks = {record["name"]: record["pk"] for record in db.list_records("a")}
+    assert len(pks) == 2000
+
+    # the pks of the replayed rows are not handed out again
+    db.store_record("a", {"name": "new"})
+    assert db.get_record_by_key("a", "pk", pks["name 1999"])["name"] == \
+        "name 1999"
+    assert len({record["pk"] for record in db.list_records("a")}) == 2001
@@ -0,0 +1,108 @@
+import pytest
+
+import sdb.db
+from sdb.db import DB, SCAN_CHUNK_SIZE, ColumnInfo
+from sdb.query import (And, Between, Eq, Gt, In, Lt, Or, Prefix,
+                       parse_predicate, plan_query)
+
+ROWS = 3 * SCAN_CHUNK_SIZE
+
+
+def cast(column, value):
+    return int(value)
+
+
+@pytest.mark.parametrize("spec", [
+    {"column": "age", "op": "<", "value": None},
+    {"column": "age", "op": "==", "value": [1]},
+    {"column": "age", "op": "==", "value": {"a": 1}},
+    {"column": "age", "op": "in", "value": [1, None]},
+    {"column": "age", "op": "between", "value": [1, {}]},
+    {"column": "age", "op": "prefix", "value": ["a"]},
+])
+def test_leaf_values_that_cant_be_cast_are_rejected(spec):
+    with pytest.raises(ValueError):
+        parse_predicate(spec, cast)
+
+
+def test_leaf_values_are_cast():
+    between = parse_predicate(
+        {"column": "age", "op": "between", "value": ["1", 2]}, cast)
+    assert isinstance(between, Between)
+    assert (between.low, between.high) == (1, 2)
+
+    values = parse_predicate({"column": "age", "op": "in", "value": ["3"]},
+                             cast)
+    assert isinstance(values, In)
+    assert 3 in values.values
+
+
+@pytest.fixture(scope="module")
+def db(tmp_path_factory):
+    db = DB(str(tmp_path_factory.mktemp("db")), sync_commits=False)
+    db.create_table("a",
+                    columns=[
+                        ColumnInfo(name="email", is_key=True, type="str"),
+                        ColumnInfo(name="city",
+                                   is_key=False,
+                                   type="str",
+                                   indexed=True),
+                        ColumnInfo(name="age",
+                                   is_key=False,
+                                   type="int",
+                                   ordered=True),
+                        ColumnInfo(name="name", is_key=False, type="str"),
+                    ])
+    db.store_records("a", ({
+        "email": f"{i}@x",
+        "city": f"city {i % 10}",
+        "age": i % 90,
+        "name": f"name {i}",
+    } for i in range(ROWS)))
+    return db
+
+
+@pytest.mark.parametrize("predicate,kind,column", [
+    (None, "scan", None),
+    (Eq("email", "7@x"), "index", "email"),
+    (In("city", ["city 1", "city 2"]), "index", "city"),
+    (And(Eq("city", "city 1"), Eq("email", "11@x")), "index", "email"),
+    (Or(Eq("city", "city 1"), Eq("city", "city 3")), "index", "city"),
+    (Or(Eq("city", "city 1"), Eq("email", "3@x")), "union", None),
+    (Or(Eq("city", "city 1"), Eq("name", "name 3")), "scan", None),
+    (And(Gt("age", 10), Lt("age", 20)), "range", "age"),
+    (And(Between("age", 5, 6), Prefix("name", "name 1")), "range", "age"),
+    (Prefix("name", "name 1"), "scan", None),
+])
+def test_planner_picks_the_narrowest_access_path(db, predicate, kind,
+                                                 column):
+    plan = db.explain("a", predicate)
+    assert (plan.kind, plan.column) == (kind, column)
+
+    expected = [(offset, record)
+                for offset, record in db.scan_records("a")
+                if predicate is None or predicate.matches(record)]
+    assert sorted(db.execute_plan("a", plan, predicate)) == expected
+
+
+def test_range_plan_bounds():
+    plan = plan_query(And(Gt("age", 10), Lt("age", 20), Gt("age", 15)),
+                      keys={"pk"},
+                      indexed=set(),
+                      ordered={"age"})
+    assert plan.values == [15, 20]
+
+
+def test_limit_stops_the_scan_early(db, monkeypatch):
+    chunks = []
+    read_range_data = sdb.db.read_range_data
+
+    def count_chunks(storage, offsets, starts, lengths):
+        chunks.append(len(offsets))
+        return read_range_data(storage, offsets, starts, lengths)
+
+    monkeypatch.setattr(sdb.db, "read_range_data", count_chunks)
+    records = list(db.query("a", Prefix("name", "name 1"), ["name"], 5))
+
+    assert records == [{"name": f"name {i}"} for i in (1, 10, 11, 12, 13)]
+    assert chunks == [SCAN_CHUNK_SIZE]
@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+from sdb.db import DB, ColumnInfo
+from sdb.handles import HandlePool
+from sdb.index import HashIndex, MultiHashIndex
+
+ROWS = 2000
+
+
+class Crash(Exception):
+    pass
+
+
+def crash(level, split):
+    raise Crash()
+
+
+def test_values_are_found_after_every_split(tmp_path):
+    index = HashIndex(str(tmp_path), "email", 3, HandlePool(16))
+    index.put_many((f"{i}@x", i) for i in range(ROWS))
+
+    splits = []
+    for _ in range(8):
+        index.split_bucket(lambda level, split: splits.append(
+            (level, split)))
+        assert all(index.get(f"{i}@x") == i for i in range(ROWS))
+
+    # the three buckets have doubled, then five of the six of the next level
+    assert splits[-1] == (1, 5)
+    assert index.count_buckets() == 11
+    reopened = HashIndex(str(tmp_path), "email", 3, HandlePool(16), None,
+                         *splits[-1])
+    assert all(reopened.get(f"{i}@x") == i for i in range(ROWS))
+    assert reopened.get("missing") is None
+
+
+def test_split_interrupted_before_its_commit(tmp_path):
+    index = MultiHashIndex(str(tmp_path), "age", 2, HandlePool(16))
+    index.put_many((i % 50, i) for i in range(ROWS))
+
+    # the sibling is written, but the index still addresses the old layout
+    with pytest.raises(Crash):
+        index.split_bucket(crash)
+
+    reopened = MultiHashIndex(str(tmp_path), "age", 2, HandlePool(16))
+    assert reopened.count_buckets() == 2
+    assert all(
+        reopened.get(age) == list(range(age, ROWS, 50)) for age in range(50))
+
+
+def make_table(path):
+    db = DB(str(path), sync_commits=False)
+    db.create_table("a",
+                    columns=[
+                        ColumnInfo(name="email", is_key=True, type="str"),
+                        ColumnInfo(name="age", is_key=False, type="int",
+                                   indexed=True),
+                    ],
+                    number_of_buckets=2)
+    db.store_records("a", ({
+        "email": f"{i}@x",
+        "age": i % 50
+    } for i in range(ROWS)))
+    return db
+
+
+def test_lookups_while_the_index_is_rehashed(tmp_path):
+    db = make_table(tmp_path)
+    lookups = DB(str(tmp_path), sync_commits=False)
+
+    rehash = threading.Thread(
+        target=lambda: db.rehash("a", number_of_buckets=64))
+    rehash.start()
+    try:
+        while rehash.is_alive():
+            for i in range(0, ROWS, 97):
+                assert lookups.get_record_by_key("a", "email",
+                                                 f"{i}@x")["pk"] == i
+            assert len(list(lookups.get_record("a", "age", 7))) == ROWS // 50
+    finally:
+        rehash.join()
+
+    stats = lookups.get_bucket_stats("a", "email")
+    assert stats["buckets"] == 64
+    assert (stats["level"], stats["split"]) == (5, 0)
+    assert all(
+        lookups.get_record_by_key("a", "email", f"{i}@x")["pk"] == i
+        for i in range(ROWS))
+
+
+def test_overloaded_buckets_are_split_until_they_fit(tmp_path):
+    db = make_table(tmp_path)
+    before = db.get_bucket_stats("a", "age")
+
+    splits = db.rehash("a", "age", max_bucket_size=before["mean_bytes"] / 5)
+
+    after = db.get_bucket_stats("a", "age")
+    assert splits == {"age": after["buckets"] - before["buckets"]}
+    assert after["mean_bytes"] <= before["mean_bytes"] / 5
+    db = DB(str(tmp_path), sync_commits=False)
+    assert db.get_bucket_stats("a", "age")["buckets"] == after["buckets"]
+    assert len(list(db.get_record("a", "age", 7))) == ROWS // 50
+    with pytest.raises(ValueError):
+        db.rehash("a", "height")
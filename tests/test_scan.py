@@ -0,0 +1,24 @@
+from sdb.db import DB, ColumnInfo
+from sdb.query import Eq
+from sdb.scan import SCAN_PARALLEL_MIN_ROWS
+
+
+def test_only_filtered_scans_go_to_workers(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False, scan_workers=2)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="age", is_key=False,
+                                        type="int")])
+    db.store_records("a", ({
+        "age": i % 10
+    } for i in range(SCAN_PARALLEL_MIN_ROWS)))
+
+    try:
+        assert sum(1 for _ in db.list_records("a")) == SCAN_PARALLEL_MIN_ROWS
+        assert db.scanner.executor is None
+
+        rows = list(db.scan_records("a", predicate=Eq("age", 3)))
+        assert len(rows) == sum(1 for i in range(SCAN_PARALLEL_MIN_ROWS)
+                                if i % 10 == 3)
+        assert db.scanner.executor is not None
+    finally:
+        db.scanner.close()
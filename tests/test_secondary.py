@@ -0,0 +1,49 @@
+import pytest
+
+from sdb.db import DB, ColumnInfo
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path), sync_commits=False)
+    db.create_table("a",
+                    columns=[
+                        ColumnInfo(name="name", is_key=False, type="str"),
+                        ColumnInfo(name="city", is_key=False, type="str"),
+                    ])
+    db.store_records("a", ({
+        "name": f"name {i}",
+        "city": f"city {i % 5}"
+    } for i in range(200)))
+    db.create_index("a", "city")
+    return db
+
+
+def names(db, city):
+    return sorted(record["name"]
+                  for record in db.get_record("a", "city", city))
+
+
+def no_scans(name, *args, **kwargs):
+    raise AssertionError("indexed columns are not scanned")
+
+
+def test_index_built_for_existing_rows_answers_lookups(db, monkeypatch):
+    expected = sorted(f"name {i}" for i in range(200) if i % 5 == 2)
+
+    monkeypatch.setattr(db, "scan_matching", no_scans)
+    assert "city" in db.load_indexed_columns("a")
+    assert names(db, "city 2") == expected
+    assert names(db, "city 9") == []
+
+
+def test_index_follows_writes(db, monkeypatch):
+    db.store_record("a", {"name": "new", "city": "city 9"})
+    assert db.update_record("a", 1, {"city": "city 9"})
+    assert db.delete_record("a", "city", "city 3") == 40
+
+    db = DB(db.path, sync_commits=False)
+    monkeypatch.setattr(db, "scan_matching", no_scans)
+    assert names(db, "city 9") == ["name 1", "new"]
+    assert "name 1" not in names(db, "city 1")
+    assert names(db, "city 3") == []
@@ -0,0 +1,46 @@
+from sdb.db import DB, ColumnInfo
+
+
+def make_db(path):
+    db = DB(str(path), sync_commits=False)
+    db.create_table("people",
+                    columns=[
+                        ColumnInfo(name="email", is_key=True, type="str"),
+                        ColumnInfo(name="age", is_key=False, type="int"),
+                    ])
+    return db
+
+
+def test_batch_skips_duplicate_keys(tmp_path):
+    db = make_db(tmp_path)
+    assert db.store_record("people", {"email": "a@x", "age": 1})
+
+    stored = db.store_records("people", [
+        {"email": "a@x", "age": 2},
+        {"email": "b@x", "age": 3},
+        {"email": "b@x", "age": 4},
+        {"email": "c@x", "age": 5},
+    ])
+
+    assert stored == 2
+    assert {(r["email"], r["age"]) for r in db.list_records("people")} == \
+        {("a@x", 1), ("b@x", 3), ("c@x", 5)}
+
+
+def test_batches_are_logged_as_one_entry_each(tmp_path, monkeypatch):
+    monkeypatch.setattr("sdb.db.STORE_BATCH_SIZE", 10)
+    db = make_db(tmp_path)
+
+    stored = db.store_records("people", ({
+        "email": f"{i}@x",
+        "age": i
+    } for i in range(25)))
+
+    assert stored == 25
+    entries = [meta for meta, _ in db.get_wal("people").read()]
+    assert [len(meta["lengths"]) for meta in entries
+            if meta["op"] == "store"] == [10, 10, 5]
+
+    db = DB(str(tmp_path), sync_commits=False)
+    assert db.get_record_by_key("people", "email", "24@x")["age"] == 24
+    assert len({r["pk"] for r in db.list_records("people")}) == 25
@@ -0,0 +1,40 @@
+import pytest
+
+from sdb.codec import STORAGE_FORMAT_BINARY, STORAGE_FORMAT_JSON
+from sdb.db import DB, ColumnInfo
+
+
+def make_table(path, storage_format):
+    db = DB(str(path), sync_commits=False)
+    db.create_table("a",
+                    columns=[ColumnInfo(name="name", is_key=False,
+                                        type="str")],
+                    storage_format=storage_format)
+    db.store_records("a", ({"name": f"name {i}"} for i in range(10000)))
+    return db
+
+
+@pytest.mark.parametrize("storage_format",
+                         [STORAGE_FORMAT_JSON, STORAGE_FORMAT_BINARY])
+def test_shrinking_update_during_scan(tmp_path, storage_format):
+    db = make_table(tmp_path, storage_format)
+
+    names = []
+    for i, record in enumerate(db.list_records("a")):
+        if i == 1:
+            assert db.update_record("a", 9000, {"name": "s"})
+        names.append(record["name"])
+
+    assert len(names) == 10000
+    assert names[9000] in ("name 9000", "s")
+    assert db.get_record_by_key("a", "pk", 9000)["name"] == "s"
+
+
+def test_shrunk_row_survives_reopen_and_export(tmp_path):
+    db = make_table(tmp_path, STORAGE_FORMAT_JSON)
+    assert db.update_record("a", 5, {"name": "s"})
+
+    db = DB(str(tmp_path), sync_commits=False)
+    assert db.get_record_by_key("a", "pk", 5)["name"] == "s"
+    lines = b"".join(db.export("a", "ndjson")).splitlines()
+    assert lines[5] == b'{"name":"s","pk":5}'
@@ -0,0 +1,13 @@
+from sdb.wal import WriteAheadLog
+
+
+def test_commit_after_close(tmp_path):
+    wal = WriteAheadLog(str(tmp_path / "wal.log"))
+    lsn = wal.append({"op": "store"}, b"row")
+    # another thread dropped the table state before the writer committed
+    wal.close()
+    wal.commit(lsn)
+
+    assert WriteAheadLog(str(tmp_path / "wal.log")).read() == [({
+        "op": "store"
+    }, b"row")]